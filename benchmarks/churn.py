@@ -0,0 +1,135 @@
+"""Diffing a daily update with 1% churn: outer join and EXCEPT versus anti-joins.
+
+Needs a running PostGIS reachable with the settings in plenario/settings.py.
+Builds a synthetic point table and a staging table holding the next day's
+source, which drops --churn of the existing records and adds as many new
+ones. Then times the two steps of an incremental update both ways:
+
+* finding the new records to put in the n_ table, as the outer join
+  Update used to run and as the NOT EXISTS anti-join it runs now
+* deleting the records gone from the source, as the EXCEPT that
+  delete_absent_hashes used to run and as its NOT EXISTS anti-join
+
+Each run happens in a transaction that's rolled back, so every run starts
+from the same tables.
+
+    python -m benchmarks.churn [--rows N] [--churn F] [--repeat N] [--keep]
+"""
+
+import argparse
+import time
+
+from plenario.database import postgres_engine
+
+EXISTING = 'benchmark_churn'
+STAGING = 's_benchmark_churn'
+NEW = 'n_benchmark_churn'
+
+CREATE = '''
+CREATE TABLE "{existing}" (
+    hash VARCHAR(32) PRIMARY KEY,
+    description VARCHAR,
+    point_date TIMESTAMP,
+    geom GEOMETRY(POINT, 4326)
+);
+INSERT INTO "{existing}"
+SELECT md5(i::text),
+       (ARRAY['THEFT', 'BATTERY', 'NARCOTICS'])[i % 3 + 1],
+       timestamp '2017-01-01' + (i % 365) * interval '1 day',
+       ST_SetSRID(ST_MakePoint(-87.9 + random() * 0.4, 41.6 + random() * 0.5), 4326)
+FROM generate_series(1, {rows}) AS i;
+
+CREATE UNLOGGED TABLE "{staging}" (
+    hash VARCHAR(32) PRIMARY KEY,
+    description VARCHAR,
+    date TIMESTAMP,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION
+);
+-- The first {churned} records are gone from the source and {churned} new ones follow the rest.
+INSERT INTO "{staging}"
+SELECT md5(i::text),
+       (ARRAY['THEFT', 'BATTERY', 'NARCOTICS'])[i % 3 + 1],
+       timestamp '2017-01-01' + (i % 365) * interval '1 day',
+       41.6 + random() * 0.5,
+       -87.9 + random() * 0.4
+FROM generate_series({churned} + 1, {rows} + {churned}) AS i;
+
+CREATE UNLOGGED TABLE "{new}" (
+    hash VARCHAR(32) PRIMARY KEY,
+    point_date TIMESTAMP,
+    geom GEOMETRY(POINT, 4326)
+);
+ANALYZE "{existing}";
+ANALYZE "{staging}";
+'''
+
+NEW_RECORDS = {
+    'outer join': '''
+        INSERT INTO "{new}"
+        SELECT s.hash, s.date, ST_SetSRID(ST_MakePoint(s.longitude, s.latitude), 4326)
+        FROM "{staging}" AS s LEFT OUTER JOIN "{existing}" AS e ON s.hash = e.hash
+        WHERE e.hash IS NULL''',
+    'not exists': '''
+        INSERT INTO "{new}"
+        SELECT s.hash, s.date, ST_SetSRID(ST_MakePoint(s.longitude, s.latitude), 4326)
+        FROM "{staging}" AS s
+        WHERE NOT EXISTS (SELECT 1 FROM "{existing}" AS e WHERE e.hash = s.hash)''',
+}
+
+ABSENT_RECORDS = {
+    'except': '''
+        DELETE FROM "{existing}"
+        WHERE hash IN (SELECT hash FROM "{existing}" EXCEPT SELECT hash FROM "{staging}")''',
+    'not exists': '''
+        DELETE FROM "{existing}" AS e
+        WHERE NOT EXISTS (SELECT 1 FROM "{staging}" AS s WHERE s.hash = e.hash)''',
+}
+
+
+def drop():
+    for table in (EXISTING, STAGING, NEW):
+        postgres_engine.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+
+
+def time_statement(sql, repeat):
+    """Median seconds to run sql, and the rows it touched, rolling back each run."""
+    sql = sql.format(existing=EXISTING, staging=STAGING, new=NEW)
+    timings = []
+    for _ in range(repeat):
+        with postgres_engine.connect() as connection:
+            trans = connection.begin()
+            start = time.time()
+            rowcount = connection.execute(sql).rowcount
+            timings.append(time.time() - start)
+            trans.rollback()
+    timings.sort()
+    return timings[len(timings) // 2], rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--churn', type=float, default=0.01, help='fraction of records replaced')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--keep', action='store_true', help="don't drop the tables afterwards")
+    args = parser.parse_args()
+
+    drop()
+    churned = int(args.rows * args.churn)
+    postgres_engine.execute(CREATE.format(existing=EXISTING, staging=STAGING, new=NEW,
+                                          rows=args.rows, churned=churned))
+
+    try:
+        print('{:>12} {:>12} {:>10} {:>10}'.format('step', 'plan', 'ms', 'rows'))
+        for step, statements in (('new', NEW_RECORDS), ('absent', ABSENT_RECORDS)):
+            for plan, sql in sorted(statements.items()):
+                seconds, rowcount = time_statement(sql, args.repeat)
+                print('{:>12} {:>12} {:>10.1f} {:>10}'.format(step, plan, seconds * 1000, rowcount))
+    finally:
+        if not args.keep:
+            drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Compare column-at-a-time type inference with the single-pass inferencer.
+
+Each strategy runs in its own interpreter so that peak RSS is measured
+independently. Without a path, a synthetic CSV is generated first.
+
+    python -m benchmarks.inference [path] [--rows N] [--cols N]
+"""
+
+import argparse
+import csv
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def make_synthetic_csv(rows, cols):
+    """Write a CSV with a mix of the column types we usually see."""
+    makers = [
+        lambda i: str(i),
+        lambda i: '{:.6f}'.format(random.uniform(41.6, 42.1)),
+        lambda i: '2015-{:02d}-{:02d} {:02d}:00:00'.format(i % 12 + 1, i % 28 + 1, i % 24),
+        lambda i: random.choice(['true', 'false']),
+        lambda i: random.choice(['THEFT', 'BATTERY', 'NARCOTICS', '']),
+    ]
+    f = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+    writer = csv.writer(f)
+    writer.writerow(['col_{}'.format(c) for c in range(cols)])
+    for i in range(rows):
+        writer.writerow([makers[c % len(makers)](i) for c in range(cols)])
+    f.close()
+    return f.name
+
+
+def run(mode, path):
+    from plenario.utils.helpers import iter_column, iter_columns
+
+    with open(path, 'rt', encoding='utf-8') as f:
+        width = len(next(csv.reader(f)))
+        rows = sum(1 for _ in f)
+
+        start = time.time()
+        if mode == 'legacy':
+            result = [iter_column(i, f) for i in range(width)]
+        else:
+            result = iter_columns(f)
+        elapsed = time.time() - start
+
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'mode': mode,
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed if elapsed else None,
+        'peak_rss_mb': peak_rss / 1024.0,
+        'types': [str(t.__visit_name__) for t, _ in result],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--cols', type=int, default=40)
+    parser.add_argument('--mode', choices=['legacy', 'streaming'])
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.path)
+        return
+
+    path = args.path or make_synthetic_csv(args.rows, args.cols)
+    results = {}
+    for mode in ('legacy', 'streaming'):
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.inference', path, '--mode', mode])
+        results[mode] = json.loads(output.decode('utf-8').splitlines()[-1])
+
+    for mode, r in results.items():
+        print('{mode:>10}: {rows_per_second:>12,.0f} rows/s  '
+              '{peak_rss_mb:>8.1f} MB peak RSS'.format(**r))
+
+    if results['legacy']['types'] != results['streaming']['types']:
+        print('WARNING: inferred types differ between strategies')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Throughput of loading a CSV into a staging table with 1, 2, 4 and 8 workers.
+
+Needs a running Postgres (PostGIS not required) reachable with the settings
+in plenario/settings.py. Without a path, a synthetic CSV is generated, with
+some quoted newlines thrown in to exercise the record-boundary search.
+Each run loads into a fresh table, hashing and deduplicating on the way in,
+then builds the primary key, as Staging does.
+
+    python -m benchmarks.parallel_copy [path] [--rows N] [--workers 1 2 4 8]
+"""
+
+import argparse
+import csv
+import random
+import tempfile
+import time
+
+from plenario.database import postgres_engine
+from plenario.etl.common import DigestSet, copy_csv_parallel
+
+TABLE_NAME = 'benchmark_parallel_copy'
+
+
+def make_synthetic_csv(rows):
+    f = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='')
+    writer = csv.writer(f)
+    writer.writerow(['id', 'date', 'latitude', 'longitude', 'description'])
+    for i in range(rows):
+        description = random.choice(['THEFT', 'BATTERY', 'NARCOTICS', 'FROM BUILDING\nTO STREET', ''])
+        writer.writerow([i, '2015-{:02d}-{:02d} {:02d}:00:00'.format(i % 12 + 1, i % 28 + 1, i % 24),
+                         '{:.6f}'.format(random.uniform(41.6, 42.1)),
+                         '{:.6f}'.format(random.uniform(-87.9, -87.5)),
+                         description])
+    f.close()
+    return f.name
+
+
+def load(path, width, workers):
+    cols = ', '.join('c{} TEXT'.format(i) for i in range(width))
+    postgres_engine.execute('DROP TABLE IF EXISTS {t}; CREATE TABLE {t} ({cols}, hash VARCHAR(32))'.
+                            format(t=TABLE_NAME, cols=cols))
+    names = ', '.join('c{}'.format(i) for i in range(width))
+    copy_st = "COPY {} ({}, hash) FROM STDIN WITH (FORMAT CSV, HEADER FALSE, DELIMITER ',')".\
+        format(TABLE_NAME, names)
+
+    start = time.time()
+    with DigestSet() as digests:
+        copy_csv_parallel(path, copy_st, digests, workers)
+    postgres_engine.execute('ALTER TABLE {} ADD PRIMARY KEY (hash)'.format(TABLE_NAME))
+    elapsed = time.time() - start
+
+    rows = postgres_engine.execute('SELECT count(*) FROM {}'.format(TABLE_NAME)).scalar()
+    return rows, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    path = args.path or make_synthetic_csv(args.rows)
+    with open(path, 'rt', encoding='utf-8') as f:
+        width = len(next(csv.reader(f)))
+
+    try:
+        baseline = None
+        for workers in args.workers:
+            rows, elapsed = load(path, width, workers)
+            baseline = baseline or elapsed
+            print('{:>3} workers: {:>12,.0f} rows/s  {:>8.2f} s  {:>5.2f}x'.format(
+                workers, rows / elapsed, elapsed, baseline / elapsed))
+    finally:
+        postgres_engine.execute('DROP TABLE IF EXISTS {}'.format(TABLE_NAME))
+
+
+if __name__ == '__main__':
+    main()
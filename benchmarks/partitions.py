@@ -0,0 +1,116 @@
+"""Query latency on a monolithic point table versus one partitioned by month.
+
+Needs a running PostGIS reachable with the settings in plenario/settings.py.
+Builds a synthetic ten year point dataset twice, once as a single table and
+once split with plenario.etl.partition, then times the kinds of queries the
+API issues: a 90 day /detail page, a 90 day weekly /timeseries count and a
+90 day /grid-style count, each over the most recent window and one in the
+middle of the range.
+
+    python -m benchmarks.partitions [--rows N] [--repeat N] [--keep]
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from plenario.database import postgres_engine
+from plenario.etl.partition import create_partition, drop_point_table
+
+MONOLITHIC = 'benchmark_points'
+PARTITIONED = 'benchmark_points_by_month'
+START = datetime(2007, 1, 1)
+YEARS = 10
+
+CREATE = '''
+CREATE TABLE "{t}" (
+    hash VARCHAR(32) PRIMARY KEY,
+    description VARCHAR,
+    point_date TIMESTAMP,
+    geom GEOMETRY(POINT, 4326)
+);
+CREATE INDEX "ix_{t}_point_date" ON "{t}" (point_date);
+CREATE INDEX "ix_{t}_geom" ON "{t}" USING GIST (geom);
+'''
+
+ROWS = '''
+SELECT md5(i::text),
+       (ARRAY['THEFT', 'BATTERY', 'NARCOTICS'])[i % 3 + 1],
+       timestamp '{start}' + (random() * {days}) * interval '1 day',
+       ST_SetSRID(ST_MakePoint(-87.9 + random() * 0.4, 41.6 + random() * 0.5), 4326)
+FROM generate_series(1, {rows}) AS i
+'''
+
+QUERIES = {
+    'detail': 'SELECT * FROM "{t}" WHERE point_date >= %(lo)s AND point_date <= %(hi)s '
+              'ORDER BY point_date DESC LIMIT 1000',
+    'timeseries': "SELECT date_trunc('week', point_date) AS t, count(*) FROM \"{t}\" "
+                  'WHERE point_date >= %(lo)s AND point_date <= %(hi)s GROUP BY t',
+    'grid': 'SELECT count(*) FROM "{t}" WHERE point_date >= %(lo)s AND point_date <= %(hi)s '
+            'AND ST_Intersects(geom, ST_MakeEnvelope(-87.7, 41.8, -87.6, 41.9, 4326))',
+}
+
+
+def build(rows):
+    days = (START.replace(year=START.year + YEARS) - START).days
+    rows_sql = ROWS.format(start=START, days=days, rows=rows)
+
+    drop_point_table(MONOLITHIC)
+    postgres_engine.execute(CREATE.format(t=MONOLITHIC))
+    postgres_engine.execute('INSERT INTO "{}" {}'.format(MONOLITHIC, rows_sql))
+
+    drop_point_table(PARTITIONED)
+    postgres_engine.execute(CREATE.format(t=PARTITIONED))
+    for year in range(START.year, START.year + YEARS):
+        for month in range(1, 13):
+            child = create_partition(PARTITIONED, 'month', datetime(year, month, 1))
+            postgres_engine.execute(
+                'INSERT INTO "{child}" SELECT * FROM "{src}" '
+                "WHERE date_trunc('month', point_date) = '{year}-{month:02d}-01'".
+                format(child=child, src=MONOLITHIC, year=year, month=month))
+
+    # Picks up the partitions too.
+    postgres_engine.execute('ANALYZE')
+
+
+def time_query(sql, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        postgres_engine.execute(sql, params).fetchall()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help="don't drop the tables afterwards")
+    args = parser.parse_args()
+
+    build(args.rows)
+    end = START.replace(year=START.year + YEARS)
+    windows = {
+        'latest': (end - timedelta(days=90), end),
+        'middle': (START + timedelta(days=365 * 5), START + timedelta(days=365 * 5 + 90)),
+    }
+
+    try:
+        print('{:>12} {:>8} {:>14} {:>14} {:>8}'.format('query', 'window', 'monolithic ms', 'partitioned ms', 'speedup'))
+        for name, sql in sorted(QUERIES.items()):
+            for window, (lo, hi) in sorted(windows.items()):
+                params = {'lo': lo, 'hi': hi}
+                mono = time_query(sql.format(t=MONOLITHIC), params, args.repeat)
+                part = time_query(sql.format(t=PARTITIONED), params, args.repeat)
+                print('{:>12} {:>8} {:>14.1f} {:>14.1f} {:>7.2f}x'.format(
+                    name, window, mono * 1000, part * 1000, mono / part))
+    finally:
+        if not args.keep:
+            drop_point_table(MONOLITHIC)
+            drop_point_table(PARTITIONED)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Timeseries over the point table versus over its daily counts.
+
+Needs a running PostGIS reachable with the settings in plenario/settings.py.
+Builds a synthetic ten year point dataset, counts it into etl_daily_count with
+DailyCount.rebuild, then times the counts /timeseries asks for by week, month,
+quarter and year over the whole range, both from the point table and from the
+daily counts.
+
+    python -m benchmarks.rollups [--rows N] [--repeat N] [--keep]
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+from plenario.database import postgres_engine
+from plenario.models.DailyCount import DailyCount
+
+TABLE = 'benchmark_rollups'
+START = datetime(2007, 1, 1)
+END = datetime(2017, 1, 1)
+
+CREATE = '''
+CREATE TABLE "{t}" (
+    hash VARCHAR(32) PRIMARY KEY,
+    point_date TIMESTAMP,
+    geom GEOMETRY(POINT, 4326)
+);
+INSERT INTO "{t}"
+SELECT md5(i::text),
+       timestamp '{start}' + (random() * {days}) * interval '1 day',
+       ST_SetSRID(ST_MakePoint(-87.9 + random() * 0.4, 41.6 + random() * 0.5), 4326)
+FROM generate_series(1, {rows}) AS i;
+CREATE INDEX "ix_{t}_point_date" ON "{t}" (point_date);
+ANALYZE "{t}";
+'''
+
+QUERIES = {
+    'point table': 'SELECT date_trunc(%(agg)s, point_date) AS t, count(hash) FROM "{t}" '
+                   'WHERE point_date >= %(lo)s AND point_date <= %(hi)s GROUP BY t',
+    'daily counts': 'SELECT date_trunc(%(agg)s, day::timestamp) AS t, sum(count) FROM etl_daily_count '
+                    'WHERE dataset_name = %(name)s AND day >= %(lo)s AND day < %(hi)s GROUP BY t',
+}
+
+
+def drop():
+    postgres_engine.execute('DROP TABLE IF EXISTS "{}"'.format(TABLE))
+    DailyCount.clear(TABLE)
+
+
+def time_query(sql, params, repeat):
+    """Median seconds to run sql."""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        postgres_engine.execute(sql.format(t=TABLE), params).fetchall()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help="don't drop the tables afterwards")
+    args = parser.parse_args()
+
+    drop()
+    postgres_engine.execute(CREATE.format(t=TABLE, start=START, days=(END - START).days, rows=args.rows))
+    start = time.time()
+    with postgres_engine.begin() as connection:
+        DailyCount.rebuild(connection, TABLE, TABLE)
+    print('Counted {} rows by day in {:.1f} ms'.format(args.rows, (time.time() - start) * 1000))
+
+    try:
+        print('{:>8} {:>14} {:>10}'.format('agg', 'source', 'ms'))
+        for agg in ('week', 'month', 'quarter', 'year'):
+            params = {'agg': agg, 'lo': START, 'hi': END, 'name': TABLE}
+            for source, sql in sorted(QUERIES.items()):
+                seconds = time_query(sql, params, args.repeat)
+                print('{:>8} {:>14} {:>10.1f}'.format(agg, source, seconds * 1000))
+    finally:
+        if not args.keep:
+            drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Micro-benchmark of date/time classification over the fixture CSVs.
+
+Every distinct cell of every CSV in tests/fixtures is classified both with
+dateutil alone and with temporal_type (fast path first, dateutil only as a
+fallback). Reports values/s for each, the share of values settled by the
+fast path, and any disagreement between the two.
+
+    python -m benchmarks.temporal [--repeat N]
+"""
+
+import argparse
+import csv
+import glob
+import os
+import time
+
+from dateutil.parser import parse
+
+from plenario.utils.typeinference import DEFAULT_DATETIME, _classify, fast_temporal_type, temporal_type
+
+fixtures_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../tests/fixtures')
+
+
+def dateutil_only(x):
+    return _classify(parse(x, default=DEFAULT_DATETIME))
+
+
+def classify_all(classifier, values):
+    results = []
+    for x in values:
+        try:
+            results.append(classifier(x))
+        except (ValueError, TypeError, OverflowError):
+            results.append(None)
+    return results
+
+
+def fixture_values():
+    values = []
+    for path in sorted(glob.glob(os.path.join(fixtures_path, '*.csv'))):
+        with open(path, encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                values.extend(x for x in row if x.strip())
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    values = fixture_values() * args.repeat
+    fast_hits = sum(1 for x in values if fast_temporal_type(x) is not None)
+
+    timings = {}
+    results = {}
+    for name, classifier in (('dateutil', dateutil_only), ('fast path', temporal_type)):
+        start = time.time()
+        results[name] = classify_all(classifier, values)
+        timings[name] = time.time() - start
+
+    for name, elapsed in timings.items():
+        print('{:>10}: {:>12,.0f} values/s'.format(name, len(values) / elapsed))
+    print('{:>10}: {:.1%} of {:,} values'.format('fast hits', fast_hits / len(values), len(values)))
+
+    mismatches = sum(1 for a, b in zip(results['dateutil'], results['fast path']) if a != b)
+    if mismatches:
+        print('WARNING: {} values classified differently'.format(mismatches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""WAL written per ingested row, with logged versus UNLOGGED scratch tables.
+
+Needs a running PostGIS reachable with the settings in plenario/settings.py,
+and a user allowed to read the current WAL position. Each mode runs in its
+own interpreter, since ETL_UNLOGGED_SCRATCH is read at import. A synthetic
+point CSV is staged and turned into a point table with Staging and Creation,
+as a first-time add does. Nothing else should be writing to the database
+while this runs.
+
+    python -m benchmarks.wal [path] [--rows N]
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+DATASET_NAME = 'benchmark_wal_points'
+
+
+def make_synthetic_csv(rows):
+    f = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='')
+    writer = csv.writer(f)
+    writer.writerow(['id', 'date', 'latitude', 'longitude', 'description'])
+    for i in range(rows):
+        writer.writerow([i, '2015-{:02d}-{:02d} {:02d}:00:00'.format(i % 12 + 1, i % 28 + 1, i % 24),
+                         '{:.6f}'.format(random.uniform(41.6, 42.1)),
+                         '{:.6f}'.format(random.uniform(-87.9, -87.5)),
+                         random.choice(['THEFT', 'BATTERY', 'NARCOTICS'])])
+    f.close()
+    return f.name
+
+
+def wal_position(engine):
+    if int(engine.execute('SHOW server_version_num').scalar()) >= 100000:
+        return engine.execute('SELECT pg_current_wal_lsn()').scalar(), 'pg_wal_lsn_diff'
+    return engine.execute('SELECT pg_current_xlog_location()').scalar(), 'pg_xlog_location_diff'
+
+
+def run(path):
+    from plenario.database import postgres_engine
+    from plenario.etl.partition import drop_point_table
+    from plenario.etl.point import Creation, Staging
+    from plenario.models import MetaTable
+    from plenario.settings import ETL_UNLOGGED_SCRATCH
+
+    meta = MetaTable(url='benchmark.plenar.io/{}.csv'.format(DATASET_NAME),
+                     human_name='Benchmark WAL Points', dataset_name=DATASET_NAME,
+                     observed_date='date', latitude='latitude', longitude='longitude')
+    drop_point_table(DATASET_NAME)
+
+    start, diff = wal_position(postgres_engine)
+    with Staging(meta, source_path=path) as s_table:
+        table = Creation(s_table.table, meta.meta_tuple()).table
+    end, _ = wal_position(postgres_engine)
+
+    wal_bytes = postgres_engine.execute('SELECT {}(%s, %s)'.format(diff), (end, start)).scalar()
+    rows = postgres_engine.execute(table.count()).scalar()
+    drop_point_table(DATASET_NAME)
+    print(json.dumps({
+        'unlogged': ETL_UNLOGGED_SCRATCH,
+        'rows': rows,
+        'wal_bytes': float(wal_bytes),
+        'wal_bytes_per_row': float(wal_bytes) / rows,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.path)
+        return
+
+    path = args.path or make_synthetic_csv(args.rows)
+    results = {}
+    for unlogged in ('false', 'true'):
+        env = dict(os.environ, ETL_UNLOGGED_SCRATCH=unlogged)
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.wal', path, '--run'], env=env)
+        results[unlogged] = json.loads(output.decode('utf-8').splitlines()[-1])
+
+    for label, key in (('logged', 'false'), ('unlogged', 'true')):
+        r = results[key]
+        print('{:>10}: {:>10,.0f} WAL bytes/row  {:>14,.0f} WAL bytes total'.format(
+            label, r['wal_bytes_per_row'], r['wal_bytes']))
+
+
+if __name__ == '__main__':
+    main()
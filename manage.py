@@ -142,6 +142,8 @@ def init():
 
     logger.debug('[plenario] Creating metadata tables')
     postgres_base.metadata.create_all()
+    # Bring metadata tables created by earlier versions up to date
+    psql('./plenario/dbscripts/meta_columns.sql')
 
     logger.debug('[plenario] Creating weather tables')
     WeatherStationsETL().make_station_table()
@@ -7,7 +7,8 @@ from plenario.sensor_network.api.ifttt import get_ifttt_meta, get_ifttt_observat
 from plenario.sensor_network.api.sensor_networks import check, get_aggregations, get_feature_metadata, \
     get_network_map, get_network_metadata, get_node_download, get_node_metadata, get_observation_nearest, \
     get_observations, get_observations_download, get_sensor_metadata
-from .common import cache, make_cache_key
+from .caching import cache_stats, cached
+from .common import cache
 from .point import datadump_view, dataset_fields, detail, detail_aggregate, get_job_view, grid, meta
 from .sensor import weather, weather_fill, weather_stations
 from .shape import aggregate_point_data, export_shape, get_all_shape_datasets
@@ -75,8 +76,15 @@ def flush_cache():
     return resp
 
 
+@api.route('{}{}'.format(prefix, '/cache-stats'))
+def get_cache_stats():
+    resp = make_response(json.dumps({'status': 'ok', 'objects': cache_stats()}))
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
 @api.route('{}{}'.format(prefix, '/slow'))
-@cache.cached(timeout=60 * 60 * 6, key_prefix=make_cache_key)
+@cached(timeout=60 * 60 * 6)
 def slow():
     sleep(5)
     return 'I feel well rested'
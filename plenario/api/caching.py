@@ -0,0 +1,429 @@
+"""
+Caching of API responses in the shared (Redis) cache.
+
+Every worker has to arrive at the same key for the same query, so keys are
+built from a canonical form of the request rather than anything that varies
+by process: arguments sorted by name, arguments left at their endpoint's
+default dropped, dates and JSON (condition trees, GeoJSON) written out one
+way, and the lot hashed with sha1.
+
+Equivalent queries share a response, so the query a response echoes back
+in its metadata is the one that was asked first.
+
+Responses are stored along with the versions of the datasets they were
+computed from (see plenario.utils.versions), which the ETL tasks bump, so a
+response stops being served as soon as its data changes rather than when
+its TTL runs out. That lets queries that end in the past, whose responses
+only change with their data, be kept for much longer.
+
+A response missing from the cache is only computed by one worker at a time,
+see single_flight, so an expired popular query doesn't run once for every
+request that arrives while it's being computed. Views with a soft timeout
+serve responses past it as they are and recompute them in the background,
+see refresh, so queries asked for often enough are never computed while
+someone waits.
+
+A sample of the queries is logged with their costs (see
+plenario.utils.query_log), so that the most expensive of them can be put
+back in the cache right after an ETL update expires them.
+"""
+
+import json
+import logging
+import pickle
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from functools import wraps
+from hashlib import sha1
+from urllib.parse import urlencode
+from uuid import uuid4
+
+from dateutil import parser
+from flask import current_app, request
+from redis import Redis
+
+from plenario.api.common import CACHE_TIMEOUT, HISTORICAL_CACHE_TIMEOUT, cache
+from plenario.settings import CACHE_CONFIG, REDIS_HOST
+from plenario.utils.query_log import REPLAY_HEADER, log_cost, log_query
+from plenario.utils.versions import ALL, get_versions
+
+logger = logging.getLogger(__name__)
+
+redis = Redis(REDIS_HOST)
+
+# Seconds a worker may hold the lock on computing a response, in case it dies holding it.
+COALESCE_LEASE = 120
+# Seconds to wait on a response being computed elsewhere before computing it too.
+COALESCE_TIMEOUT = 30
+# Seconds between looks at the cache while another worker computes a response.
+COALESCE_POLL = 0.1
+
+# Deletes a lock only if it's still held with the given token, not after its lease ran out.
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Threads recomputing responses served past their soft timeout.
+REFRESH_WORKERS = 4
+
+COUNTERS = ('hits', 'stale', 'misses', 'coalesced')
+
+# Arguments each endpoint fills in when they're left out, as strings.
+# Only endpoints whose validators apply these defaults are listed,
+# since elsewhere the same argument can mean something else or nothing.
+ARG_DEFAULTS = {
+    'timeseries': {'agg': 'week', 'data_type': 'json'},
+    'detail': {'data_type': 'json', 'offset': '0', 'limit': '1000', 'job': 'false',
+               'date__time_of_day_ge': '0', 'date__time_of_day_le': '23'},
+    'detail-aggregate': {'agg': 'week', 'data_type': 'json', 'job': 'false'},
+    'grid': {'resolution': '500', 'buffer': '100'},
+    'point_fields': {'job': 'false'},
+    'meta': {'job': 'false'},
+    'node_aggregate': {'agg': 'hour', 'function': 'avg'},
+}
+
+# Endpoints whose responses depend on point datasets, named by their arguments.
+POINT_VIEWS = {'timeseries', 'detail', 'detail-aggregate', 'grid', 'point_fields', 'meta'}
+# Endpoints whose responses depend on data of a kind as a whole.
+KIND_VIEWS = {'weather': 'weather', 'weather_stations': 'weather', 'node_aggregate': 'network'}
+
+DATE_ARGS = {'obs_date__ge', 'obs_date__le', 'start_datetime', 'end_datetime', 'since', 'datetime'}
+JSON_ARGS = {'location_geom__within', 'geom', 'filter'}
+# Condition trees on a dataset come as <dataset name>__filter, and are JSON too.
+FILTER_SUFFIX = '__filter'
+
+# Names of the views behind cached(), to report counters for.
+_cached_views = set()
+
+# {key: Future} of the responses being computed by this process.
+_flights = {}
+_flights_lock = threading.Lock()
+# Keys of the responses being refreshed by this process.
+_refreshing = set()
+_refresh_pool = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+
+
+def canonical_args(args, defaults=None):
+    """
+    :param args: (name, [values]) pairs, as MultiDict.lists() gives them
+    :param defaults: {name: value} of arguments to leave out when they're set to it
+    :return: sorted [(name, [values])] in canonical form
+    """
+    defaults = defaults or {}
+    canonical = []
+    for name, values in args:
+        values = [_canonical_value(name, v.strip()) for v in values]
+        if values == [defaults.get(name)]:
+            continue
+        # Only the first value of a repeated argument is used, so keep them in order.
+        canonical.append((name, values))
+    return sorted(canonical)
+
+
+def canonical_key(path, args, defaults=None):
+    """Cache key of the response to a query of path with args, see canonical_args."""
+    digest = sha1(json.dumps(canonical_args(args, defaults)).encode('utf-8')).hexdigest()
+    return 'view:{}:{}'.format(path, digest)
+
+
+def canonical_query(path, args, defaults=None):
+    """Path and query string of a query of path with args in canonical form, which has the same cache key."""
+    pairs = [(name, value) for name, values in canonical_args(args, defaults) for value in values]
+    return path + ('?' + urlencode(pairs) if pairs else '')
+
+
+def make_cache_key():
+    """Cache key of the response to the current request."""
+    return canonical_key(request.path, request.args.lists(), ARG_DEFAULTS.get(_endpoint()))
+
+
+def dependencies(endpoint, args, view_args=None):
+    """
+    :param endpoint: name of the view, as in ARG_DEFAULTS
+    :param args: {name: value} of the query
+    :param view_args: {name: value} of the path parameters
+    :return: sorted [(kind, name)] of the data the response is computed from,
+             see plenario.utils.versions
+    """
+    if endpoint in KIND_VIEWS:
+        return [(KIND_VIEWS[endpoint], ALL)]
+    if endpoint not in POINT_VIEWS:
+        return []
+
+    args = dict(args, **(view_args or {}))
+    shape = args.get('shape')
+    points = set(filter(None, args.get('dataset_name__in', '').split(',')))
+    points.update(name[:-len(FILTER_SUFFIX)] for name in args if name.endswith(FILTER_SUFFIX))
+    points.add(args.get('dataset_name'))
+    points.discard(shape)
+    points.discard(None)
+    points.discard('')
+
+    deps = {('point', name) for name in points} or {('point', ALL)}
+    if shape:
+        deps.add(('shape', shape))
+    return sorted(deps)
+
+
+def is_historical(args, now=None):
+    """:return: whether the query explicitly ends before today, so its data is done changing but for ETL updates"""
+    end = args.get('obs_date__le')
+    if not end:
+        return False
+    try:
+        end = parser.parse(end)
+    except (ValueError, OverflowError):
+        return False
+    now = now or datetime.now()
+    return end.replace(tzinfo=None) < now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def cached(timeout=CACHE_TIMEOUT, soft_timeout=None, historical_timeout=HISTORICAL_CACHE_TIMEOUT):
+    """
+    Decorator that caches a view's responses under canonical keys, counting
+    hits and misses. Like cache.cached, the view runs uncached if the cache
+    can't be reached.
+
+    :param timeout: seconds to keep a response for
+    :param soft_timeout: seconds after which a response is still served, but
+                         recomputed in the background for the next request
+    :param historical_timeout: seconds to keep a response for when the view's
+                               data is versioned and the query ends in the past,
+                               with no soft timeout
+    """
+    def decorator(f):
+        _cached_views.add(f.__name__)
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            try:
+                key = make_cache_key()
+                deps = dependencies(_endpoint(), request.args.to_dict(), request.view_args)
+                versions = get_versions(deps)
+                entry = _fresh(key, versions)
+                query = canonical_query(request.path, request.args.lists(), ARG_DEFAULTS.get(_endpoint()))
+                if not request.headers.get(REPLAY_HEADER):
+                    log_query(query, deps)
+            except Exception:
+                if current_app.debug:
+                    raise
+                logger.exception('Exception possibly due to cache backend.')
+                return f(*args, **kwargs)
+
+            historical = bool(deps) and is_historical(request.args)
+            ttl = historical_timeout if historical else timeout
+
+            def compute():
+                start = time.time()
+                rv = f(*args, **kwargs)
+                seconds = time.time() - start
+                try:
+                    cache.set(key, {'versions': versions, 'value': rv, 'time': time.time()}, timeout=ttl)
+                    log_cost(query, deps, seconds)
+                except Exception:
+                    if current_app.debug:
+                        raise
+                    logger.exception('Exception possibly due to cache backend.')
+                return rv
+
+            if entry is not None:
+                if soft_timeout and not historical and time.time() - entry.get('time', 0) > soft_timeout:
+                    _count(f.__name__, 'stale')
+                    refresh(key, compute)
+                else:
+                    _count(f.__name__, 'hits')
+                return entry['value']
+
+            _count(f.__name__, 'misses')
+            return single_flight(key, versions, compute, on_shared=lambda: _count(f.__name__, 'coalesced'))
+
+        decorated_function.uncached = f
+        return decorated_function
+    return decorator
+
+
+def single_flight(key, versions, compute, on_shared=None):
+    """
+    Compute the response for key in one place at a time. Threads of this
+    process asking for a key that's being computed wait on that computation,
+    and a Redis lock with a lease makes other processes wait for the response
+    to show up in the cache. A waiter gives up and runs compute itself after
+    COALESCE_TIMEOUT, or as soon as the computation it waited on failed.
+
+    :param versions: of the data behind the response, see cached
+    :param compute: runs the view and caches its response
+    :param on_shared: called when a response computed elsewhere is used
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Future()
+
+    if not leader:
+        try:
+            # Every waiter gets its own copy, as after_request handlers change responses in place.
+            rv = pickle.loads(flight.result(timeout=COALESCE_TIMEOUT))
+        except Exception:
+            logger.warning('Gave up waiting on another thread for {}.'.format(key))
+            return compute()
+        if on_shared:
+            on_shared()
+        return rv
+
+    try:
+        rv = _lead(key, versions, compute, on_shared)
+    except BaseException as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+
+    try:
+        flight.set_result(pickle.dumps(rv))
+    except Exception as e:
+        flight.set_exception(e)
+    return rv
+
+
+def refresh(key, compute):
+    """
+    Recompute the response for key on a thread of the refresh pool, in a copy
+    of the current request's context, unless it's already being computed
+    here or under its lock elsewhere.
+    """
+    with _flights_lock:
+        if key in _refreshing or key in _flights:
+            return
+        _refreshing.add(key)
+
+    app = current_app._get_current_object()
+    environ = request.environ.copy()
+
+    def run():
+        try:
+            with app.request_context(environ):
+                try:
+                    lock, token = _acquire(key)
+                except Exception:
+                    logger.exception('Failed to lock {}.'.format(key))
+                    compute()
+                    return
+                if token is None:
+                    return
+                try:
+                    compute()
+                finally:
+                    _release(lock, token)
+        except Exception:
+            logger.exception('Failed to refresh {}.'.format(key))
+        finally:
+            with _flights_lock:
+                _refreshing.discard(key)
+
+    try:
+        _refresh_pool.submit(run)
+    except Exception:
+        logger.exception('Failed to queue a refresh of {}.'.format(key))
+        with _flights_lock:
+            _refreshing.discard(key)
+
+
+def cache_stats():
+    """
+    :return: {view name: {counter: n}} of hits, stale hits, misses and
+             coalesced misses since the counters were last cleared
+    """
+    views = sorted(_cached_views)
+    counts = cache.get_many(*['stats:{}:{}'.format(v, c) for v in views for c in COUNTERS])
+    counts = iter(counts)
+    return {v: {c: next(counts) or 0 for c in COUNTERS} for v in views}
+
+
+def _lead(key, versions, compute, on_shared):
+    """Compute under the Redis lock of key, or wait for whoever holds it to cache the response."""
+    try:
+        lock, token = _acquire(key)
+    except Exception:
+        logger.exception('Failed to lock {}.'.format(key))
+        return compute()
+
+    if token is not None:
+        try:
+            return compute()
+        finally:
+            _release(lock, token)
+
+    deadline = time.time() + COALESCE_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(COALESCE_POLL)
+        try:
+            entry = _fresh(key, versions)
+            if entry is not None:
+                if on_shared:
+                    on_shared()
+                return entry['value']
+            if not redis.exists(lock):
+                # The holder failed, or couldn't cache what it computed.
+                break
+        except Exception:
+            logger.exception('Exception possibly due to cache backend.')
+            break
+    logger.warning('Gave up waiting on another worker for {}.'.format(key))
+    return compute()
+
+
+def _acquire(key):
+    """:return: (lock, token) with the token to release the lock of key with, None if it's held elsewhere"""
+    lock = '{}lock:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'], key)
+    token = uuid4().hex
+    if redis.set(lock, token, nx=True, px=COALESCE_LEASE * 1000):
+        return lock, token
+    return lock, None
+
+
+def _release(lock, token):
+    try:
+        redis.eval(RELEASE, 1, lock, token)
+    except Exception:
+        logger.exception('Failed to unlock {}, it will expire.'.format(lock))
+
+
+def _fresh(key, versions):
+    """:return: the cache entry for key if it was computed from the given versions of its data"""
+    entry = cache.get(key)
+    # Entries from before their data changed are as good as missing.
+    if entry is not None and entry['versions'] == versions:
+        return entry
+    return None
+
+
+def _endpoint():
+    return (request.endpoint or '').rsplit('.', 1)[-1]
+
+
+def _count(view, counter):
+    try:
+        cache.cache.inc('stats:{}:{}'.format(view, counter))
+    except Exception:
+        logger.exception('Failed to count a cache {} of {}.'.format(counter, view))
+
+
+def _canonical_value(name, value):
+    if name in DATE_ARGS:
+        try:
+            return parser.parse(value).isoformat()
+        except (ValueError, OverflowError):
+            return value
+    if name in JSON_ARGS or name.endswith(FILTER_SUFFIX):
+        try:
+            return json.dumps(json.loads(value), sort_keys=True, separators=(',', ':'))
+        except ValueError:
+            return value
+    return value
@@ -21,6 +21,10 @@ cache = Cache(config=CACHE_CONFIG)
 
 RESPONSE_LIMIT = 1000
 CACHE_TIMEOUT = 60 * 60 * 6
+# For responses served while they're recomputed past it, see plenario.api.caching
+SOFT_CACHE_TIMEOUT = 60 * 60
+# For responses that are dropped when their data changes, see plenario.api.caching
+HISTORICAL_CACHE_TIMEOUT = 60 * 60 * 24 * 7
 
 
 def unknown_object_json_handler(obj):
@@ -103,12 +107,6 @@ def crossdomain(origin=None, methods=None, headers=None,
     return decorator
 
 
-def make_cache_key(*args, **kwargs):
-    path = request.path
-    args = str(hash(frozenset(list(request.args.items()))))
-    return path + args
-
-
 def make_csv(data):
     logger.info(('data.type: {}'.format(type(data))))
     logger.info(('data.firstrow: {}'.format(data[0])))
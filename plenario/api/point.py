@@ -15,14 +15,16 @@ from datetime import datetime, timedelta
 from dateutil import parser
 from flask import Response, jsonify, request, stream_with_context
 
-from plenario.api.common import CACHE_TIMEOUT, cache, crossdomain, make_cache_key, unknown_object_json_handler
+from plenario.api.caching import cached
+from plenario.api.common import SOFT_CACHE_TIMEOUT, crossdomain, unknown_object_json_handler
 from plenario.api.condition_builder import parse_tree
 from plenario.api.jobs import get_job, make_job_response
 from plenario.api.validator import DatasetRequiredValidator, NoDefaultDatesValidator, \
     NoGeoJSONDatasetRequiredValidator, NoGeoJSONValidator, has_tree_filters, validate, \
     PointsetRequiredValidator
 from plenario.database import postgres_session
-from plenario.models import MetaTable
+from plenario.models import IngestBatch, IngestChange, MetaTable
+from plenario.utils.cells import record_columns
 from . import response as api_response
 
 
@@ -37,7 +39,7 @@ def get_job_view(ticket):
     return jsonify(get_job(ticket))
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached(soft_timeout=SOFT_CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def detail_aggregate():
     fields = ('location_geom__within', 'dataset_name', 'agg', 'obs_date__ge',
@@ -55,30 +57,40 @@ def detail_aggregate():
         return api_response.detail_aggregate_response(time_counts, validator_result)
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached()
 @crossdomain(origin='*')
 def detail():
     fields = ('location_geom__within', 'dataset_name', 'shape', 'obs_date__ge',
               'obs_date__le', 'data_type', 'offset', 'date__time_of_day_ge',
-              'date__time_of_day_le', 'limit', 'job')
+              'date__time_of_day_le', 'limit', 'job', 'since', 'since_batch')
     validator = DatasetRequiredValidator(only=fields)
     validator_result = validate(validator, request.args.to_dict())
 
     if validator_result.errors:
         return api_response.bad_request(validator_result.errors)
 
+    try:
+        since_batch = resolve_since(validator_result.data)
+    except ValueError as e:
+        return api_response.bad_request(str(e))
+
     if validator_result.data.get('job'):
         return make_job_response('detail', validator_result)
     else:
         result_rows = _detail(validator_result)
-        return api_response.detail_response(result_rows, validator_result)
+        if since_batch is None:
+            return api_response.detail_response(result_rows, validator_result)
+        data = validator_result.data
+        return api_response.detail_delta_response(
+            result_rows, validator_result, data['until_batch'],
+            removed_since(data['dataset'], since_batch, data['until_batch']))
 
 
 @crossdomain(origin='*')
 def datadump_view():
     fields = ('location_geom__within', 'dataset_name', 'shape', 'obs_date__ge',
               'obs_date__le', 'offset', 'date__time_of_day_ge',
-              'date__time_of_day_le', 'limit', 'job', 'data_type')
+              'date__time_of_day_le', 'limit', 'job', 'data_type', 'since', 'since_batch')
 
     validator = DatasetRequiredValidator(only=fields)
     validator_result = validate(validator, request.args.to_dict())
@@ -86,6 +98,11 @@ def datadump_view():
     if validator_result.errors:
         return api_response.error(validator_result.errors, 400)
 
+    try:
+        since_batch = resolve_since(validator_result.data)
+    except ValueError as e:
+        return api_response.error(str(e), 400)
+
     stream = datadump(**validator_result.data)
 
     dataset = validator_result.data['dataset'].name
@@ -94,10 +111,12 @@ def datadump_view():
 
     attachment = Response(stream_with_context(stream), mimetype='text/%s' % fmt)
     attachment.headers['Content-Disposition'] = content_disposition
+    if since_batch is not None:
+        attachment.headers['X-Plenario-Batch'] = str(validator_result.data['until_batch'])
     return attachment
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached()
 @crossdomain(origin='*')
 def grid():
 
@@ -124,7 +143,7 @@ def grid():
     return jsonify(results)
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached()
 @crossdomain(origin='*')
 def dataset_fields(dataset_name):
     request_args = request.args.to_dict()
@@ -143,7 +162,7 @@ def dataset_fields(dataset_name):
         return api_response.fields_response(result_data, validator_result)
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached(soft_timeout=SOFT_CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def meta():
     fields = ('obs_date__le', 'obs_date__ge', 'dataset_name', 'location_geom__within', 'job')
@@ -253,7 +272,8 @@ def datadump_json(**kwargs):
     vr_proxy.data = kwargs
 
     dataset = kwargs['dataset']
-    columns = [c.name for c in dataset.c]
+    since_batch, until_batch = kwargs.get('since_batch'), kwargs.get('until_batch')
+    columns = [c.name for c in record_columns(dataset.c)]
     query = detail_query(vr_proxy)
 
     buffer = ''
@@ -275,7 +295,8 @@ def datadump_json(**kwargs):
             'properties': dict(zip(columns, row))
         }
         del geojson['properties']['geom']
-        del geojson['properties']['hash']
+        if since_batch is None:
+            del geojson['properties']['hash']
 
         buffer += json.dumps(geojson, default=unknown_object_json_handler)
         buffer += ','
@@ -285,7 +306,12 @@ def datadump_json(**kwargs):
             buffer = ''
 
     # Remove the trailing comma and close the json
-    yield buffer.rsplit(',', 1)[0] + ']}'
+    buffer = buffer.rsplit(',', 1)[0] + ']'
+    if since_batch is not None:
+        # Hashes of records removed since, to match up with earlier downloads.
+        buffer += ', "batch": {}, "removed": {}'.format(
+            until_batch, json.dumps(removed_since(dataset, since_batch, until_batch)))
+    yield buffer + '}'
 
 
 def datadump_csv(**kwargs):
@@ -300,19 +326,24 @@ def datadump_csv(**kwargs):
     vr_proxy.data = kwargs
 
     dataset = kwargs['dataset']
+    since_batch, until_batch = kwargs.get('since_batch'), kwargs.get('until_batch')
     query = detail_query(vr_proxy)
 
     rownum = 0
     chunksize = 1000
-    hide = {'geom', 'hash'}
+    # A delta keeps the hash, so removed records can be matched up,
+    # and marks each row as added or removed.
+    hide = {'geom', 'hash'} if since_batch is None else {'geom'}
+    change = [] if since_batch is None else ['added']
 
     buffer = io.StringIO()
     writer = csv.writer(buffer)
-    writer.writerow([c.name for c in dataset.c if c not in hide])
+    header = [c.name for c in record_columns(dataset.c) if c.name not in hide]
+    writer.writerow(header + (['change'] if change else []))
 
     for row in query.yield_per(chunksize):
         rownum += 1
-        writer.writerow([getattr(row, c) for c in row.keys() if c not in hide])
+        writer.writerow([getattr(row, c) for c in row.keys() if c not in hide] + change)
 
         if rownum % chunksize == 0:
             yield buffer.getvalue()
@@ -320,10 +351,67 @@ def datadump_csv(**kwargs):
             buffer = io.StringIO()
             writer = csv.writer(buffer)
 
+    if since_batch is not None:
+        for hash_ in removed_since(dataset, since_batch, until_batch):
+            writer.writerow([hash_ if c == 'hash' else None for c in header] + ['removed'])
+
     yield buffer.getvalue()
     buffer.close()
 
 
+def resolve_since(data):
+    """Turn the since or since_batch of a /detail or /datadump request into
+    the id of the batch to return changes after, left in data['since_batch'].
+    The dataset's latest batch is looked up once, up front, and left in
+    data['until_batch'], so that the records, the removed hashes and the batch
+    to ask for next time all stop at the same point even if an ingest lands
+    while the response is being put together.
+    Unless the request asked for dates, it's not cut to the default window.
+
+    :param data: validated request arguments
+    :returns: the batch id, or None if the request didn't ask for changes
+    :raises ValueError: if the change log doesn't reach back that far, or the
+                        dataset was rebuilt from scratch since then,
+                        so there's no delta to give
+    """
+    since, since_batch = data.pop('since', None), data.pop('since_batch', None)
+    if since is None and since_batch is None:
+        return None
+
+    dataset = data['dataset']
+    if since_batch is None:
+        since_batch = IngestBatch.as_of(dataset.name, since)
+    if not IngestBatch.logged(dataset.name, since_batch):
+        raise ValueError("{}'s change log doesn't reach back that far, download it in full and ask "
+                         "for changes since then.".format(dataset.name))
+    reloaded = IngestBatch.reloaded_after(dataset.name, since_batch)
+    if reloaded is not None:
+        raise ValueError('{} was rebuilt in batch {}, download it in full and ask '
+                         'for changes since then.'.format(dataset.name, reloaded))
+
+    for key in ('obs_date__ge', 'obs_date__le'):
+        if key not in request.args:
+            data.pop(key, None)
+    data['since_batch'] = since_batch
+    data['until_batch'] = latest_batch(dataset, since_batch)
+    return since_batch
+
+
+def latest_batch(dataset, since_batch):
+    """Id of the batch to ask for changes since next time."""
+    latest = IngestBatch.latest(dataset.name)
+    return latest.id if latest else since_batch
+
+
+def removed_since(dataset, since_batch, until_batch):
+    """Hashes of the records removed from dataset after since_batch,
+    up to and including until_batch (and not back since)."""
+    change = IngestChange.__table__
+    removed = IngestBatch.changed_since(dataset.name, since_batch, removed=True, until=until_batch).\
+        where(~sqlalchemy.exists().where(dataset.c.hash == change.c.hash))
+    return [hash_ for hash_, in postgres_session.execute(removed)]
+
+
 def detail_query(args, aggregate=False):
     meta_params = ('dataset', 'shapeset', 'data_type', 'geom', 'obs_date__ge',
                    'obs_date__le')
@@ -347,7 +435,14 @@ def detail_query(args, aggregate=False):
         return api_response.bad_request('Too many table filters provided.')
 
     # Query the point dataset.
-    q = postgres_session.query(dataset)
+    q = postgres_session.query(*record_columns(dataset.c))
+
+    # If the user asked for changes since a batch, only return records it added.
+    since_batch = args.data.get('since_batch')
+    if since_batch is not None:
+        added = IngestBatch.changed_since(dataset.name, since_batch, removed=False,
+                                          until=args.data.get('until_batch'))
+        q = q.filter(dataset.c.hash.in_(added))
 
     # If the user specified a geom, filter results to those within its shape.
     if geom:
@@ -523,7 +618,7 @@ def request_args_to_condition_tree(request_args, ignore=list()):
     ignored = {'agg', 'data_type', 'dataset', 'geom', 'limit', 'offset',
                'shape', 'shapeset', 'job', 'all', 'datadump_part', 'datadump_total',
                'datadump_requestid', 'datadump_urlroot', 'jobsframework_ticket', 'jobsframework_workerid',
-               'jobsframework_workerbirthtime'}
+               'jobsframework_workerbirthtime', 'since', 'since_batch', 'until_batch'}
     for val in ignore:
         ignored.add(val)
 
@@ -1,6 +1,7 @@
 import json
 import os
 import tempfile
+from collections import OrderedDict
 from datetime import datetime
 from functools import reduce
 from itertools import groupby
@@ -108,12 +109,13 @@ def add_geojson_feature(geojson_response, feature_geom, feature_properties):
     geojson_response['features'].append(new_feature)
 
 
-def form_json_detail_response(to_remove, validator, rows):
+def form_json_detail_response(to_remove, validator, rows, meta=None):
     to_remove.append('geom')
     remove_columns_from_dict(rows, to_remove)
     resp = json_response_base(validator, rows)
     resp['meta']['total'] = len(resp['objects'])
     resp['meta']['query'] = request.args
+    resp['meta'].update(meta or {})
     resp = make_response(
         json.dumps(resp, default=unknown_object_json_handler),
         200
@@ -149,9 +151,10 @@ def form_csv_detail_response(to_remove, rows, dataset_names=None):
     return resp
 
 
-def form_geojson_detail_response(to_remove, rows):
+def form_geojson_detail_response(to_remove, rows, members=None):
     remove_columns_from_dict(rows, to_remove)
     geojson_resp = convert_result_geoms(rows)
+    geojson_resp.update(members or {})
     resp = make_response(json.dumps(geojson_resp, default=unknown_object_json_handler), 200)
     resp.headers['Content-Type'] = 'application/json'
     return resp
@@ -227,6 +230,36 @@ def detail_response(query_result, query_args):
         return form_geojson_detail_response(to_remove, query_result)
 
 
+def detail_delta_response(query_result, query_args, batch, removed):
+    """Respond to /detail with since or since_batch. Records keep their hash
+    so clients can match up the hashes of records removed since, and the
+    batch to ask for changes since next time comes along."""
+    to_remove = ['point_date']
+
+    data_type = query_args.data['data_type']
+    if data_type == 'json':
+        resp = form_json_detail_response(to_remove, query_args, query_result,
+                                         meta={'batch': batch, 'removed': removed})
+
+    elif data_type == 'csv':
+        # Removed records are rows with just a hash, told apart by a change column.
+        for row in query_result:
+            row['change'] = 'added'
+        columns = list(query_result[0].keys()) if query_result else ['hash', 'change']
+        for hash_ in removed:
+            row = OrderedDict((c, None) for c in columns if c not in ('geom', 'point_date'))
+            row.update(hash=hash_, change='removed')
+            query_result.append(row)
+        resp = form_csv_detail_response(to_remove, query_result)
+
+    elif data_type == 'geojson':
+        resp = form_geojson_detail_response(to_remove, query_result,
+                                            members={'batch': batch, 'removed': removed})
+
+    resp.headers['X-Plenario-Batch'] = str(batch)
+    return resp
+
+
 # Shape Endpoint Responses ====================================================
 
 def aggregate_point_data_response(data_type, rows, dataset_names):
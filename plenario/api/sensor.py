@@ -7,13 +7,14 @@ from flask import jsonify, make_response, request
 from sqlalchemy import Table, func
 from sqlalchemy.exc import SQLAlchemyError
 
-from plenario.api.common import CACHE_TIMEOUT, RESPONSE_LIMIT, cache, crossdomain, date_json_handler, make_cache_key
+from plenario.api.caching import cached
+from plenario.api.common import RESPONSE_LIMIT, crossdomain, date_json_handler
 from plenario.api.response import make_error
 from plenario.database import postgres_base, postgres_engine as engine, postgres_session
 from plenario.utils.helpers import get_size_in_degrees
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached()
 @crossdomain(origin='*')
 def weather_stations():
     raw_query_params = request.args.copy()
@@ -54,7 +55,7 @@ def weather_stations():
     return resp
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached()
 @crossdomain(origin='*')
 def weather(table):
     raw_query_params = request.args.copy()
@@ -10,7 +10,8 @@ from marshmallow.decorators import pre_dump, post_load
 from marshmallow.fields import Str, List
 from marshmallow.validate import OneOf
 
-from plenario.api.common import crossdomain, cache, CACHE_TIMEOUT, make_cache_key
+from plenario.api.caching import cached
+from plenario.api.common import SOFT_CACHE_TIMEOUT, crossdomain
 from plenario.api.condition_builder import parse_tree
 from plenario.api.fields import Geometry, Pointset, DateTime, Commalist
 from plenario.api.response import make_error, make_csv, make_response
@@ -48,7 +49,7 @@ class TimeseriesValidator(Schema):
         return data
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached(soft_timeout=SOFT_CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def timeseries():
     validator = TimeseriesValidator()
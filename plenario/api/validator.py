@@ -138,6 +138,9 @@ class DatasetRequiredValidator(Validator):
     requests that do not specify a 'dataset_name' in the query string.
     """
     dataset_name = fields.Str(validate=validate_dataset, dump_to='dataset', required=True)
+    # Ask for only what changed after an ingest batch, or after a point in time
+    since_batch = fields.Integer(default=None, validate=Range(0))
+    since = fields.DateTime(default=None)
 
 
 class PointsetRequiredValidator(Validator):
@@ -11,6 +11,7 @@ from wtforms import StringField
 from plenario.database import postgres_session
 from plenario.models.SensorNetwork import NetworkMeta
 from plenario.sensor_network.redshift_ops import create_foi_table, table_exists
+from plenario.utils.versions import bump_version
 from .validators import assert_json_enclosed_in_brackets, map_to_redshift_type, validate_node, \
     validate_sensor_properties
 
@@ -43,6 +44,10 @@ class BaseMetaView(ModelView):
     def inaccessible_callback(self, name, **kwargs):
         return redirect(url_for('auth.login'))
 
+    def after_model_change(self, form, model, is_created):
+        # Drop cached sensor network responses, which may describe the old metadata
+        bump_version('network')
+
 
 class NetworkMetaView(BaseMetaView):
     column_list = ('name', 'nodes', 'info')
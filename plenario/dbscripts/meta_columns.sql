@@ -0,0 +1,34 @@
+-- Columns added to meta_master and meta_shape after those tables were first
+-- created. create_all() leaves existing tables alone, so databases set up
+-- before then get them here. Safe to run again.
+--
+-- ADD COLUMN IF NOT EXISTS needs Postgres 9.6 and we still run on 9.4,
+-- so each column is looked up first instead.
+
+CREATE OR REPLACE FUNCTION pg_temp.add_column_if_not_exists(tbl text, col text, typ text)
+    RETURNS void
+AS
+$$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = tbl AND column_name = col) THEN
+        EXECUTE format('ALTER TABLE %I ADD COLUMN %I %s', tbl, col, typ);
+    END IF;
+END;
+$$
+LANGUAGE plpgsql;
+
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'inference_sample_size', 'INTEGER');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'source_etag', 'VARCHAR');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'source_last_modified', 'VARCHAR');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'source_digest', 'VARCHAR(32)');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'partition_by', 'VARCHAR(10)');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'layout_policy', 'JSONB');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'layout_timings', 'JSONB');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'grid_cells', 'JSONB');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'daily_counts', 'BOOLEAN');
+SELECT pg_temp.add_column_if_not_exists('meta_master', 'cell_counts', 'INTEGER');
+
+SELECT pg_temp.add_column_if_not_exists('meta_shape', 'source_etag', 'VARCHAR');
+SELECT pg_temp.add_column_if_not_exists('meta_shape', 'source_last_modified', 'VARCHAR');
+SELECT pg_temp.add_column_if_not_exists('meta_shape', 'source_digest', 'VARCHAR(32)');
@@ -1,11 +1,39 @@
+import bz2
+import csv
+import gzip
+import io
+import os
+import queue
+import re
 import requests
+import sqlite3
 import tempfile
+import threading
+import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5, sha1
 from logging import getLogger
 from plenario.database import postgres_engine
+from plenario.utils.typeinference import NULL_VALUES, widen_type
+from sqlalchemy import String
 
 logger = getLogger(__name__)
 
+# Values that Postgres wraps in double quotes when writing out a row.
+RECORD_QUOTE = re.compile(r'[",\\()\s]')
+# Backslash escapes of the COPY text format.
+COPY_TEXT_ESCAPE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+COPY_TEXT_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+# How many row digests to hold in memory before spilling to disk when deduplicating.
+DIGESTS_IN_MEMORY = 2000000
+# Characters that matter when looking for the end of a CSV record.
+QUOTE_OR_NEWLINE = re.compile(b'["\n]')
+# Leading bytes of the compressed formats we can read sources in.
+COMPRESSION_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'PK\x03\x04', 'zip'))
+# Ask for gzip, which we can sniff, rather than the requests default of 'gzip, deflate'.
+ACCEPT_ENCODING = 'gzip'
+
 
 class PlenarioETLError(Exception):
     def __init__(self, message):
@@ -20,14 +48,45 @@ class ETLFile(object):
     If initialized with source_path, it opens file on local filesystem.
     If initialized with source_url, it attempts to download file.
 
+    Sources compressed with gzip, bz2 or zip (holding a single file)
+    are recognized by their leading bytes, and open_text and open_binary
+    decompress them on the fly. Downloads are kept as they arrive over
+    the wire, so a server's gzip Content-Encoding is left on too.
+
     Implements context manager interface with __enter__ and __exit__.
     """
-    def __init__(self, source_path=None, source_url=None, interpret_as='text'):
+    def __init__(self, source_path=None, source_url=None, interpret_as='text', stream=False,
+                 etag=None, last_modified=None, digest=None, cache_dir=None, conditional=False):
+        """
+        :param stream: If True and the file is remote, don't download it to a
+                       temporary file first. Instead, self.handle is a
+                       forward-only text stream that's fed by the download
+                       as it happens.
+        :param etag: ETag of the source as of the last ingest.
+                     Sent as If-None-Match when conditional.
+        :param last_modified: Last-Modified of the source as of the last ingest.
+                              Sent as If-Modified-Since when conditional.
+        :param digest: md5 of the source contents as of the last ingest.
+                       Checked against the new contents once they're read.
+        :param cache_dir: If given, keep downloads in this directory
+                          under a name made from the URL and the ETag or
+                          Last-Modified the server sends, instead of in a
+                          temporary file. A later ETLFile for the same
+                          version of the source reuses the file, or resumes
+                          the download if it was cut off. Remove it with
+                          discard_cache once it's no longer needed.
+        :param conditional: If True, send the validators along, so that the
+                            server can answer that the source is unchanged
+                            instead of sending it. Only for callers that skip
+                            unchanged sources, since the handle is empty then.
+                            Can also be set on the instance before __enter__.
+        """
 
         logger.info('Begin.')
         logger.info('source_path: {}'.format(source_path))
         logger.info('source_url: {}'.format(source_url))
         logger.info('interpret_as: {}'.format(interpret_as))
+        logger.info('stream: {}'.format(stream))
         if source_path and source_url:
             raise RuntimeError('ETLFile takes exactly one of source_path and source_url. Both were given.')
 
@@ -38,7 +97,25 @@ class ETLFile(object):
         self.source_path = source_path
         self.source_url = source_url
         self.is_local = bool(source_path)
+        self.is_stream = stream and not self.is_local
+        self.cache_dir = cache_dir
         self._handle = None
+
+        self.previous_digest = digest
+        self.previous_etag = etag
+        self.previous_last_modified = last_modified
+        self.conditional = conditional
+
+        # Validators of what we actually got, filled in on __enter__
+        self.not_modified = False
+        self.etag = None
+        self.last_modified = None
+        self._digest = None
+        # Identifies this version of the source, when we can tell
+        self.source_key = None
+        self.cached_path = None
+        # 'gzip', 'bz2', 'zip' or None, filled in on __enter__
+        self.compression = None
         logger.info('End')
 
     def __enter__(self):
@@ -49,31 +126,135 @@ class ETLFile(object):
         if self.is_local:
             logger.debug('self.is_local: True')
             file_type = 'rb' if self.interpret_as == 'bytes' else 'r'
+            self._digest = file_digest(self.source_path)
+            self.source_key = _source_key(self.source_path, self._digest)
             self.handle = open(self.source_path, file_type)
+        elif self.is_stream:
+            logger.debug('self.is_stream: True')
+            self._stream = DownloadStream(self.source_url, headers=self.request_headers)
+            self._read_validators(self._stream.response)
+            raw = io.BufferedReader(self._stream)
+            self.compression = sniff_compression(raw)
+            if self.compression == 'zip':
+                # A zip archive has its index at the end, so it can't be read
+                # front to back. Spool it to a temporary file first.
+                spooled = tempfile.TemporaryFile()
+                for chunk in iter(lambda: raw.read(1024*1024), b''):
+                    spooled.write(chunk)
+                raw = spooled
+            self.handle = io.TextIOWrapper(decompressed(raw, self.compression), encoding='utf-8')
         else:
             logger.debug('self.is_local: False')
             self._download_temp_file(self.source_url)
 
+        if not self.is_stream:
+            with open(self._handle.name, 'rb') as f:
+                self.compression = sniff_compression(f)
+            if self.compression:
+                logger.info('Source is compressed with {}'.format(self.compression))
+
         # Return the whole ETLFile so that the `with foo as bar:` syntax looks right.
         return self
 
+    def downloaded(self):
+        """A new ETLFile for the same remote source that downloads it instead of streaming it."""
+        return ETLFile(source_url=self.source_url, interpret_as=self.interpret_as,
+                       etag=self.previous_etag, last_modified=self.previous_last_modified,
+                       digest=self.previous_digest, cache_dir=self.cache_dir,
+                       conditional=self.conditional)
+
+    @property
+    def request_headers(self):
+        headers = {'Accept-Encoding': ACCEPT_ENCODING}
+        if self.conditional and self.previous_etag:
+            headers['If-None-Match'] = self.previous_etag
+        if self.conditional and self.previous_last_modified:
+            headers['If-Modified-Since'] = self.previous_last_modified
+        return headers
+
     # Users of the class were seeking to 0 all the time after they grabbed the handle.
     # Moved it here so clients are always pointed to 0 when they get handle
     @property
     def handle(self):
-        self._handle.seek(0)
+        # Streamed downloads can only be read front to back.
+        if self._handle.seekable():
+            self._handle.seek(0)
         return self._handle
 
     @handle.setter
     def handle(self, val):
         self._handle = val
 
+    @property
+    def digest(self):
+        """
+        md5 of the source contents. When streaming, this is None
+        until the download has been read to the end.
+        """
+        if self.is_stream:
+            return self._stream.digest
+        return self._digest
+
+    @property
+    def unchanged(self):
+        """
+        True if the source is known to be the same as at the last ingest,
+        either because the server said so or because the contents match.
+        """
+        if self.not_modified:
+            return True
+        return self.digest is not None and self.digest == self.previous_digest
+
+    def open_text(self):
+        """
+        A new text handle on the source, decompressed if need be.
+        For a stream, that's self.handle. The caller closes it.
+        """
+        if self.is_stream:
+            return self.handle
+        return io.TextIOWrapper(self.open_binary(), encoding='utf-8')
+
+    def open_binary(self, unzip=True):
+        """
+        A new binary handle on the downloaded or local source,
+        decompressed if need be. The caller closes it.
+        :param unzip: if False, hand over a zip archive as is
+                      (a gzipped or bz2ed archive is still decompressed)
+        """
+        compression = self.compression
+        if compression == 'zip' and not unzip:
+            compression = None
+        return decompressed(open(self._handle.name, 'rb'), compression)
+
+    def save_validators(self, meta):
+        """
+        Remember this source's validators on its metadata record
+        (a MetaTable or ShapeMetadata), to send along on the next update.
+        Call after a successful ingest. The caller commits.
+        """
+        meta.source_etag = self.etag
+        meta.source_last_modified = self.last_modified
+        meta.source_digest = self.digest
+
+    def discard_cache(self):
+        """Remove the cached download, if there is one."""
+        if self.cached_path and os.path.exists(self.cached_path):
+            os.remove(self.cached_path)
+
+    def _read_validators(self, response):
+        self.not_modified = response.status_code == 304
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        if self.not_modified:
+            logger.info('Not modified since the last ingest.')
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         # If self.handle is to a file that was already on the file system,
         # .close() acts as we expect.
         # If self.handle is to a TemporaryFile that we downloaded for this purpose,
         # .close() also deletes it from the filesystem.
-        self.handle.close()
+        if self._handle is not None:
+            self._handle.close()
 
     def _download_temp_file(self, url):
         """
@@ -88,62 +269,892 @@ class ETLFile(object):
         # I'd like to enforce a timeout, but some big datasets
         # take more than a minute to start streaming.
         # Maybe add timeout as a parameter.
-        file_stream_request = requests.get(url, stream=True)
-        # Raise an exception if we didn't get a 200
+        file_stream_request = requests.get(url, stream=True, headers=self.request_headers)
+        # Raise an exception if we didn't get a 200 (or a 304)
         file_stream_request.raise_for_status()
+        self._read_validators(file_stream_request)
+
+        if self.not_modified:
+            # Make an empty temporary file our file handle
+            self.handle = tempfile.NamedTemporaryFile()
+            logger.info('End.')
+            return
+
+        validator = self.etag or self.last_modified
+        if validator:
+            self.source_key = _source_key(url, validator)
+        if self.cache_dir and validator:
+            self._download_cached(url, file_stream_request, validator)
+            logger.info('End.')
+            return
 
         # Make this temporary file our file handle
         self.handle = tempfile.NamedTemporaryFile()
 
         # Download and write to disk in 1MB chunks.
-        for chunk in file_stream_request.iter_content(chunk_size=1024*1024):
+        digest = md5()
+        for chunk in raw_chunks(file_stream_request):
             if chunk:
+                digest.update(chunk)
                 self._handle.write(chunk)
                 self._handle.flush()
+        self._digest = digest.hexdigest()
         logger.info('End.')
 
+    def _download_cached(self, url, response, validator):
+        """
+        Download to the cache, or reuse what's there for this URL and validator.
+        A partial download is picked up where it left off with a Range request.
+        """
+        path = os.path.join(self.cache_dir, self.source_key)
+        partial = path + '.part'
+
+        if os.path.exists(path):
+            logger.info('Using cached download {}'.format(path))
+            response.close()
+        else:
+            mode = 'wb'
+            if os.path.exists(partial) and os.path.getsize(partial) > 0:
+                response.close()
+                offset = os.path.getsize(partial)
+                logger.info('Resuming download at byte {}'.format(offset))
+                # If-Range makes the server send the whole thing
+                # if the source changed since the partial download.
+                response = requests.get(url, stream=True, headers={
+                    'Range': 'bytes={}-'.format(offset), 'If-Range': validator,
+                    'Accept-Encoding': ACCEPT_ENCODING})
+                response.raise_for_status()
+                if response.status_code == 206:
+                    mode = 'ab'
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(partial, mode) as f:
+                for chunk in raw_chunks(response):
+                    if chunk:
+                        f.write(chunk)
+            os.rename(partial, path)
+
+        self.cached_path = path
+        self._digest = file_digest(path)
+        self.handle = open(path, 'rb')
+
 
-def add_unique_hash(table_name):
+def raw_chunks(response, chunk_size=1024*1024):
     """
-    Adds an md5 hash column of the preexisting columns
-    and removes duplicate rows from a table.
-    :param table_name: Name of table to add hash to.
+    The body of a streamed requests response as sent, without undoing
+    its Content-Encoding, so a gzipped download stays gzipped on disk.
+    """
+    return response.raw.stream(chunk_size, decode_content=False)
+
+
+def sniff_compression(f):
+    """
+    :param f: binary file at the start of the source. Left where it was.
+    :return: 'gzip', 'bz2', 'zip' or None, going by the leading bytes
+    """
+    if hasattr(f, 'peek'):
+        head = f.peek(4)[:4]
+    else:
+        head = f.read(4)
+        f.seek(-len(head), io.SEEK_CUR)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def decompressed(f, compression):
+    """
+    A binary file that reads the decompressed contents of f.
+    Decompression happens as it's read, nothing is expanded on disk.
+    :param f: binary file of compressed data. Only a zip archive needs to be seekable.
+    :param compression: 'gzip', 'bz2', 'zip' or None to read f as it is
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(f)
+    if compression == 'zip':
+        archive = zipfile.ZipFile(f)
+        members = [m for m in archive.infolist() if not m.filename.endswith('/')]
+        if len(members) != 1:
+            raise PlenarioETLError('Expected a zip archive holding one file, found {}'.format(
+                [m.filename for m in members]))
+        return io.BufferedReader(ZipMember(archive, members[0], f))
+    return f
+
+
+class ZipMember(io.RawIOBase):
+    """
+    Read-only raw stream over a file in a zip archive.
+    Before Python 3.7 the file in an archive can't seek, and Staging reads
+    a source more than once. So seeking back reopens the file and reads
+    forward from its start, instead of expanding it anywhere.
+    Seeking forward reads and discards.
+    """
+    def __init__(self, archive, member, f):
+        """
+        :param archive: open ZipFile
+        :param member: ZipInfo of the file to read
+        :param f: the archive's file, closed along with this stream
+        """
+        super().__init__()
+        self._archive = archive
+        self._member = member
+        self._f = f
+        self._file = archive.open(member)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._file.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self._position += n
+        return n
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Can only seek from the start of a file in a zip archive')
+        if offset < self._position:
+            self._file.close()
+            self._file = self._archive.open(self._member)
+            self._position = 0
+        while self._position < offset:
+            skipped = len(self._file.read(min(offset - self._position, 1024*1024)))
+            if not skipped:
+                break
+            self._position += skipped
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._archive.close()
+            self._f.close()
+        super().close()
+
+
+def _source_key(location, validator):
+    """Name for a version of a source, from its URL or path and its ETag, Last-Modified or digest."""
+    return sha1('{}\n{}'.format(location, validator).encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    """md5 hex digest of the contents of the file at path."""
+    digest = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadStream(io.RawIOBase):
+    """
+    Read-only raw stream over a remote file that is downloaded
+    on a background thread while it's being read.
+    Downloaded chunks wait in a bounded queue, so when the reader falls behind,
+    the download stalls instead of piling up in memory or on disk.
+    A 304 Not Modified response reads as an empty stream.
+    """
+    def __init__(self, url, chunk_size=1024*1024, max_chunks=8, headers=None):
+        super().__init__()
+        logger.info('Begin. (url: {})'.format(url))
+        self.response = requests.get(url, stream=True, headers=headers)
+        # Raise an exception if we didn't get a 200 (or a 304)
+        self.response.raise_for_status()
+        # md5 of the whole download, once it's complete
+        self.digest = None
+
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._pending = memoryview(b'')
+        self._finished = False
+        self._error = None
+        self._stop = threading.Event()
+
+        if self.response.status_code == 304:
+            self._finished = True
+            return
+        self._thread = threading.Thread(target=self._download, daemon=True)
+        self._thread.start()
+
+    def _download(self):
+        digest = md5()
+        try:
+            for chunk in raw_chunks(self.response, self._chunk_size):
+                if chunk:
+                    digest.update(chunk)
+                    if not self._put(chunk):
+                        return
+        except Exception as e:
+            self._error = e
+        else:
+            # Closing the response cuts the download short without an error.
+            if self._stop.is_set():
+                return
+            self.digest = digest.hexdigest()
+        # Let the reader know we're done.
+        self._put(None)
+
+    def _put(self, chunk):
+        """Block until there's room in the queue, or until the stream is closed."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            if self._finished:
+                return 0
+            chunk = self._queue.get()
+            if chunk is None:
+                self._finished = True
+                if self._error is not None:
+                    raise IOError('Download failed: {}'.format(self._error))
+                return 0
+            self._pending = memoryview(chunk)
+
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self.response.close()
+        super().close()
+
+
+class IteratorFile(object):
+    """
+    Read-only file-like object over an iterator of strings.
+    Lets cursor.copy_expert consume rows as they are produced
+    instead of needing them written out to a file first.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        pieces, length = [self._buffer], len(self._buffer)
+        while size < 0 or length < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            pieces.append(chunk)
+            length += len(chunk)
+
+        data = ''.join(pieces)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def raw_csv_rows(lines, rejects=None):
+    """
+    Parse CSV lines while holding on to the exact source text of each record,
+    so records can be checked and then handed to COPY untouched.
+    :param lines: iterable of lines, newlines included (like an open file)
+    :param rejects: RejectLog. If given, records that can't be parsed,
+                    have the wrong number of values, hold NUL characters
+                    or have a value that doesn't fit the log's column types
+                    are logged there and skipped instead of raising
+                    or being passed on to fail the COPY.
+    :return: generator of (row, raw) pairs where row is the parsed list of
+             values and raw is the record's text, which may span lines.
+    """
+    consumed = []
+
+    def feed():
+        for line in lines:
+            consumed.append(line)
+            yield line
+
+    reader = csv.reader(feed())
+    if rejects is None:
+        for row in reader:
+            raw = ''.join(consumed)
+            del consumed[:]
+            yield row, raw
+        return
+
+    while True:
+        try:
+            row = next(reader)
+            error = None
+        except StopIteration:
+            return
+        except csv.Error as e:
+            row, error = None, str(e)
+        raw = ''.join(consumed)
+        line = rejects.line
+        # Move on before yielding, so line is right while the record is out.
+        rejects.line += len(consumed)
+        del consumed[:]
+
+        if error is None and row:
+            if rejects.width is None:
+                # The header sets the width.
+                rejects.width = len(row)
+                yield row, raw
+                continue
+            if len(row) != rejects.width:
+                error = 'Expected {} values, found {}'.format(rejects.width, len(row))
+            elif '\x00' in raw:
+                error = 'NUL character'
+            elif rejects.types is not None:
+                row, raw, error = fit_csv_record(row, raw, rejects.types)
+
+        if error is None:
+            if row:
+                rejects.accepted += 1
+            yield row, raw
+        else:
+            rejects.reject(line, raw, error)
+
+
+def fit_csv_record(row, raw, types):
+    """
+    Check a record's values against the types of the columns they're going into.
+    Null tokens like N/A in typed columns (see NULL_VALUES) are read as NULL
+    by inference but not by COPY, so the record is rewritten with them left empty.
+    :param row: parsed values of the record
+    :param raw: the record's source text
+    :param types: SQLAlchemy type of each column. String columns aren't checked.
+    :return: (row, raw, error) where error says why the record doesn't fit, or is None
+    """
+    nulled = False
+    for idx, (type_, value) in enumerate(zip(types, row)):
+        if type_ is String or value == '':
+            continue
+        if value.lower() in NULL_VALUES:
+            row[idx] = ''
+            nulled = True
+        elif widen_type(type_, value) is not type_:
+            return row, raw, "Value {!r} of column {} isn't {}".format(value, idx + 1, type_.__name__)
+
+    if nulled:
+        out = io.StringIO()
+        csv.writer(out, lineterminator='\n').writerow(row)
+        raw = out.getvalue()
+    return row, raw, None
+
+
+class RejectLog(object):
+    """
+    Malformed CSV records set aside during a load instead of failing it,
+    each with the line number it starts on and the reason it was rejected.
+    Rejects wait in a temporary file until save() copies them into a table.
+    """
+    def __init__(self, width=None, line=1, types=None, _root=None):
+        """
+        :param width: number of values every record should have.
+                      If None, the first record (the header) sets it.
+        :param line: line number of the next record
+        :param types: SQLAlchemy type of each column to check values against
+                      with fit_csv_record. If None, values aren't checked.
+        """
+        self.width = width
+        self.line = line
+        self.types = types
+        self.accepted = 0
+        self.rejected = 0
+        self._root = _root or self
+        self._forks = []
+        if _root is None:
+            self._lock = threading.Lock()
+            self._file = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+
+    def fork(self, line):
+        """A log for a part of the source that starts at line, to be used on another thread."""
+        child = RejectLog(self.width, line, self.types, _root=self)
+        self._forks.append(child)
+        return child
+
+    def reject(self, line, raw, reason):
+        root = self._root
+        with root._lock:
+            # Postgres text can't hold NUL characters.
+            root._writer.writerow([line, reason, raw.replace('\x00', '')])
+        self.rejected += 1
+
+    def reset(self):
+        """Start over from the top of the source, header included."""
+        self.width = None
+        self.line = 1
+        self.accepted = self.rejected = 0
+        self._forks = []
+        self._file.seek(0)
+        self._file.truncate()
+
+    @property
+    def counts(self):
+        """(accepted, rejected) records, forks included."""
+        logs = [self] + self._forks
+        return sum(l.accepted for l in logs), sum(l.rejected for l in logs)
+
+    @property
+    def error_rate(self):
+        accepted, rejected = self.counts
+        total = accepted + rejected
+        return rejected / total if total else 0.0
+
+    def save(self, cursor, table_name):
+        """
+        Copy the rejects logged so far into table_name, creating it if need be.
+        The caller commits.
+        """
+        if self._file.tell() == 0:
+            return
+        cursor.execute('CREATE TABLE IF NOT EXISTS "{}" '
+                       '(line_number BIGINT, reason TEXT, record TEXT)'.format(table_name))
+        self._file.seek(0)
+        cursor.copy_expert('COPY "{}" (line_number, reason, record) FROM STDIN '
+                           'WITH (FORMAT CSV)'.format(table_name), self._file)
+        self._file.seek(0)
+        self._file.truncate()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def record_text(values):
+    """
+    Format values the way Postgres writes out a row (record_out),
+    so that hashing the result matches md5(CAST(row AS text))
+    for values already written in their canonical text form.
+    :param values: list of strings, None for NULL
+    """
+    out = []
+    for value in values:
+        if value is None:
+            out.append('')
+        elif value == '' or RECORD_QUOTE.search(value):
+            out.append('"' + value.replace('\\', '\\\\').replace('"', '""') + '"')
+        else:
+            out.append(value)
+    return '(' + ','.join(out) + ')'
+
+
+def record_hash(values):
+    return md5(record_text(values).encode('utf-8'))
+
+
+class DigestSet(object):
+    """
+    Set of row digests for deduplicating records as they stream by.
+    Holds up to max_in_memory digests in memory,
+    then spills the rest to a temporary sqlite database on disk.
+    Safe to share between threads.
+    """
+    def __init__(self, max_in_memory=DIGESTS_IN_MEMORY):
+        self.max_in_memory = max_in_memory
+        self._memory = set()
+        self._disk = None
+        self._disk_path = None
+        self._lock = threading.Lock()
+
+    def add(self, digest):
+        """
+        :param digest: bytes of a row digest
+        :return: True if the digest hadn't been seen before
+        """
+        with self._lock:
+            return self._add(digest)
+
+    def _add(self, digest):
+        if digest in self._memory:
+            return False
+        if len(self._memory) < self.max_in_memory:
+            self._memory.add(digest)
+            return True
+
+        if self._disk is None:
+            fd, self._disk_path = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            self._disk = sqlite3.connect(self._disk_path, check_same_thread=False)
+            self._disk.execute('CREATE TABLE digests (digest BLOB PRIMARY KEY) WITHOUT ROWID')
+        cursor = self._disk.execute('INSERT OR IGNORE INTO digests VALUES (?)', (digest,))
+        return cursor.rowcount == 1
+
+    def close(self):
+        """Forget every digest and remove any spill file. The set can be reused."""
+        self._memory = set()
+        if self._disk is not None:
+            self._disk.close()
+            os.remove(self._disk_path)
+            self._disk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def hash_csv_records(records, digests):
+    """
+    Append an md5 hash column to each CSV record and drop duplicate records,
+    so a table can be loaded and deduplicated in a single COPY.
+    Unquoted empty values are hashed as NULL, as that's how COPY reads them.
+    :param records: (row, raw) pairs from raw_csv_rows
+    :param digests: DigestSet of records seen so far
+    :return: generator of CSV lines with the hash as the last value
+    """
+    for row, raw in records:
+        if not row:
+            continue
+        digest = record_hash([value if value != '' else None for value in row])
+        if digests.add(digest.digest()):
+            yield raw.rstrip('\r\n') + ',' + digest.hexdigest() + '\n'
+
+
+def csv_chunk_ranges(f, chunks, block_size=1024 * 1024):
+    """
+    Split a CSV file into byte ranges that each hold whole records,
+    so that the ranges can be loaded independently.
+    A newline only ends a record outside of quotes, which we track
+    by the parity of the quote characters seen so far.
+    :param f: file opened in binary mode
+    :param chunks: how many ranges to aim for. There may be fewer
+                   when records are long and the file is short.
+    :return: list of (start, end) offsets, skipping the header
+    """
+    f.seek(0, io.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+
+    boundaries = []
+    step = None
+    # The first boundary we look for ends the header.
+    target = 0
+    in_quotes = False
+    pos = 0
+    while len(boundaries) < chunks:
+        block = f.read(block_size)
+        if not block:
+            break
+        i = 0
+        while len(boundaries) < chunks:
+            t = target - pos
+            if t >= len(block):
+                # Nothing to look for in this block, just keep count of quotes.
+                in_quotes ^= bool(block.count(b'"', i) & 1)
+                break
+            if t > i:
+                in_quotes ^= bool(block.count(b'"', i, t) & 1)
+                i = t
+            match = QUOTE_OR_NEWLINE.search(block, i)
+            if match is None:
+                break
+            i = match.end()
+            if match.group() == b'"':
+                in_quotes = not in_quotes
+            elif not in_quotes:
+                boundaries.append(pos + i)
+                if step is None:
+                    step = max((size - boundaries[0]) // chunks, 1)
+                target = max(boundaries[0] + step * len(boundaries), pos + i)
+        pos += len(block)
+
+    if not boundaries:
+        return []
+    ends = boundaries[1:] + [size]
+    return [(start, end) for start, end in zip(boundaries, ends) if end > start]
+
+
+def line_numbers(f, offsets, block_size=1024 * 1024):
+    """
+    :param f: file opened in binary mode
+    :param offsets: ascending byte offsets, each at the start of a line
+    :return: the line number (counting from 1) at each offset
+    """
+    f.seek(0)
+    numbers = []
+    line, pos = 1, 0
+    for offset in offsets:
+        while pos < offset:
+            block = f.read(min(block_size, offset - pos))
+            if not block:
+                break
+            line += block.count(b'\n')
+            pos += len(block)
+        numbers.append(line)
+    return numbers
+
+
+class FileRange(io.RawIOBase):
+    """Read the bytes from start up to end of the file at path."""
+
+    def __init__(self, path, start, end):
+        self._f = open(path, 'rb')
+        self._f.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._f.read(min(len(b), self._remaining))
+        self._remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._f.close()
+        super(FileRange, self).close()
+
+
+def copy_csv_parallel(path, copy_statement, digests, workers, rejects=None):
+    """
+    COPY a CSV file over several connections at once.
+    The file is split into a range of whole records per worker,
+    and each range is hashed and fed to its own COPY
+    on a connection from the engine's pool.
+    Records already seen in any range are dropped.
+    :param path: path of a CSV file with a header
+    :param copy_statement: COPY ... FROM STDIN of CSV records with the hash tacked on
+    :param digests: DigestSet shared by all the workers
+    :param workers: number of connections to COPY over
+    :param rejects: RejectLog with its width set, to skip malformed records into
+    """
+
+    logger.info('Begin (path: {}, workers: {})'.format(path, workers))
+    with open(path, 'rb') as f:
+        ranges = csv_chunk_ranges(f, workers)
+        first_lines = line_numbers(f, [start for start, _ in ranges]) if rejects else None
+
+    def copy_range(start, end, range_rejects):
+        conn = postgres_engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                raw = io.BufferedReader(FileRange(path, start, end))
+                with io.TextIOWrapper(raw, encoding='utf-8') as text:
+                    hashed = hash_csv_records(raw_csv_rows(text, range_rejects), digests)
+                    cursor.copy_expert(copy_statement, IteratorFile(hashed))
+            conn.commit()
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for i, (start, end) in enumerate(ranges):
+            range_rejects = rejects.fork(first_lines[i]) if rejects else None
+            futures.append(pool.submit(copy_range, start, end, range_rejects))
+        # Surface the first failure, if any.
+        for future in futures:
+            future.result()
+    logger.info('End.')
+
+
+def _unescape_copy_text(value):
+    if value == '\\N':
+        return None
+
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] == 'x' and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        elif escape.isdigit():
+            return chr(int(escape, 8))
+        return COPY_TEXT_ESCAPES.get(escape, escape)
+
+    return COPY_TEXT_ESCAPE.sub(replace, value)
+
+
+def hash_copy_text_lines(lines, digests):
+    """
+    Like hash_csv_records, but for data lines in COPY's text format
+    (tab separated, backslash escaped), such as ogr2ogr's PGDUMP output.
+    Stops at the end-of-data marker.
+    """
+    for line in lines:
+        line = line.rstrip('\n')
+        if line == '\\.':
+            return
+        digest = record_hash([_unescape_copy_text(v) for v in line.split('\t')])
+        if digests.add(digest.digest()):
+            yield line + '\t' + digest.hexdigest() + '\n'
+
+
+def copy_pgdump_with_hashes(lines, table_name):
+    """
+    Run a PGDUMP-style SQL script (like ogr2ogr -f PGDUMP writes)
+    that creates and fills a table, adding an md5 hash primary key to
+    every row and dropping duplicate rows on the way into COPY.
+    The table is written once, instead of being copied again to hash it.
+    :param lines: iterable of lines of the script
+    :param table_name: name of the table the script creates
     """
 
     logger.info('Begin (table_name: {})'.format(table_name))
-    add_hash = '''
-    DROP TABLE IF EXISTS temp;
-    CREATE TABLE temp AS
-      SELECT DISTINCT *,
-             md5(CAST(("{table_name}".*)AS text))
-                AS hash FROM "{table_name}";
-    DROP TABLE "{table_name}";
-    ALTER TABLE temp RENAME TO "{table_name}";
-    ALTER TABLE "{table_name}" ADD PRIMARY KEY (hash);
-    '''.format(table_name=table_name)
+    copy_re = re.compile(r'^COPY (.+) \((.*)\) FROM STDIN;$')
+    lines = iter(lines)
+
+    conn = postgres_engine.raw_connection()
+    try:
+        with conn.cursor() as cursor, DigestSet() as digests:
+            has_hash = False
+            statement = []
+            for line in lines:
+                stripped = line.strip()
+                copy = copy_re.match(stripped)
+                if copy:
+                    if not has_hash:
+                        cursor.execute('ALTER TABLE "{}" ADD COLUMN hash VARCHAR(32)'.format(table_name))
+                        has_hash = True
+                    copy_st = 'COPY {} ({}, "hash") FROM STDIN'.format(*copy.groups())
+                    cursor.copy_expert(copy_st, IteratorFile(hash_copy_text_lines(lines, digests)))
+                    continue
+
+                statement.append(line)
+                if stripped.endswith(';'):
+                    sql = ''.join(statement).strip()
+                    statement = []
+                    # We commit once at the end, all or nothing.
+                    if sql.upper() not in ('BEGIN;', 'COMMIT;', 'END;'):
+                        cursor.execute(sql)
+
+            # ogr2ogr makes its own feature id the primary key.
+            cursor.execute('ALTER TABLE "{t}" DROP CONSTRAINT IF EXISTS "{t}_pk"'.format(t=table_name))
+            cursor.execute('ALTER TABLE "{}" ADD PRIMARY KEY (hash)'.format(table_name))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise PlenarioETLError(repr(e) + '\n Failed to load ' + table_name)
+    finally:
+        conn.close()
+    logger.info('End.')
+
+
+def swap_tables(live_name, new_name, in_swap=None):
+    """
+    Put the table new_name in place of live_name, dropping the old live table.
+    Statistics are gathered on the new table (and any partitions) first,
+    so the transaction that swaps them only has to drop and rename.
+    Indexes and partitions are renamed along with the table,
+    so that their names follow live_name and don't collide next time.
+    :param live_name: name of the table readers query
+    :param new_name: name of the fully built and indexed replacement
+    :param in_swap: callable taking the connection of the swap's transaction,
+                    to commit other work along with the swap. It's called
+                    before the old live table is dropped, so it can still
+                    read it, and before readers are locked out.
+    """
+
+    logger.info('Begin (live_name: {}, new_name: {})'.format(live_name, new_name))
+    children = """SELECT c.relname FROM pg_inherits AS i
+                    JOIN pg_class AS c ON c.oid = i.inhrelid
+                    JOIN pg_class AS p ON p.oid = i.inhparent
+                  WHERE p.relname = %s"""
+    indexes = """SELECT indexname FROM pg_indexes
+                 WHERE schemaname = current_schema() AND tablename = %s"""
 
     try:
-        postgres_engine.execute(add_hash)
+        with postgres_engine.connect() as connection:
+            with connection.begin():
+                tables = [row[0] for row in connection.execute(children, (new_name,))] + [new_name]
+                for name in tables:
+                    connection.execute('ANALYZE "{}"'.format(name))
+
+            with connection.begin():
+                if in_swap is not None:
+                    in_swap(connection)
+                # Readers queue up behind this transaction's locks from here on, so keep it short.
+                connection.execute('DROP TABLE IF EXISTS "{}" CASCADE'.format(live_name))
+                for name in tables:
+                    for index, in connection.execute(indexes, (name,)).fetchall():
+                        if new_name in index:
+                            connection.execute('ALTER INDEX "{}" RENAME TO "{}"'.format(
+                                index, index.replace(new_name, live_name, 1)))
+                    connection.execute('ALTER TABLE "{}" RENAME TO "{}"'.format(
+                        name, name.replace(new_name, live_name, 1)))
     except Exception as e:
-        raise PlenarioETLError(repr(e) +
-                               '\n Failed to deduplicate with ' + add_hash)
+        raise PlenarioETLError(repr(e) + '\n Failed to swap in ' + new_name)
     logger.info('End.')
 
 
-def delete_absent_hashes(staging_name, existing_name):
+def delete_absent_hashes(staging_name, existing_name, bind=postgres_engine, batch_id=None, dataset_name=None,
+                         cell_column=None):
+    """
+    Delete the records of existing_name whose hashes aren't in staging_name.
+    Both tables have their hashes indexed, so this is an anti-join
+    rather than a sort of both tables.
+    :param bind: engine or connection to delete over, to make it part of a transaction
+    :param batch_id: if given, log the deleted hashes as removed by this IngestBatch
+    :param dataset_name: if given, take the deleted records off the dataset's DailyCounts
+    :param cell_column: if given with dataset_name, take the deleted records
+                        off the dataset's CellCounts by this cell key column too
+    :return: number of records deleted
+    """
 
     logger.info('Begin.')
     logger.info('staging_name: {}'.format(staging_name))
     logger.info('existing_name: {}'.format(existing_name))
-    del_ = """DELETE FROM "{existing}"
-                  WHERE hash IN
-                     (SELECT hash FROM "{existing}"
-                        EXCEPT
-                      SELECT hash FROM  "{staging}");""".\
+    del_ = """DELETE FROM "{existing}" AS e
+                  WHERE NOT EXISTS
+                     (SELECT 1 FROM "{staging}" AS s
+                        WHERE s.hash = e.hash)""".\
             format(existing=existing_name, staging=staging_name)
+    # Whatever the deleted records are logged and counted in
+    # gets updated in the same statement, as they go.
+    steps = []
+    if batch_id is not None:
+        steps.append("""logged AS (
+            INSERT INTO etl_ingest_change (batch_id, hash, removed)
+            SELECT %(batch_id)s, hash, TRUE FROM gone)""")
+    if dataset_name is not None:
+        steps.append("""uncounted AS (
+            UPDATE etl_daily_count AS d SET count = d.count - g.n
+            FROM (SELECT point_date::date AS day, count(*) AS n FROM gone
+                  WHERE point_date IS NOT NULL GROUP BY point_date::date) AS g
+            WHERE d.dataset_name = %(dataset_name)s AND d.day = g.day)""")
+        if cell_column is not None:
+            steps.append("""uncelled AS (
+                UPDATE etl_cell_count AS d SET count = d.count - g.n
+                FROM (SELECT point_date::date AS day, cell, count(*) AS n FROM gone
+                      WHERE point_date IS NOT NULL AND cell IS NOT NULL
+                      GROUP BY point_date::date, cell) AS g
+                WHERE d.dataset_name = %(dataset_name)s AND d.day = g.day AND d.cell = g.cell)""")
 
     try:
-        postgres_engine.execute(del_)
+        if steps:
+            returning = 'e.hash, e.point_date' + (', e.{} AS cell'.format(cell_column) if cell_column else '')
+            with_ = 'WITH gone AS ({} RETURNING {}), {} SELECT count(*) FROM gone'.\
+                format(del_, returning, ', '.join(steps))
+            deleted = bind.execute(with_, {'batch_id': batch_id, 'dataset_name': dataset_name}).scalar()
+        else:
+            deleted = bind.execute(del_).rowcount
     except Exception as e:
         raise PlenarioETLError(repr(e) + '\n Failed to execute' + del_)
-    logger.info('End.')
\ No newline at end of file
+    logger.info('End.')
+    return deleted
\ No newline at end of file
@@ -0,0 +1,168 @@
+"""
+Optional reorganizing of a point table once it's been ingested.
+
+Point tables come out of the ETL in source file order, so date range and
+bounding box scans touch pages all over the heap. A dataset's layout_policy
+can ask for any of the following, applied in this order:
+
+    {
+        "cluster": "point_date" or "geohash",
+        "brin": ["point_date", ...],
+        "statistics": {"column": target, ...},
+        "analyze": true
+    }
+
+cluster rewrites the table in point_date order, or in the order of the
+geohash of geom, which is a Z-order curve and keeps nearby points together.
+brin adds BRIN indexes, which are tiny and work well on columns that follow
+the physical order of the table, like point_date in a table that's mostly
+appended to or clustered by it. statistics sets per-column statistics targets
+for the planner. analyze (on unless set to false) refreshes the statistics.
+
+CLUSTER locks the table against reads while it runs, so datasets that update
+in place with a cluster policy are unavailable for that long. Tables that are
+swapped in are reorganized before the swap.
+
+The standard queries are timed before and after, so it's plain what a policy
+bought.
+"""
+
+import time
+from datetime import timedelta
+from logging import getLogger
+
+from plenario.database import postgres_engine
+from plenario.etl.common import PlenarioETLError
+
+logger = getLogger(__name__)
+
+CLUSTER_KEYS = ('point_date', 'geohash')
+POLICY_KEYS = ('cluster', 'brin', 'statistics', 'analyze')
+# BRIN indexes arrived in Postgres 9.5.
+BRIN_SERVER_VERSION = 90500
+
+# A /detail page, a weekly /timeseries and a /grid-style count
+# over the latest 90 days of the table, standing in for what the API runs.
+STANDARD_QUERIES = {
+    'detail': 'SELECT * FROM "{t}" WHERE point_date >= %(lo)s AND point_date <= %(hi)s '
+              'ORDER BY point_date DESC LIMIT 1000',
+    'timeseries': "SELECT date_trunc('week', point_date) AS t, count(*) FROM \"{t}\" "
+                  'WHERE point_date >= %(lo)s AND point_date <= %(hi)s GROUP BY t',
+    'grid': 'SELECT count(*) FROM "{t}" WHERE point_date >= %(lo)s AND point_date <= %(hi)s '
+            'AND geom && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326)',
+}
+
+
+def validate_policy(policy):
+    """:raises PlenarioETLError: if policy isn't a layout policy we can apply"""
+    if not policy:
+        return
+    unknown = set(policy) - set(POLICY_KEYS)
+    if unknown:
+        raise PlenarioETLError('Unknown layout policy keys: {}'.format(sorted(unknown)))
+    if policy.get('cluster') not in (None,) + CLUSTER_KEYS:
+        raise PlenarioETLError('Unknown cluster key: {}'.format(policy['cluster']))
+
+
+def optimize_layout(table_name, policy):
+    """
+    Apply a layout policy to a point table and its partitions, if any.
+    :param table_name: name of the point table
+    :param policy: dict as described in the module docstring
+    :return: {query name: {'before_ms': ..., 'after_ms': ...}} for the standard queries
+    """
+    validate_policy(policy)
+    logger.info('Begin (table: {}, policy: {})'.format(table_name, policy))
+    params = _standard_params(table_name)
+    before = time_standard_queries(table_name, params)
+
+    # A partitioned table's rows all live in its children.
+    tables = _children(table_name) or [table_name]
+    try:
+        if policy.get('cluster'):
+            for name in tables:
+                _cluster(name, policy['cluster'])
+        if policy.get('brin'):
+            _brin(tables, policy['brin'])
+        for column, target in sorted(policy.get('statistics', {}).items()):
+            # Carries on to partitions on its own.
+            postgres_engine.execute('ALTER TABLE "{}" ALTER COLUMN "{}" SET STATISTICS {:d}'.
+                                    format(table_name, column, int(target)))
+        if policy.get('analyze', True):
+            for name in set(tables + [table_name]):
+                postgres_engine.execute('ANALYZE "{}"'.format(name))
+    except PlenarioETLError:
+        raise
+    except Exception as e:
+        raise PlenarioETLError(repr(e) + '\n Failed to optimize the layout of ' + table_name)
+
+    after = time_standard_queries(table_name, params)
+    timings = {name: {'before_ms': before[name], 'after_ms': after[name]} for name in before}
+    for name, timing in sorted(timings.items()):
+        logger.info('{} {}: {before_ms:.1f} ms before, {after_ms:.1f} ms after'.format(
+            table_name, name, **timing))
+    logger.info('End.')
+    return timings
+
+
+def time_standard_queries(table_name, params, repeat=3):
+    """Median milliseconds each of the standard queries takes on the table."""
+    timings = {}
+    for name, sql in STANDARD_QUERIES.items():
+        runs = []
+        for _ in range(repeat):
+            start = time.time()
+            postgres_engine.execute(sql.format(t=table_name), params).fetchall()
+            runs.append((time.time() - start) * 1000)
+        timings[name] = sorted(runs)[len(runs) // 2]
+    return timings
+
+
+def _standard_params(table_name):
+    """The latest 90 days of the table and the middle quarter of its extent."""
+    row = postgres_engine.execute(
+        'SELECT max(point_date), '
+        'ST_XMin(ST_Extent(geom)), ST_YMin(ST_Extent(geom)), '
+        'ST_XMax(ST_Extent(geom)), ST_YMax(ST_Extent(geom)) '
+        'FROM "{}"'.format(table_name)).first()
+    hi, xmin, ymin, xmax, ymax = row
+    if hi is None or xmin is None:
+        # Nothing to measure with; the queries still run, and come back empty.
+        return {'lo': None, 'hi': None, 'xmin': 0, 'ymin': 0, 'xmax': 0, 'ymax': 0}
+    width, height = xmax - xmin, ymax - ymin
+    return {
+        'lo': hi - timedelta(days=90),
+        'hi': hi,
+        'xmin': xmin + width / 4, 'ymin': ymin + height / 4,
+        'xmax': xmax - width / 4, 'ymax': ymax - height / 4,
+    }
+
+
+def _children(table_name):
+    """Names of the tables that inherit from table_name."""
+    return [name for name, in postgres_engine.execute(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = %s::regclass ORDER BY c.relname', '"{}"'.format(table_name))]
+
+
+def _cluster(table_name, key):
+    if key == 'point_date':
+        index = 'ix_{}_point_date'.format(table_name)
+    else:
+        # The geohash of a point orders points along a Z-order curve.
+        index = 'ix_{}_geohash'.format(table_name)
+        postgres_engine.execute('DROP INDEX IF EXISTS "{i}"; '
+                                'CREATE INDEX "{i}" ON "{t}" (ST_GeoHash(geom))'.
+                                format(i=index, t=table_name))
+    logger.info('Clustering {} on {}'.format(table_name, index))
+    postgres_engine.execute('CLUSTER "{}" USING "{}"'.format(table_name, index))
+
+
+def _brin(tables, columns):
+    if int(postgres_engine.execute('SHOW server_version_num').scalar()) < BRIN_SERVER_VERSION:
+        logger.warning('Skipping BRIN indexes, which need Postgres 9.5 or later.')
+        return
+    for name in tables:
+        for column in columns:
+            postgres_engine.execute('CREATE INDEX IF NOT EXISTS "ix_{t}_{c}_brin" ON "{t}" USING BRIN ("{c}")'.
+                                    format(t=name, c=column))
@@ -0,0 +1,128 @@
+"""
+Point tables split into child tables by ranges of point_date.
+
+A partitioned point table is an empty parent with one child table per month
+or year, each inheriting the parent's columns and carrying a CHECK constraint
+on its point_date range. Queries go against the parent as usual,
+and with constraint_exclusion at its default of 'partition' the planner
+skips children whose range can't match a point_date filter.
+Rows with no point_date go to a child of their own.
+
+Postgres (as of 9.4) doesn't route rows inserted into the parent,
+so the ETL inserts into each child directly.
+"""
+
+from logging import getLogger
+
+from sqlalchemy import Column, MetaData, Table, and_, func
+
+from plenario.database import postgres_engine
+from plenario.etl.common import PlenarioETLError
+from plenario.utils.cells import cell_column_names
+
+logger = getLogger(__name__)
+
+PARTITION_UNITS = ('month', 'year')
+
+
+def partition_bounds(unit, start):
+    """
+    :param unit: 'month' or 'year'
+    :param start: datetime at the start of a partition's range
+    :return: (start, end) of the range, end exclusive
+    """
+    if unit == 'year':
+        return start, start.replace(year=start.year + 1)
+    if start.month == 12:
+        return start, start.replace(year=start.year + 1, month=1)
+    return start, start.replace(month=start.month + 1)
+
+
+def partition_name(table_name, unit, start):
+    """Name of the child holding the range starting at start, or null point_dates if start is None."""
+    if start is None:
+        return '{}_pnull'.format(table_name)
+    if unit == 'year':
+        return '{}_p{:%Y}'.format(table_name, start)
+    return '{}_p{:%Y_%m}'.format(table_name, start)
+
+
+def drop_point_table(table_name):
+    """Drop a point table along with any partitions."""
+    postgres_engine.execute('DROP TABLE IF EXISTS "{}" CASCADE'.format(table_name))
+
+
+def create_partition(parent, unit, start, bind=postgres_engine, cell_columns=()):
+    """
+    Create the child of parent for the range starting at start,
+    with the same indexes a monolithic point table has,
+    unless it exists already.
+    :param parent: name of the parent table
+    :param start: datetime at the start of the range, or None for null point_dates
+    :param bind: engine or connection to create it over
+    :param cell_columns: names of the parent's grid cell key columns
+    :return: name of the child
+    """
+    name = partition_name(parent, unit, start)
+    if bind.run_callable(bind.dialect.has_table, name):
+        return name
+
+    if start is None:
+        check = 'point_date IS NULL'
+    else:
+        lower, upper = partition_bounds(unit, start)
+        check = "point_date >= '{}' AND point_date < '{}'".format(lower.isoformat(), upper.isoformat())
+
+    logger.info('Creating partition {}'.format(name))
+    create = '''
+    CREATE TABLE "{name}" (CHECK ({check})) INHERITS ("{parent}");
+    ALTER TABLE "{name}" ADD PRIMARY KEY (hash);
+    CREATE INDEX "ix_{name}_point_date" ON "{name}" (point_date);
+    CREATE INDEX "ix_{name}_geom" ON "{name}" USING GIST (geom);
+    '''.format(name=name, parent=parent, check=check)
+    for column in cell_columns:
+        create += 'CREATE INDEX "ix_{n}_{c}" ON "{n}" (point_date, {c});\n'.format(n=name, c=column)
+
+    try:
+        bind.execute(create)
+    except Exception as e:
+        raise PlenarioETLError(repr(e) + '\n Failed to create partition ' + name)
+    return name
+
+
+def insert_into_partitions(parent, sel_cols, sel, point_date, unit, bind=postgres_engine):
+    """
+    Insert the rows of a select into the children of parent,
+    creating children as needed.
+    :param parent: Table of the parent
+    :param sel_cols: columns of sel, named like the parent's columns
+    :param sel: select of the rows to insert
+    :param point_date: column of sel with each row's point_date
+    :param unit: 'month' or 'year'
+    :param bind: engine or connection to insert over
+    :return: number of rows inserted
+    """
+
+    logger.info('Begin (parent: {}, unit: {})'.format(parent.name, unit))
+    period = func.date_trunc(unit, point_date)
+    starts = [row[0] for row in bind.execute(sel.with_only_columns([period]).distinct())]
+
+    inserted = 0
+    cell_columns = cell_column_names(parent)
+    for start in starts:
+        name = create_partition(parent.name, unit, start, bind, cell_columns)
+        child = Table(name, MetaData(), *[Column(c.name, c.type) for c in parent.columns])
+
+        if start is None:
+            where = point_date == None
+        else:
+            lower, upper = partition_bounds(unit, start)
+            where = and_(point_date >= lower, point_date < upper)
+
+        ins = child.insert().from_select(sel_cols, sel.where(where))
+        try:
+            inserted += bind.execute(ins).rowcount
+        except Exception as e:
+            raise PlenarioETLError(repr(e) + '\n Failed on statement: ' + str(ins))
+    logger.info('End.')
+    return inserted
@@ -2,26 +2,72 @@
 
 # from csvkit.unicsv import UnicodeCSVReader
 import csv
+import itertools
+from datetime import datetime
 from logging import getLogger
 from geoalchemy2 import Geometry
-from sqlalchemy import TIMESTAMP, Table, Column, MetaData, String
-from sqlalchemy import select, func
+from sqlalchemy import BigInteger, TIMESTAMP, Table, Column, MetaData, String
+from sqlalchemy import Boolean, Date, Float, Integer
+from sqlalchemy import cast, exists, select, func
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import NoSuchTableError
 
 from plenario.database import postgres_base, postgres_engine
 from plenario.database import postgres_session
-from plenario.etl.common import ETLFile, add_unique_hash, PlenarioETLError, delete_absent_hashes
-from plenario.utils.helpers import iter_column, slugify
+from plenario.settings import ETL_CHECKPOINT_ROWS, ETL_COPY_WORKERS, ETL_DOWNLOAD_CACHE_DIR, \
+    ETL_CELL_COUNT_RESOLUTION, ETL_GRID_RESOLUTIONS, ETL_MAX_ERROR_RATE, ETL_STREAM_INGEST, ETL_SWAP_TABLES, ETL_UNLOGGED_SCRATCH
+from plenario.etl.common import ETLFile, PlenarioETLError, delete_absent_hashes
+from plenario.etl.common import DigestSet, IteratorFile, RejectLog, copy_csv_parallel, hash_csv_records, \
+    raw_csv_rows
+from plenario.etl.common import swap_tables
+from plenario.etl.layout import optimize_layout, validate_policy
+from plenario.etl.partition import PARTITION_UNITS, drop_point_table, insert_into_partitions
+from plenario.models.CellCount import CellCount
+from plenario.models.DailyCount import DailyCount
+from plenario.models.IngestBatch import IngestBatch
+from plenario.models.IngestState import IngestState
+from plenario.utils.cells import cell_column_name, cell_column_names, cell_key, cell_sizes, record_columns
+from plenario.utils.helpers import iter_columns, sample_csv_rows, slugify
+from plenario.utils.typeinference import infer_column_types, widen_type
 
 logger = getLogger(__name__)
 
+# When streaming a download into COPY, how many rows to hold back
+# for type inference if the dataset doesn't ask for a sample size.
+STREAM_INFERENCE_ROWS = 50000
+
+# Prefix of the table an update builds before swapping it in for the live one.
+SWAP_PREFIX = 'swap_'
+
+# (source type, existing type) pairs of columns whose values an update
+# can insert into the existing table as they are, by casting them.
+# Any other change in the source's columns means rebuilding the table.
+WIDENINGS = {
+    ('INTEGER', 'BIGINT'),
+    ('INTEGER', 'DOUBLE PRECISION'),
+    ('BIGINT', 'DOUBLE PRECISION'),
+    ('DATE', 'TIMESTAMP WITHOUT TIME ZONE'),
+}
+
+# Staging and n_ tables are dropped after every ingest,
+# so don't spend WAL on them. They're shared between connections,
+# so they can't be temporary tables.
+SCRATCH_TABLE_PREFIXES = ['UNLOGGED'] if ETL_UNLOGGED_SCRATCH else []
+
 
 class PlenarioETL(object):
-    def __init__(self, metadata, source_path=None):
+    def __init__(self, metadata, source_path=None, sample_size=None, stream=None, workers=None):
         """
         :param metadata: MetaTable instance of dataset being ETL'd.
         :param source_path: If provided, get source CSV from local filesystem
                             instead of URL in metadata.
+        :param sample_size: If provided, infer column types from this many
+                            sampled rows instead of the whole source.
+                            Overrides metadata.inference_sample_size.
+        :param stream: If True, pipe a remote source straight into COPY
+                       as it downloads. Defaults to settings.ETL_STREAM_INGEST.
+        :param workers: Number of connections to COPY the source over.
+                        Defaults to settings.ETL_COPY_WORKERS.
         """
 
         logger.info('Begin.')
@@ -32,7 +78,17 @@ class PlenarioETL(object):
         # instead of passing around the unwieldy metadata object to ETL objects.
         # Type of namedtuple('Dataset', 'name date lat lon loc')
         self.dataset = self.metadata.meta_tuple()
-        self.staging_table = Staging(self.metadata, source_path=source_path)
+        self.partition_by = self.metadata.partition_by
+        if self.partition_by not in (None,) + PARTITION_UNITS:
+            raise PlenarioETLError('Unknown partition_by: {}'.format(self.partition_by))
+        self.layout_policy = self.metadata.layout_policy
+        validate_policy(self.layout_policy)
+        self.staging_table = Staging(self.metadata, source_path=source_path,
+                                     sample_size=sample_size, stream=stream,
+                                     workers=workers)
+        # Records an incremental update inserted and deleted, once it's done
+        self.inserted = None
+        self.deleted = None
         logger.info('End.')
 
     def add(self):
@@ -40,14 +96,173 @@ class PlenarioETL(object):
         Create point table for the first time.
         """
         logger.info('Begin.')
-        with self.staging_table as s_table:
-            new_table = Creation(s_table.table, self.dataset).table
-        update_meta(self.metadata, new_table)
+        new_table = self._ingest()
         logger.info('End.')
         return new_table
 
-    def update(self):
-        self.add()
+    def update(self, full_meta=False, swap=None):
+        """
+        Bring the point table in line with the current source,
+        unless the source hasn't changed since the last ingest.
+        Records new to the source are inserted and records gone from it
+        are deleted. If there's no point table yet, create it.
+        :param full_meta: If True, recompute the dataset's time range
+                          and bounding box from the whole table.
+                          Otherwise, only widen them to cover new records,
+                          so they can overstate the extent after deletions.
+        :param swap: If True, leave the live table alone and build a new one,
+                     indexed and analyzed, then swap it in.
+                     Readers never wait on the update's writes, only on the swap.
+                     What changed is still logged against the table it replaces.
+                     Defaults to settings.ETL_SWAP_TABLES.
+        :return: whether the point table was written to,
+                 False if the source was unchanged
+        """
+        logger.info('Begin.')
+        swap = ETL_SWAP_TABLES if swap is None else swap
+        try:
+            existing = self.metadata.point_table
+        except NoSuchTableError:
+            existing = None
+
+        # With no table to keep, load the source whether or not it changed.
+        self.staging_table.skip_unchanged = existing is not None
+        table = self._ingest(existing, full_meta, swap)
+        logger.info('End.')
+        return table is not None
+
+    def _ingest(self, existing=None, full_meta=True, swap=False):
+        with self.staging_table as s_table:
+            # Streamed sources only get their digest once they're loaded,
+            # so check again before touching the point table.
+            if s_table.table is None or (s_table.skip_unchanged and s_table.file_helper.unchanged):
+                logger.info('Source unchanged since the last ingest, nothing to do.')
+                return None
+
+            if existing is not None:
+                # The staging table's columns are inferred from the source anew,
+                # so a column can have come or gone, or changed type.
+                changes = column_changes(s_table.table, existing)
+                if changes:
+                    logger.info('Columns of {} changed ({}), rebuilding it.'.format(
+                        self.dataset.name, '; '.join(changes)))
+                    existing, full_meta, swap = None, True, True
+
+            if swap:
+                name = SWAP_PREFIX + self.dataset.name
+                created = Creation(s_table.table, self.dataset, self.partition_by, name=name,
+                                   grid_resolutions=ETL_GRID_RESOLUTIONS)
+                self.metadata.grid_cells = created.grid_cells
+                # Reorganize before the swap, while no one's reading the table.
+                self._optimize_layout(name)
+
+                def log_swap(connection):
+                    # The live table is still there to compare against.
+                    if existing is None:
+                        self._log_full_batch(connection, created.count)
+                    else:
+                        self._log_delta_batch(connection, existing.name, name)
+                    # Readers see the new counts along with the new table.
+                    self._count_days(connection, name, created.table)
+
+                swap_tables(self.dataset.name, name, log_swap)
+                self._forget_point_table()
+                new_table = Table(self.dataset.name, MetaData(), autoload_with=postgres_engine)
+                # Saved along with the rest of the metadata, now that the source is in.
+                s_table.file_helper.save_validators(self.metadata)
+                update_meta(self.metadata, new_table)
+                return new_table
+
+            if existing is None:
+                created = Creation(s_table.table, self.dataset, self.partition_by,
+                                   grid_resolutions=ETL_GRID_RESOLUTIONS)
+                self.metadata.grid_cells = created.grid_cells
+                with postgres_engine.begin() as connection:
+                    self._log_full_batch(connection, created.count)
+                    self._count_days(connection, self.dataset.name, created.table)
+                self._optimize_layout(self.dataset.name)
+                new_table = created.table
+                s_table.file_helper.save_validators(self.metadata)
+                update_meta(self.metadata, new_table)
+                return new_table
+
+            with Update(s_table.table, self.dataset, existing, self.partition_by) as new:
+                # Readers see the inserts and deletes land together,
+                # along with the log of what they changed and the daily counts.
+                counted = self.metadata.daily_counts
+                cell_column = self._cell_count_column(existing)
+                celled = counted and cell_column is not None and \
+                    self.metadata.cell_counts == ETL_CELL_COUNT_RESOLUTION
+                with postgres_engine.begin() as connection:
+                    batch = IngestBatch.begin(connection, self.dataset.name)
+                    self.inserted = new.insert(connection, cell_sizes(self.metadata.grid_cells))
+                    IngestBatch.log_added(connection, batch, new.name)
+                    if counted:
+                        DailyCount.add(connection, self.dataset.name, new.name)
+                    if celled:
+                        CellCount.add(connection, self.dataset.name, existing.name, new.name, cell_column)
+                    self.deleted = delete_absent_hashes(s_table.name, existing.name, connection, batch,
+                                                        self.dataset.name if counted else None,
+                                                        cell_column if celled else None)
+                    # Ingested before the dataset had its counts kept.
+                    if not counted:
+                        DailyCount.rebuild(connection, self.dataset.name, existing.name)
+                    if cell_column is not None and not celled:
+                        CellCount.rebuild(connection, self.dataset.name, existing.name, cell_column)
+                    IngestBatch.finish(connection, batch, self.inserted, self.deleted)
+                self.metadata.daily_counts = True
+                self.metadata.cell_counts = ETL_CELL_COUNT_RESOLUTION if cell_column else None
+                logger.info('{}: inserted {}, deleted {}'.format(self.dataset.name, self.inserted, self.deleted))
+                self._optimize_layout(existing.name)
+                s_table.file_helper.save_validators(self.metadata)
+                update_meta(self.metadata, existing, delta=None if full_meta else new.table)
+            return existing
+
+    def _forget_point_table(self):
+        """The point table was replaced, maybe with other columns, so reflect it anew when it's next needed."""
+        table = self.metadata.__dict__.pop('_point_table', None)
+        if table is not None:
+            postgres_base.metadata.remove(table)
+
+    def _optimize_layout(self, table_name):
+        """
+        Apply the dataset's layout policy, if it has one, and keep the query
+        timings on the metadata for update_meta to save. The records are in
+        by now, so a failure here is logged rather than failing the ingest.
+        """
+        if not self.layout_policy:
+            return
+        try:
+            self.metadata.layout_timings = optimize_layout(table_name, self.layout_policy)
+        except PlenarioETLError as e:
+            logger.error('Layout optimization of {} failed: {}'.format(table_name, e))
+
+    def _count_days(self, connection, table_name, table):
+        """Count the records of a table built from scratch by day, and cell if it can, for timeseries."""
+        cell_column = self._cell_count_column(table)
+        DailyCount.rebuild(connection, self.dataset.name, table_name)
+        if cell_column is not None:
+            CellCount.rebuild(connection, self.dataset.name, table_name, cell_column)
+        self.metadata.daily_counts = True
+        self.metadata.cell_counts = ETL_CELL_COUNT_RESOLUTION if cell_column else None
+
+    @staticmethod
+    def _cell_count_column(table):
+        """The cell key column CellCounts are kept by, if the point table has it."""
+        name = cell_column_name(ETL_CELL_COUNT_RESOLUTION)
+        return name if name in table.c else None
+
+    def _log_full_batch(self, connection, count):
+        """Log a batch that built the table from scratch, without a delta."""
+        batch = IngestBatch.begin(connection, self.dataset.name, full=True)
+        IngestBatch.finish(connection, batch, count, None)
+
+    def _log_delta_batch(self, connection, live_name, new_name):
+        """Log a batch that rebuilt the table as new_name, as its delta against the live table."""
+        batch = IngestBatch.begin(connection, self.dataset.name)
+        self.inserted, self.deleted = IngestBatch.log_delta(connection, batch, live_name, new_name)
+        IngestBatch.finish(connection, batch, self.inserted, self.deleted)
+        logger.info('{}: inserted {}, deleted {}'.format(self.dataset.name, self.inserted, self.deleted))
 
 
 class Staging(object):
@@ -57,11 +272,28 @@ class Staging(object):
     or insert records from it into an existing point table.
     """
 
-    def __init__(self, meta, source_path=None):
+    def __init__(self, meta, source_path=None, sample_size=None, stream=None, workers=None):
         """
         :param meta: record from MetaTable
         :param source_path: path of source file on local filesystem
                             if None, look for data at a remote URL instead
+        :param sample_size: number of rows to infer column types from.
+                            Rows past the sample are type checked during COPY
+                            and columns are widened as needed.
+                            If None, fall back to meta.inference_sample_size,
+                            and if that's unset too, scan every row.
+        :param stream: if True, don't download a remote source to disk.
+                       Types are inferred from the first sample_size
+                       (or STREAM_INFERENCE_ROWS) rows and the download
+                       is fed into COPY as it arrives. If a column turns
+                       out to be text past those rows, the source is
+                       downloaded after all and loaded from the top.
+                       If None, use settings.ETL_STREAM_INGEST.
+        :param workers: number of connections to COPY over in parallel,
+                        each taking its own range of the source file.
+                        Only applies when every row was scanned for types,
+                        since sampled and streamed loads may need to stop
+                        and widen a column, and to uncompressed sources. If None, use settings.ETL_COPY_WORKERS.
         """
         # Just the info about column names we usually need
         logger.info('Begin.')
@@ -69,6 +301,18 @@ class Staging(object):
         logger.info('source_path: {}'.format(source_path))
         self.dataset = meta.meta_tuple()
         self.name = 's_' + self.dataset.name
+        # Malformed records are set aside here instead of failing the COPY
+        self.rejects_name = 'r_' + self.dataset.name
+        self.rejects = RejectLog()
+        self.sample_size = sample_size or meta.inference_sample_size
+        self.workers = workers or ETL_COPY_WORKERS
+        # If True, don't build the table when the source is the same
+        # as at the last ingest. self.table is None in that case.
+        self.skip_unchanged = False
+        self.table = None
+        # Set when the load is checkpointed (see _copy_checkpointed)
+        self.source_key = None
+        self.resume = None
 
         # Get the Columns to construct our table
         try:
@@ -80,9 +324,15 @@ class Staging(object):
         # Retrieve the source file
         try:
             if source_path:  # Local ingest
-                self.file_helper = ETLFile(source_path=source_path)
+                self.file_helper = ETLFile(source_path=source_path,
+                                           digest=meta.source_digest)
             else:  # Remote ingest
-                self.file_helper = ETLFile(source_url=meta.source_url)
+                stream = ETL_STREAM_INGEST if stream is None else stream
+                self.file_helper = ETLFile(source_url=meta.source_url, stream=stream,
+                                           etag=meta.source_etag,
+                                           last_modified=meta.source_last_modified,
+                                           digest=meta.source_digest,
+                                           cache_dir=ETL_DOWNLOAD_CACHE_DIR)
         except Exception as e:
             raise PlenarioETLError(e)
 
@@ -90,14 +340,52 @@ class Staging(object):
         """Create the staging table. Will be named s_[dataset_name]"""
 
         logger.info('Begin.')
+        try:
+            return self._load()
+        except _StreamRestart as e:
+            logger.info('{}, downloading the source to start over.'.format(e))
+            self.file_helper = self.file_helper.downloaded()
+            self.rejects = RejectLog()
+            return self._load()
+
+    def _load(self):
+        # Only ask the server whether the source changed if we'd skip it.
+        self.file_helper.conditional = self.skip_unchanged
         with self.file_helper as helper:
-            text_handle = open(helper.handle.name, "rt", encoding='utf-8')
-            self.cols = self._from_inference(text_handle)
+            # A streamed source can only be compared by digest once it's read,
+            # so up front we only know when the server says it's unchanged.
+            if self.skip_unchanged and helper.unchanged:
+                return self
+
+            records = None
+            if helper.is_stream:
+                text_handle = helper.handle
+                self.cols, records = self._from_stream(
+                    text_handle, self.sample_size or STREAM_INFERENCE_ROWS, self.rejects)
+            else:
+                text_handle = helper.open_text()
+                if helper.compression and self.workers > 1:
+                    # Byte ranges of a compressed file aren't ranges of the CSV.
+                    logger.info('Copying compressed source over one connection.')
+                    self.workers = 1
+                if ETL_CHECKPOINT_ROWS and not self.sample_size and self.workers <= 1:
+                    self.source_key = helper.source_key
+                    self.resume = self._resume_state()
+
+                if self.resume is not None:
+                    self.cols = self._from_staging()
+                elif self.sample_size and helper.compression:
+                    # Seeking to random offsets would decompress from the top
+                    # every time, so sample the head like a stream instead.
+                    self.cols, _ = self._from_stream(text_handle, self.sample_size)
+                elif self.sample_size:
+                    self.cols = self._from_sample(text_handle, self.sample_size)
+                else:
+                    self.cols = self._from_inference(text_handle)
 
             # Grab the handle to build a table from the CSV
             try:
-                self.table = self._make_table(text_handle)
-                add_unique_hash(self.table.name)
+                self.table = self._make_table(text_handle, records)
                 self.table = Table(
                     self.name,
                     postgres_base.metadata,
@@ -105,6 +393,8 @@ class Staging(object):
                     extend_existing=True
                 )
                 return self
+            except _StreamRestart:
+                raise
             except Exception as e:
                 raise PlenarioETLError(e)
         logger.info('End.')
@@ -116,37 +406,73 @@ class Staging(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
         Drop the staging table if it's been created.
+        If the ingest failed after a checkpointed load, keep it
+        (along with any cached download) for the next attempt.
         """
+        if exc_type is not None and self.source_key:
+            logger.info('Keeping {} to resume from.'.format(self.name))
+            return
         self._drop()
+        if self.source_key:
+            IngestState.clear(self.dataset.name)
+        self.file_helper.discard_cache()
 
-    def _make_table(self, f):
+    def _make_table(self, f, records=None):
         """
         Create a table and fill it with CSV data.
+        The md5 hash of each record is computed as it's fed to COPY
+        and duplicate records are dropped on the way,
+        so the table is written once with hash as its primary key.
         :param f: Open file handle pointing to start of CSV
+        :param records: When streaming, (row, raw) pairs of every record
+                        past the header, since f can't be rewound
         :return: populated table
         """
         # Persist an empty table eagerly
         # so that we can access it when we drop down to a raw connection.
 
         # Be paranoid and remove the table if one by this name already exists.
-        table = Table(self.name, MetaData(), *self.cols, extend_existing=True)
-        self._drop()
-        table.create(bind=postgres_engine)
-
-        # Fill in the columns we expect from the CSV.
-        names = ['"' + c.name + '"' for c in self.cols]
-        copy_st = "COPY {t_name} ({cols}) FROM STDIN " \
-                  "WITH (FORMAT CSV, HEADER TRUE, DELIMITER ',')".\
-            format(t_name=self.name, cols=', '.join(names))
+        table = Table(self.name, MetaData(), *self.cols,
+                      Column('hash', String(32)), extend_existing=True,
+                      prefixes=SCRATCH_TABLE_PREFIXES)
+        if self.resume is None:
+            self._drop()
+            table.create(bind=postgres_engine)
+            postgres_engine.execute('DROP TABLE IF EXISTS "{}"'.format(self.rejects_name))
 
         # In order to issue a COPY, we need to drop down to the psycopg2 DBAPI.
         conn = postgres_engine.raw_connection()
         try:
-            with conn.cursor() as cursor:
-                f.seek(0)
-                cursor.copy_expert(copy_st, f)
+            with conn.cursor() as cursor, DigestSet() as digests:
+                if records is None and not self.sample_size:
+                    # Inference saw every value, but COPY is stricter about some
+                    # (null tokens, 1,000 as an integer). Set those records aside.
+                    self.rejects.types = [_checked_type(c) for c in self.cols]
+                if records is not None:
+                    self._copy_with_widening(cursor, records, digests)
+                elif self.source_key:
+                    self._copy_checkpointed(conn, cursor, f, digests)
+                elif self.sample_size:
+                    self._copy_with_widening(cursor, self._records(f), digests,
+                                             reload=lambda: self._records(f))
+                elif self.workers > 1:
+                    self.rejects.width = len(self.cols)
+                    copy_csv_parallel(f.name, self._copy_statement(), digests, self.workers,
+                                      self.rejects)
+                else:
+                    hashed = hash_csv_records(self._records(f), digests)
+                    cursor.copy_expert(self._copy_statement(), IteratorFile(hashed))
+                self._check_rejects(conn, cursor)
+                # Build the index once, after the rows are in.
+                if self.resume is None or not self.resume.complete:
+                    cursor.execute('ALTER TABLE "{}" ADD PRIMARY KEY (hash)'.format(self.name))
+                if self.source_key:
+                    IngestState.save(cursor, self.dataset.name, self.source_key,
+                                     f.tell(), self.rejects.line, self._rows_committed, complete=True)
                 conn.commit()
                 return table
+        except PlenarioETLError:
+            raise
         except Exception as e:
             # When the bulk copy fails on _any_ row,
             # roll back the entire operation.
@@ -154,6 +480,172 @@ class Staging(object):
         finally:
             conn.close()
 
+    def _check_rejects(self, conn, cursor):
+        """
+        Save the records rejected so far to the rejects table, and abort
+        (keeping them) if they're more than ETL_MAX_ERROR_RATE of the source.
+        """
+        self.rejects.save(cursor, self.rejects_name)
+        accepted, rejected = self.rejects.counts
+        if not rejected:
+            return
+        message = 'Rejected {} of {} records of {} ({:.2%}), see table {}'.format(
+            rejected, accepted + rejected, self.dataset.name, self.rejects.error_rate, self.rejects_name)
+        if self.rejects.error_rate > ETL_MAX_ERROR_RATE:
+            conn.commit()
+            raise PlenarioETLError(message + ', which is over ETL_MAX_ERROR_RATE')
+        logger.warning(message)
+
+    def _copy_statement(self):
+        # Fill in the columns we expect from the CSV,
+        # followed by the hash we tack on to each record.
+        names = ['"' + c.name + '"' for c in self.cols] + ['"hash"']
+        return "COPY {t_name} ({cols}) FROM STDIN " \
+               "WITH (FORMAT CSV, HEADER FALSE, DELIMITER ',')".\
+            format(t_name=self.name, cols=', '.join(names))
+
+    def _copy_with_widening(self, cursor, records, digests, reload=None):
+        """
+        COPY records whose column types were inferred from a sample.
+        Every value is checked against its column's type on the way in.
+        When one doesn't fit, the COPY is cut short before that record,
+        the column is widened with ALTER COLUMN ... TYPE,
+        and a new COPY picks up from the offending record.
+        :param cursor: psycopg2 cursor, committed by the caller
+        :param records: (row, raw) pairs of every record past the header
+        :param digests: DigestSet of the records copied so far
+        :param reload: callable returning fresh records from the start,
+                       or None if the source can only be read once.
+                       Then a column that turns out to be text
+                       raises _StreamRestart.
+        """
+        types = [type(c.type) for c in self.cols]
+
+        while True:
+            checked = _TypeCheckedRecords(records, types)
+            hashed = hash_csv_records(checked, digests)
+            cursor.copy_expert(self._copy_statement(), IteratorFile(hashed))
+            if checked.violation is None:
+                return
+
+            idx, new_type, record = checked.violation
+            col = self.cols[idx]
+            if new_type is String and reload is None:
+                # Loaded values would read back in Postgres' text form
+                # (true for yes, 1.5 for 1.50) rather than as written,
+                # and a stream can't be read again to load them as strings.
+                raise _StreamRestart('Streamed column {} turned out to be text'.format(col.name))
+            logger.info('Widening {} from {} to {}'.format(
+                col.name, types[idx].__name__, new_type.__name__))
+
+            sql_type = new_type().compile(dialect=postgres_engine.dialect)
+            cursor.execute('ALTER TABLE "{t}" ALTER COLUMN "{c}" TYPE {type} '
+                           'USING "{c}"::text::{type}'.
+                           format(t=self.name, c=col.name, type=sql_type))
+            types[idx] = new_type
+            self.cols[idx] = _make_col(col.name, new_type, True)
+
+            if new_type is String:
+                # Reload everything as strings, as written in the source.
+                cursor.execute('TRUNCATE "{}"'.format(self.name))
+                digests.close()
+                records = reload()
+            else:
+                records = itertools.chain([record], records)
+
+    def _copy_checkpointed(self, conn, cursor, f, digests):
+        """
+        COPY the records of f in chunks of ETL_CHECKPOINT_ROWS,
+        committing each along with how far into f it got,
+        so that a failed ingest can resume after the last chunk.
+        :param conn: psycopg2 connection the cursor belongs to
+        :param f: text file of the CSV source
+        :param digests: DigestSet for the records copied so far
+        """
+        state = self.resume
+        if state is not None:
+            # Count what the earlier attempt loaded and rejected towards the error rate.
+            self.rejects = RejectLog(len(self.cols), state.line_number, self.rejects.types)
+            self.rejects.accepted = state.rows_committed
+            if postgres_engine.has_table(self.rejects_name):
+                self.rejects.rejected = postgres_engine.execute(
+                    'SELECT count(*) FROM "{}"'.format(self.rejects_name)).scalar()
+            self._rows_committed = state.rows_committed
+            if state.complete:
+                return
+
+        if state is None:
+            f.seek(0)
+            self._rows_committed = 0
+        else:
+            logger.info('Resuming {} after {} rows'.format(self.name, state.rows_committed))
+            cursor.execute('SELECT hash FROM "{}"'.format(self.name))
+            for digest, in cursor:
+                digests.add(bytes.fromhex(digest))
+            f.seek(state.byte_offset)
+
+        # Read with readline rather than iterating, so that f.tell() works between chunks.
+        records = raw_csv_rows(iter(f.readline, ''), self.rejects)
+        if state is None:
+            next(records, None)
+
+        while True:
+            taken = [0, 0]
+
+            def chunk():
+                for record in itertools.islice(records, ETL_CHECKPOINT_ROWS):
+                    taken[0] += 1
+                    yield record
+
+            def counted(lines):
+                for line in lines:
+                    taken[1] += 1
+                    yield line
+
+            hashed = counted(hash_csv_records(chunk(), digests))
+            cursor.copy_expert(self._copy_statement(), IteratorFile(hashed))
+            if not taken[0]:
+                return
+            self._rows_committed += taken[1]
+            self.rejects.save(cursor, self.rejects_name)
+            IngestState.save(cursor, self.dataset.name, self.source_key,
+                             f.tell(), self.rejects.line, self._rows_committed)
+            conn.commit()
+
+    def _resume_state(self):
+        """
+        The IngestState of an earlier, failed load of the same source
+        into a staging table that's still around, or None.
+        """
+        if self.source_key is None:
+            return None
+        state = IngestState.get(self.dataset.name)
+        if state is None or state.source_key != self.source_key:
+            return None
+        if not postgres_engine.has_table(self.name):
+            return None
+        count = postgres_engine.execute('SELECT count(*) FROM "{}"'.format(self.name)).scalar()
+        if count != state.rows_committed:
+            # An unlogged table comes back empty after a crash.
+            return None
+        return state
+
+    def _from_staging(self):
+        """Generate columns from a staging table left by a failed load."""
+        staging = Table(self.name, MetaData(), autoload_with=postgres_engine)
+        return [_copy_col(c) for c in staging.columns if c.name != 'hash']
+
+    def _records(self, f):
+        """
+        (row, raw) pairs for every record of f past the header.
+        Malformed records go to self.rejects, which starts over with them.
+        """
+        f.seek(0)
+        self.rejects.reset()
+        records = raw_csv_rows(f, self.rejects)
+        next(records)
+        return records
+
     '''Utility methods to generate columns
     into which we can dump the CSV data.'''
 
@@ -168,7 +660,7 @@ class Staging(object):
         # Don't include the geom and point_date columns.
         # They're derived from the source data
         # and won't be present in the source CSV
-        original_cols = [c for c in ingested_cols if c.name not in ['geom', 'point_date', 'hash']]
+        original_cols = [c for c in record_columns(ingested_cols) if c.name not in ['geom', 'point_date', 'hash']]
         # Make copies that don't refer to the existing table.
         cols = [_copy_col(c) for c in original_cols]
 
@@ -184,20 +676,132 @@ class Staging(object):
         header = list(map(slugify, next(reader)))
 
         cols = []
-        for col_idx, col_name in enumerate(header):
-            col_type, nullable = iter_column(col_idx, f)
+        for col_name, (col_type, nullable) in zip(header, iter_columns(f)):
             cols.append(_make_col(col_name, col_type, nullable))
 
         logger.info('End.')
         return cols
 
 
-def _null_malformed_geoms(existing):
+    @staticmethod
+    def _from_sample(f, sample_size):
+        """Generate columns by inferring column types from a sample of the CSV.
+        Columns are all nullable, since the sample can't rule out nulls."""
+
+        logger.info('Begin.')
+        header, rows = sample_csv_rows(f, sample_size)
+        header = list(map(slugify, header))
+
+        cols = []
+        for col_name, (col_type, _) in zip(header, infer_column_types(rows, len(header))):
+            cols.append(_make_col(col_name, col_type, True))
+
+        logger.info('End.')
+        return cols
+
+
+    @staticmethod
+    def _from_stream(f, head_size, rejects=None):
+        """Generate columns from the first rows of a forward-only stream.
+        :param rejects: RejectLog to set malformed records aside in
+        :return: (columns, records) where records yields (row, raw) pairs
+                 for every record past the header, held back rows included."""
+
+        logger.info('Begin.')
+        records = raw_csv_rows(f, rejects)
+        header, _ = next(records)
+        header = list(map(slugify, header))
+        head = list(itertools.islice(records, head_size))
+
+        cols = []
+        rows = (row for row, _ in head)
+        for col_name, (col_type, _) in zip(header, infer_column_types(rows, len(header))):
+            cols.append(_make_col(col_name, col_type, True))
+
+        logger.info('End.')
+        return cols, itertools.chain(head, records)
+
+
+class _StreamRestart(PlenarioETLError):
+    """A streamed load that can't go on, and has to start over from a download."""
+
+
+class _TypeCheckedRecords(object):
+    """
+    Iterate over (row, raw) CSV records for as long as their values fit
+    the given column types. Stops at the first value that doesn't, leaving
+    (column index, widened type, offending record) in self.violation.
+    """
+
+    def __init__(self, records, types):
+        self.records = records
+        self.types = types
+        self.violation = None
+
+    def __iter__(self):
+        types = self.types
+        for record in self.records:
+            row, raw = record
+            if not row:
+                # Blank lines would trip up COPY.
+                continue
+            for idx, (type_, value) in enumerate(zip(types, row)):
+                if type_ is String:
+                    continue
+                new_type = widen_type(type_, value)
+                if new_type is not type_:
+                    self.violation = (idx, new_type, record)
+                    return
+            yield record
+
+
+def column_changes(staging, existing):
+    """
+    :param staging: Table with data from CSV
+    :param existing: point table the staging records would be inserted into
+    :return: ['name: old type -> new type'] of the columns that differ
+             in ways inserting the records can't absorb, see WIDENINGS
+    """
+    source = {c.name: _sql_type(c) for c in staging.columns if c.name != 'hash'}
+    target = {c.name: _sql_type(c) for c in record_columns(existing.columns)
+              if c.name not in {'geom', 'point_date', 'hash'}}
+    changes = []
+    for name in sorted(set(source) | set(target)):
+        new, old = source.get(name), target.get(name)
+        if new != old and (new, old) not in WIDENINGS:
+            changes.append('{}: {} -> {}'.format(name, old, new))
+    return changes
+
+
+def _sql_type(col):
+    return col.type.compile(dialect=postgres_engine.dialect)
+
+
+def _checked_type(col):
+    """The type typeinference would give col, whether inferred or reflected."""
+    for type_ in (BigInteger, Integer, Float, Boolean,
+                  postgresql.TIMESTAMP, Date, postgresql.TIME):
+        if isinstance(col.type, type_):
+            return type_
+    return String
+
+
+def _null_malformed_geoms(table, bind=postgres_engine):
     # We decide to set the geom to NULL when the given lon/lat is (0,0)
     # (off the coast of Africa).
-    upd = existing.update().values(geom=None).\
-        where(existing.c.geom == select([func.ST_SetSRID(func.ST_MakePoint(0, 0), 4326)]))
-    postgres_engine.execute(upd)
+    nulls = {name: None for name in cell_column_names(table)}
+    upd = table.update().values(geom=None, **nulls).\
+        where(table.c.geom == select([func.ST_SetSRID(func.ST_MakePoint(0, 0), 4326)]))
+    bind.execute(upd)
+
+
+def _center_latitude(table):
+    """Latitude of the center of the extent of table's geoms, leaving out (0,0)."""
+    geom = table.c.geom
+    extent = cast(func.ST_Extent(geom), Geometry)
+    sel = select([func.ST_Y(func.ST_Centroid(extent))]).\
+        where((func.ST_X(geom) != 0) | (func.ST_Y(geom) != 0))
+    return postgres_engine.execute(sel).scalar() or 0.0
 
 
 def _make_col(name, type, nullable):
@@ -213,24 +817,37 @@ class Creation(object):
     When we're adding a dataset for the first time, create a brand new table
     """
 
-    def __init__(self, staging, dataset):
+    def __init__(self, staging, dataset, partition_by=None, name=None, grid_resolutions=()):
         """
         :param staging: Table with data from CSV
         :param dataset: NamedTuple of dataset metadata
+        :param partition_by: 'month' or 'year' to split the table
+                             into partitions by point_date
+        :param name: name of the table, if not the dataset's
+        :param grid_resolutions: resolutions (in meters) to give each record
+                                 a /grid cell key at, see plenario.utils.cells
         """
         self.staging = staging
         self.dataset = dataset
+        self.name = name or dataset.name
+        # What to save as MetaTable.grid_cells, if there are cell keys
+        self.grid_cells = None
         # Make a brand spanking new table
-        self.table = self._init_table()
+        self.table = self._init_table(grid_resolutions)
         # And insert data from an Update into it
-        with Update(self.staging, self.dataset, self.table) as new:
+        with Update(self.staging, self.dataset, self.table, partition_by) as new:
+            self.count = new.count
             try:
-                new.insert()
+                if grid_resolutions:
+                    self.grid_cells = {'latitude': _center_latitude(new.table),
+                                       'resolutions': list(grid_resolutions)}
+                new.insert(cells=cell_sizes(self.grid_cells))
+                self._index()
             except Exception as e:
-                self.table.drop(bind=postgres_engine, checkfirst=True)
+                drop_point_table(self.table.name)
                 raise e
 
-    def _init_table(self):
+    def _init_table(self, grid_resolutions=()):
         """
         Make a new table with the original columns from the staging table
         """
@@ -241,17 +858,37 @@ class Creation(object):
         original_cols.append(Column('hash', String(32), primary_key=True))
 
         # We also expect geometry and date columns to be created.
+        # They're indexed once the data is in, see _index.
         derived_cols = [
-            Column('point_date', TIMESTAMP, nullable=True, index=True),
-            Column('geom', Geometry('POINT', srid=4326),
-                   nullable=True, index=True)]
-        new_table = Table(self.dataset.name, MetaData(),
+            Column('point_date', TIMESTAMP, nullable=True),
+            Column('geom', Geometry('POINT', srid=4326), nullable=True)]
+        derived_cols += [Column(cell_column_name(r), BigInteger, nullable=True)
+                         for r in grid_resolutions]
+        new_table = Table(self.name, MetaData(),
                           *(original_cols + derived_cols))
 
-        new_table.drop(postgres_engine, checkfirst=True)
+        drop_point_table(new_table.name)
         new_table.create(postgres_engine)
         return new_table
 
+    def _index(self):
+        """
+        Building indexes in one go after a bulk insert beats
+        updating them row by row, and fresh statistics
+        spare the first queries a bad plan.
+        """
+        index = """CREATE INDEX "ix_{t}_point_date" ON "{t}" (point_date);
+                   CREATE INDEX "ix_{t}_geom" ON "{t}" USING GIST (geom);""".format(t=self.name)
+        # With point_date in front, a /grid count over a date range
+        # can be answered from the index alone.
+        for column in cell_column_names(self.table):
+            index += 'CREATE INDEX "ix_{t}_{c}" ON "{t}" (point_date, {c});'.format(t=self.name, c=column)
+        index += 'ANALYZE "{t}";'.format(t=self.name)
+        try:
+            postgres_engine.execute(index)
+        except Exception as e:
+            raise PlenarioETLError(repr(e) + '\n Failed to index ' + self.name)
+
     def _add_trigger(self):
         add_trigger = """CREATE TRIGGER audit_after AFTER DELETE OR UPDATE
                          ON "{table}"
@@ -264,19 +901,26 @@ class Update(object):
     """
     Create a table that contains the business key, geom, and date
     of all records found in the staging table and not in the existing table.
+    Both tables have their hashes indexed, so finding them is an anti-join
+    that never sorts either table as a whole.
     """
-    def __init__(self, staging, dataset, existing):
+    def __init__(self, staging, dataset, existing, partition_by=None):
         """
 
         :param staging: Table full of CSV data.
         :param dataset: named tuple of type Dataset
+        :param partition_by: 'month' or 'year' if existing is split
+                             into partitions by point_date
         """
         self.staging = staging
         self.dataset = dataset
         self.existing = existing
+        self.partition_by = partition_by
 
         # We'll name it n_table
         self.name = 'n_' + dataset.name
+        # Number of records in it, once it's filled
+        self.count = None
 
         # This table will only have the hash
         # and the two derived columns for space and time.
@@ -284,7 +928,7 @@ class Update(object):
                 _make_col('point_date', TIMESTAMP, True),
                 _make_col('geom', Geometry('POINT', srid=4326), True)]
 
-        self.table = Table(self.name, MetaData(), *cols)
+        self.table = Table(self.name, MetaData(), *cols, prefixes=SCRATCH_TABLE_PREFIXES)
 
     def __enter__(self):
         """
@@ -307,8 +951,7 @@ class Update(object):
         sel = select(cols_to_insert)
         # And limit our results to records
         # whose hashes aren't already present in the existing table.
-        sel = sel.select_from(s.outerjoin(e, s.c['hash'] == e.c['hash'])).\
-            where(e.c['hash'] == None)
+        sel = sel.where(~exists().where(e.c['hash'] == s.c['hash']))
 
         # Drop the table first out of healthy paranoia
         self._drop()
@@ -321,36 +964,56 @@ class Update(object):
         ins = self.table.insert().from_select(cols_to_insert, sel)
         # Populate it with records from our select statement.
         try:
-            postgres_engine.execute(ins)
+            self.count = postgres_engine.execute(ins).rowcount
         except Exception as e:
             raise PlenarioETLError(repr(e) + '\n' + str(sel))
-        else:
-            # Would be nice to check if we have new records or not right here.
-            return self
 
-    def insert(self):
+        # Null out (0,0) geoms here, so they never reach the point table,
+        # its cell keys or the bounding box widened from this table.
+        try:
+            _null_malformed_geoms(self.table)
+        except Exception as e:
+            raise PlenarioETLError(repr(e) +
+                        '\n Failed to null out geoms with (0,0) geocoding')
+        return self
+
+    def insert(self, bind=postgres_engine, cells=None):
         """
         Join with the staging table
         to insert complete records into existing table.
+        :param bind: connection to insert over, to make it part of a transaction
+        :param cells: {resolution: (size_x, size_y)} of the /grid cell keys
+                      to compute for each record, where the existing table has them
+        :return: number of records inserted
         """
+        if not self.count:
+            return 0
+
         derived_cols = [c for c in self.table.c
                         if c.name in {'geom', 'point_date'}]
-        staging_cols = [c for c in self.staging.c]
+        has_cells = set(cell_column_names(self.existing))
+        for resolution, (size_x, size_y) in sorted((cells or {}).items()):
+            name = cell_column_name(resolution)
+            if name in has_cells:
+                derived_cols.append(cell_key(self.table.c.geom, size_x, size_y).label(name))
+        # Cast the source's values where the existing column is wider, see column_changes.
+        staging_cols = [c if c.name not in self.existing.c or _sql_type(c) == _sql_type(self.existing.c[c.name])
+                        else cast(c, self.existing.c[c.name].type).label(c.name)
+                        for c in self.staging.c]
         sel_cols = staging_cols + derived_cols
 
         sel = select(sel_cols).where(self.staging.c.hash == self.table.c.hash)
-        ins = self.existing.insert().from_select(sel_cols, sel)
-
-        try:
-            postgres_engine.execute(ins)
-        except Exception as e:
-            raise PlenarioETLError(repr(e) +
-                                   '\n Failed on statement: ' + str(ins))
-        try:
-            _null_malformed_geoms(self.existing)
-        except Exception as e:
-            raise PlenarioETLError(repr(e) +
-                        '\n Failed to null out geoms with (0,0) geocoding')
+        if self.partition_by:
+            insert_into_partitions(self.existing, sel_cols, sel,
+                                   self.table.c.point_date, self.partition_by, bind)
+        else:
+            ins = self.existing.insert().from_select(sel_cols, sel)
+            try:
+                bind.execute(ins)
+            except Exception as e:
+                raise PlenarioETLError(repr(e) +
+                                       '\n Failed on statement: ' + str(ins))
+        return self.count
 
     def _drop(self):
         postgres_engine.execute("DROP TABLE IF EXISTS {};".format(self.name))
@@ -382,34 +1045,62 @@ class Update(object):
         return geom_col
 
 
-def update_meta(metatable, table):
+def update_meta(metatable, table, delta=None):
     """
     After ingest/update, update the metatable registry to reflect table information.
 
     :param metatable: MetaTable instance to update.
     :param table: Table instance to update from.
+    :param delta: Table holding point_date and geom of only the records
+                  this update inserted (an Update's n_ table).
+                  If given, the stored time range and bounding box are
+                  widened to cover it instead of being recomputed from table.
 
     :returns: None
     """
 
     metatable.update_date_added()
 
-    metatable.obs_from, metatable.obs_to = postgres_session.query(
-        func.min(table.c.point_date),
-        func.max(table.c.point_date)
-    ).first()
-
-    metatable.bbox = postgres_session.query(
-        func.ST_SetSRID(
-            func.ST_Envelope(func.ST_Union(table.c.geom)),
-            4326
-        )
-    ).first()[0]
+    if delta is None or metatable.obs_from is None or metatable.bbox is None:
+        metatable.obs_from, metatable.obs_to, metatable.bbox = _extents(table)
+    else:
+        obs_from, obs_to, bbox = _extents(delta)
+        if obs_from is not None:
+            metatable.obs_from = min(_as_date(metatable.obs_from), _as_date(obs_from))
+            metatable.obs_to = max(_as_date(metatable.obs_to), _as_date(obs_to))
+        if bbox is not None:
+            metatable.bbox = postgres_session.query(
+                func.ST_SetSRID(
+                    func.ST_Envelope(func.ST_Collect(metatable.bbox, bbox)),
+                    4326
+                )
+            ).first()[0]
 
     metatable.column_names = {
-        c.name: str(c.type) for c in metatable.column_info()
+        c.name: str(c.type) for c in record_columns(metatable.column_info())
         if c.name not in {'geom', 'point_date', 'hash'}
     }
 
     postgres_session.add(metatable)
     postgres_session.commit()
+
+
+def _extents(table):
+    """
+    Earliest and latest point_date and bounding box of geom in table.
+    ST_Extent only tracks min and max coordinates as it goes,
+    where ST_Union would build the union of every point first.
+    """
+    return postgres_session.query(
+        func.min(table.c.point_date),
+        func.max(table.c.point_date),
+        func.ST_SetSRID(
+            cast(func.ST_Extent(table.c.geom), Geometry),
+            4326
+        )
+    ).first()
+
+
+def _as_date(d):
+    # obs_from and obs_to are dates, point_date is a timestamp.
+    return d.date() if isinstance(d, datetime) else d
@@ -1,9 +1,8 @@
 import zipfile
 
-from sqlalchemy.exc import ProgrammingError
 from plenario.database import postgres_engine, postgres_session
-from plenario.etl.common import ETLFile, add_unique_hash
-from plenario.utils.shapefile import import_shapefile
+from plenario.etl.common import ETLFile, copy_pgdump_with_hashes, swap_tables
+from plenario.utils.shapefile import Shapefile
 
 
 class ShapeETL:
@@ -15,25 +14,40 @@ class ShapeETL:
         self.meta = meta
 
     def add(self):
+        self._ingest(skip_unchanged=False)
+
+    def update(self):
+        """
+        Re-ingest the shapes, unless the source hasn't changed since the last ingest
+        and the shape table is still there.
+        :return: whether the shape table was replaced
+        """
+        return self._ingest(skip_unchanged=postgres_engine.has_table(self.table_name))
+
+    def _ingest(self, skip_unchanged):
         staging_name = 'staging_{}'.format(self.table_name)
 
-        with ETLFile(self.source_path, self.source_url, interpret_as='bytes') as file_helper:
-            handle = open(file_helper.handle.name, "rb")
+        file_helper = ETLFile(self.source_path, self.source_url, interpret_as='bytes',
+                              etag=self.meta.source_etag,
+                              last_modified=self.meta.source_last_modified,
+                              digest=self.meta.source_digest,
+                              conditional=skip_unchanged)
+        with file_helper:
+            if skip_unchanged and file_helper.unchanged:
+                return False
+
+            postgres_engine.execute('drop table if exists {}'.format(staging_name))
+            # A gzipped or bz2ed archive is decompressed as it's read.
+            handle = file_helper.open_binary(unzip=False)
             with zipfile.ZipFile(handle) as shapefile_zip:
-                import_shapefile(shapefile_zip, staging_name)
-                add_unique_hash(staging_name)
-
-        try:
-            postgres_engine.execute('drop table {}'.format(self.table_name))
-        except ProgrammingError:
-            pass
-
-        rename_table = 'alter table {} rename to {}'
-        rename_table = rename_table.format(staging_name, self.table_name)
-        postgres_engine.execute(rename_table)
-        
+                # Rows are hashed and deduplicated on their way into COPY.
+                with Shapefile(shapefile_zip) as shape:
+                    copy_pgdump_with_hashes(shape.dump(staging_name), staging_name)
+
+        # The staging table comes with its spatial index already built.
+        swap_tables(self.table_name, staging_name)
+
+        file_helper.save_validators(self.meta)
         self.meta.update_after_ingest()
         postgres_session.commit()
-
-    def update(self):
-        self.add()
+        return True
@@ -0,0 +1,78 @@
+from sqlalchemy import BigInteger, Column, Date, String, TIMESTAMP, cast, func, select
+
+from plenario.database import postgres_base, postgres_engine
+from plenario.utils.cells import cell_keys
+
+
+class CellCount(postgres_base):
+    """
+    How many records of a point dataset fall on each day in each grid cell,
+    kept up to date by the ETL alongside DailyCount. Timeseries within a
+    location add up the cells wholly inside it instead of testing every point.
+    """
+    __tablename__ = 'etl_cell_count'
+
+    dataset_name = Column(String(100), primary_key=True)
+    day = Column(Date, primary_key=True)
+    # Key of the square, see plenario.utils.cells
+    cell = Column(BigInteger, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+    @classmethod
+    def rebuild(cls, bind, dataset_name, table_name, cell_column):
+        """
+        Count every record in table_name from scratch.
+        :param bind: engine or connection, to make the rebuild part of a transaction
+        :param cell_column: name of the cell key column to count by
+        """
+        bind.execute(cls.__table__.delete().where(cls.dataset_name == dataset_name))
+        bind.execute('INSERT INTO etl_cell_count (dataset_name, day, cell, count) '
+                     'SELECT %s, point_date::date, {c}, count(*) FROM "{t}" '
+                     'WHERE point_date IS NOT NULL AND {c} IS NOT NULL '
+                     'GROUP BY point_date::date, {c}'.format(t=table_name, c=cell_column),
+                     (dataset_name,))
+
+    @classmethod
+    def add(cls, bind, dataset_name, table_name, new_name, cell_column):
+        """
+        Count the records of table_name whose hashes are in new_name,
+        which were just added to the dataset, onto their days and cells.
+        The cell keys are only known once the records are in table_name.
+        :param bind: engine or connection, to make the counts part of a transaction
+        """
+        bind.execute('''
+            WITH added AS (
+                SELECT e.point_date::date AS day, e.{c} AS cell, count(*) AS n
+                FROM "{t}" AS e JOIN "{n}" AS n ON n.hash = e.hash
+                WHERE e.point_date IS NOT NULL AND e.{c} IS NOT NULL
+                GROUP BY e.point_date::date, e.{c}
+            ), bumped AS (
+                UPDATE etl_cell_count AS d SET count = d.count + a.n
+                FROM added AS a
+                WHERE d.dataset_name = %(name)s AND d.day = a.day AND d.cell = a.cell
+                RETURNING d.day, d.cell
+            )
+            INSERT INTO etl_cell_count (dataset_name, day, cell, count)
+            SELECT %(name)s, day, cell, n FROM added
+            WHERE (day, cell) NOT IN (SELECT day, cell FROM bumped)
+        '''.format(t=table_name, n=new_name, c=cell_column), {'name': dataset_name})
+
+    @classmethod
+    def buckets(cls, dataset_name, agg_unit, first_day, last_day, cells):
+        """
+        Select of the counts of the dataset by agg_unit from the given cells
+        on its days in [first_day, last_day), labeled like MetaTable.timeseries
+        labels its buckets.
+        """
+        bucket = func.date_trunc(agg_unit, cast(cls.day, TIMESTAMP))
+        keys = cell_keys(cells)
+        return select([cast(func.sum(cls.count), BigInteger).label('count'), bucket.label('time_bucket')]).\
+            select_from(cls.__table__.join(keys, cls.cell == keys.c.key)).\
+            where(cls.dataset_name == dataset_name).\
+            where(cls.day >= first_day).\
+            where(cls.day < last_day).\
+            group_by('time_bucket')
+
+    @classmethod
+    def clear(cls, dataset_name):
+        postgres_engine.execute(cls.__table__.delete().where(cls.dataset_name == dataset_name))
@@ -0,0 +1,65 @@
+from sqlalchemy import BigInteger, Column, Date, String, TIMESTAMP, cast, func, select
+
+from plenario.database import postgres_base, postgres_engine
+
+
+class DailyCount(postgres_base):
+    """
+    How many records of a point dataset fall on each day, kept up to date
+    by the ETL, so timeseries without column or location filters can add up
+    days instead of counting the point table.
+    """
+    __tablename__ = 'etl_daily_count'
+
+    dataset_name = Column(String(100), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+    @classmethod
+    def rebuild(cls, bind, dataset_name, table_name):
+        """
+        Count every record in table_name from scratch.
+        :param bind: engine or connection, to make the rebuild part of a transaction
+        """
+        bind.execute(cls.__table__.delete().where(cls.dataset_name == dataset_name))
+        bind.execute('INSERT INTO etl_daily_count (dataset_name, day, count) '
+                     'SELECT %s, point_date::date, count(*) FROM "{}" '
+                     'WHERE point_date IS NOT NULL GROUP BY point_date::date'.format(table_name),
+                     (dataset_name,))
+
+    @classmethod
+    def add(cls, bind, dataset_name, table_name):
+        """
+        Count the records in table_name, which were just added to the dataset,
+        onto the days they fall on.
+        :param bind: engine or connection, to make the counts part of a transaction
+        """
+        bind.execute('''
+            WITH added AS (
+                SELECT point_date::date AS day, count(*) AS n FROM "{}"
+                WHERE point_date IS NOT NULL GROUP BY point_date::date
+            ), bumped AS (
+                UPDATE etl_daily_count AS d SET count = d.count + a.n
+                FROM added AS a WHERE d.dataset_name = %(name)s AND d.day = a.day
+                RETURNING d.day
+            )
+            INSERT INTO etl_daily_count (dataset_name, day, count)
+            SELECT %(name)s, day, n FROM added WHERE day NOT IN (SELECT day FROM bumped)
+        '''.format(table_name), {'name': dataset_name})
+
+    @classmethod
+    def buckets(cls, dataset_name, agg_unit, first_day, last_day):
+        """
+        Select of the counts of the dataset by agg_unit from its days in
+        [first_day, last_day), labeled like MetaTable.timeseries labels its buckets.
+        """
+        bucket = func.date_trunc(agg_unit, cast(cls.day, TIMESTAMP))
+        return select([cast(func.sum(cls.count), BigInteger).label('count'), bucket.label('time_bucket')]).\
+            where(cls.dataset_name == dataset_name).\
+            where(cls.day >= first_day).\
+            where(cls.day < last_day).\
+            group_by('time_bucket')
+
+    @classmethod
+    def clear(cls, dataset_name):
+        postgres_engine.execute(cls.__table__.delete().where(cls.dataset_name == dataset_name))
@@ -0,0 +1,112 @@
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKey, Integer, String, func, select
+
+from plenario.database import postgres_base, postgres_engine
+
+
+class IngestBatch(postgres_base):
+    """
+    One ETL run over a point dataset, with the records it added and removed
+    kept in IngestChange, so clients can ask for what changed since a batch
+    instead of downloading the whole dataset again.
+    """
+    __tablename__ = 'etl_ingest_batch'
+
+    id = Column(Integer, primary_key=True)
+    dataset_name = Column(String(100), nullable=False, index=True)
+    created_at = Column(DateTime, nullable=False)
+    # True when the table was built from scratch, so there's no delta to give
+    full = Column(Boolean, nullable=False)
+    added = Column(BigInteger)
+    removed = Column(BigInteger)
+
+    @classmethod
+    def begin(cls, bind, dataset_name, full=False):
+        """
+        :param bind: engine or connection, to make the batch part of a transaction
+        :return: id of the new batch
+        """
+        ins = cls.__table__.insert().values(dataset_name=dataset_name, created_at=func.now(), full=full)
+        return bind.execute(ins.returning(cls.id)).scalar()
+
+    @classmethod
+    def log_added(cls, bind, batch_id, table_name):
+        """Log every hash in table_name as added in the batch."""
+        bind.execute('INSERT INTO etl_ingest_change (batch_id, hash, removed) '
+                     'SELECT %s, hash, FALSE FROM "{}"'.format(table_name), (batch_id,))
+
+    @classmethod
+    def log_delta(cls, bind, batch_id, old_name, new_name):
+        """
+        Log the hashes in new_name but not old_name as added in the batch,
+        and those in old_name but not new_name as removed.
+        :return: (added, removed) counts
+        """
+        changes = 'INSERT INTO etl_ingest_change (batch_id, hash, removed) ' \
+                  'SELECT %s, a.hash, {removed} FROM "{a}" AS a ' \
+                  'WHERE NOT EXISTS (SELECT 1 FROM "{b}" AS b WHERE b.hash = a.hash)'
+        added = bind.execute(changes.format(removed='FALSE', a=new_name, b=old_name), (batch_id,))
+        removed = bind.execute(changes.format(removed='TRUE', a=old_name, b=new_name), (batch_id,))
+        return added.rowcount, removed.rowcount
+
+    @classmethod
+    def finish(cls, bind, batch_id, added, removed):
+        bind.execute(cls.__table__.update().where(cls.id == batch_id).values(added=added, removed=removed))
+
+    @classmethod
+    def latest(cls, dataset_name):
+        """The most recent batch of the dataset, or None."""
+        return postgres_engine.execute(
+            cls.__table__.select().where(cls.dataset_name == dataset_name).order_by(cls.id.desc()).limit(1)
+        ).first()
+
+    @classmethod
+    def as_of(cls, dataset_name, when):
+        """Id of the last batch of the dataset created at or before when, or 0 if there's none."""
+        sel = select([func.max(cls.id)]).where(cls.dataset_name == dataset_name).where(cls.created_at <= when)
+        return postgres_engine.execute(sel).scalar() or 0
+
+    @classmethod
+    def logged(cls, dataset_name, batch_id):
+        """
+        Whether batch_id is one of the dataset's batches, so every change after
+        it is logged. Points before the dataset's first batch aren't covered,
+        and neither is anything before the log existed.
+        """
+        sel = select([cls.id]).where(cls.dataset_name == dataset_name).where(cls.id == batch_id)
+        return postgres_engine.execute(sel).scalar() is not None
+
+    @classmethod
+    def reloaded_after(cls, dataset_name, batch_id):
+        """Id of the last full batch of the dataset after batch_id, or None."""
+        sel = select([func.max(cls.id)]).where(cls.dataset_name == dataset_name).\
+            where(cls.id > batch_id).where(cls.full == True)
+        return postgres_engine.execute(sel).scalar()
+
+    @classmethod
+    def changed_since(cls, dataset_name, batch_id, removed, until=None):
+        """
+        Select of the hashes the dataset's batches after batch_id added (or removed).
+        :param until: if given, leave out the batches after it
+        """
+        change = IngestChange.__table__
+        sel = select([change.c.hash]).select_from(change.join(cls.__table__)).\
+            where(cls.dataset_name == dataset_name).\
+            where(change.c.batch_id > batch_id).\
+            where(change.c.removed == removed)
+        if until is not None:
+            sel = sel.where(change.c.batch_id <= until)
+        return sel
+
+    @classmethod
+    def clear(cls, dataset_name):
+        """Forget the dataset's batches, and with them their changes."""
+        postgres_engine.execute(cls.__table__.delete().where(cls.dataset_name == dataset_name))
+
+
+class IngestChange(postgres_base):
+    """A record hash added or removed by an IngestBatch."""
+    __tablename__ = 'etl_ingest_change'
+
+    batch_id = Column(Integer, ForeignKey('etl_ingest_batch.id', ondelete='CASCADE'), primary_key=True)
+    hash = Column(String(32), primary_key=True)
+    removed = Column(Boolean, nullable=False)
@@ -0,0 +1,47 @@
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, String
+
+from plenario.database import postgres_base, postgres_engine
+
+
+class IngestState(postgres_base):
+    """
+    How far the staging load of a point dataset has gotten,
+    so that an ingest that fails partway through can pick up
+    from its last committed chunk instead of starting over.
+    """
+    __tablename__ = 'etl_ingest_state'
+
+    dataset_name = Column(String(100), primary_key=True)
+    # Identifies the source (URL or path, and validator) the chunks came from
+    source_key = Column(String(40), nullable=False)
+    # Where in the source file the next chunk starts
+    byte_offset = Column(BigInteger, nullable=False)
+    # and the line number it starts on
+    line_number = Column(BigInteger, nullable=False)
+    rows_committed = Column(BigInteger, nullable=False)
+    # True once every chunk is in and the staging table is indexed
+    complete = Column(Boolean, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    @classmethod
+    def get(cls, dataset_name):
+        return postgres_engine.execute(
+            cls.__table__.select().where(cls.dataset_name == dataset_name)
+        ).first()
+
+    @classmethod
+    def save(cls, cursor, dataset_name, source_key, byte_offset, line_number, rows_committed,
+             complete=False):
+        """
+        Record progress through a raw DBAPI cursor,
+        so that it's committed together with the rows it describes.
+        """
+        cursor.execute('DELETE FROM etl_ingest_state WHERE dataset_name = %s', (dataset_name,))
+        cursor.execute('INSERT INTO etl_ingest_state '
+                       '(dataset_name, source_key, byte_offset, line_number, rows_committed, complete, updated_at) '
+                       'VALUES (%s, %s, %s, %s, %s, %s, now())',
+                       (dataset_name, source_key, byte_offset, line_number, rows_committed, complete))
+
+    @classmethod
+    def clear(cls, dataset_name):
+        postgres_engine.execute(cls.__table__.delete().where(cls.dataset_name == dataset_name))
@@ -1,6 +1,6 @@
 import json
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, time, timedelta
 from hashlib import md5
 from itertools import groupby
 from operator import itemgetter
@@ -9,11 +9,14 @@ import sqlalchemy as sa
 from flask_bcrypt import Bcrypt
 from geoalchemy2 import Geometry
 from shapely.geometry import shape
-from sqlalchemy import Boolean, Column, Date, DateTime, String, Table, Text, func, select
+from sqlalchemy import Boolean, Column, Date, DateTime, Integer, String, Table, Text, func, select
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.exc import ProgrammingError
 
-from plenario.database import postgres_base, postgres_session
+from plenario.database import postgres_base, postgres_engine, postgres_session
+from plenario.models.CellCount import CellCount
+from plenario.models.DailyCount import DailyCount
+from plenario.utils.cells import cell_center, cell_column_name, cell_keys, cell_sizes, cover
 from plenario.utils.helpers import get_size_in_degrees, slugify
 
 bcrypt = Bcrypt()
@@ -49,6 +52,28 @@ class MetaTable(postgres_base):
     contributor_email = Column(String)
     result_ids = Column(ARRAY(String))
     column_names = Column(JSONB)  # {'<COLUMN_NAME>': '<COLUMN_TYPE>'}
+    # If set, infer column types from a sample of this many rows
+    # instead of scanning the whole source before ingest
+    inference_sample_size = Column(Integer)
+    # Validators of the source as of the last successful ingest,
+    # so that updates can skip sources that haven't changed
+    source_etag = Column(String)
+    source_last_modified = Column(String)
+    source_digest = Column(String(32))
+    # If 'month' or 'year', split the point table into partitions by point_date
+    partition_by = Column(String(10))
+    # How to lay out the point table after each ingest, see plenario.etl.layout
+    layout_policy = Column(JSONB)
+    # Standard query timings from before and after the last layout optimization
+    layout_timings = Column(JSONB)
+    # {'latitude': ..., 'resolutions': [...]} of the /grid cell keys
+    # the point table carries, see plenario.utils.cells
+    grid_cells = Column(JSONB)
+    # True once the ETL keeps the dataset's DailyCounts, see plenario.models.DailyCount
+    daily_counts = Column(Boolean)
+    # Resolution of the cells the ETL keeps the dataset's CellCounts in,
+    # if it does, see plenario.models.CellCount
+    cell_counts = Column(Integer)
 
     def __init__(self, url, human_name, observed_date,
                  approved_status=False, update_freq='yearly',
@@ -314,25 +339,36 @@ class MetaTable(postgres_base):
         if conditions is None:
             conditions = []
 
-        # We need to convert resolution (given in meters) to degrees
-        # - which is the unit of measure for EPSG 4326 -
-        # - in order to generate our grid.
-        center = self.get_bbox_center()
-        # center[1] is longitude
-        size_x, size_y = get_size_in_degrees(resolution, center[1])
-
         t = self.point_table
-
-        q = postgres_session.query(
-                func.count(t.c.hash),
-                func.ST_SnapToGrid(
-                    t.c.geom,
-                    0,
-                    0,
-                    size_x,
-                    size_y
-                ).label('squares')
-            ).filter(*conditions).group_by('squares')
+        cell_column = cell_column_name(resolution)
+        sizes = cell_sizes(self.grid_cells)
+
+        if resolution in sizes and cell_column in t.c:
+            # Every record already knows its square, so just count by key.
+            size_x, size_y = sizes[resolution]
+            key = t.c[cell_column]
+            q = postgres_session.query(
+                    func.count(t.c.hash),
+                    cell_center(key, size_x, size_y).label('squares')
+                ).filter(*conditions).group_by(key)
+        else:
+            # We need to convert resolution (given in meters) to degrees
+            # - which is the unit of measure for EPSG 4326 -
+            # - in order to generate our grid.
+            center = self.get_bbox_center()
+            # center[1] is latitude
+            size_x, size_y = get_size_in_degrees(resolution, center[1])
+
+            q = postgres_session.query(
+                    func.count(t.c.hash),
+                    func.ST_SnapToGrid(
+                        t.c.geom,
+                        0,
+                        0,
+                        size_x,
+                        size_y
+                    ).label('squares')
+                ).filter(*conditions).group_by('squares')
 
         if geom:
             q = q.filter(t.c.geom.ST_Within(func.ST_GeomFromGeoJSON(geom)))
@@ -348,7 +384,12 @@ class MetaTable(postgres_base):
         # Reading this blog post
         # http://no0p.github.io/postgresql/2014/05/08/timeseries-tips-pg.html
         # inspired this implementation.
-        t = self.point_table
+        if self.cell_counts and geom and column_filters is None:
+            actuals = self._cell_actuals(agg_unit, start, end, geom)
+        elif self.daily_counts and geom is None and column_filters is None:
+            actuals = self._daily_actuals(agg_unit, start, end)
+        else:
+            actuals = self._point_actuals(agg_unit, start, end, geom, column_filters)
 
         # Special case for the 'quarter' unit of aggregation.
         step = '3 months' if agg_unit == 'quarter' else '1 ' + agg_unit
@@ -362,6 +403,22 @@ class MetaTable(postgres_base):
                            day_generator.label('time_bucket')]) \
             .alias('defaults')
 
+        # Outer join the default and observed values
+        # to create the timeseries select statement.
+        # If no observed value in a bucket, use the default.
+        name = sa.literal_column("'{}'".format(self.dataset_name)) \
+            .label('dataset_name')
+        bucket = defaults.c.time_bucket.label('time_bucket')
+        count = func.coalesce(actuals.c.count, defaults.c.count).label('count')
+        ts = select([name, bucket, count]). \
+            select_from(defaults.outerjoin(actuals, actuals.c.time_bucket == defaults.c.time_bucket))
+
+        return ts
+
+    def _point_actuals(self, agg_unit, start, end, geom=None, column_filters=None):
+        """Counts by agg_unit straight from the point table."""
+        t = self.point_table
+
         where_filters = [t.c.point_date >= start, t.c.point_date <= end]
         if column_filters is not None:
             # Column filters has to be iterable here, because the '+' operator
@@ -385,18 +442,70 @@ class MetaTable(postgres_base):
 
         # Need to alias to make it usable in a subexpression
         actuals = actuals.alias('actuals')
+        return actuals
 
-        # Outer join the default and observed values
-        # to create the timeseries select statement.
-        # If no observed value in a bucket, use the default.
-        name = sa.literal_column("'{}'".format(self.dataset_name)) \
-            .label('dataset_name')
-        bucket = defaults.c.time_bucket.label('time_bucket')
-        count = func.coalesce(actuals.c.count, defaults.c.count).label('count')
-        ts = select([name, bucket, count]). \
-            select_from(defaults.outerjoin(actuals, actuals.c.time_bucket == defaults.c.time_bucket))
+    def _daily_actuals(self, agg_unit, start, end):
+        """
+        Counts by agg_unit from the dataset's DailyCounts, for the days wholly
+        inside [start, end]. The partial days at either end, if any, are
+        counted from the point table, which only has to look at those days.
+        """
+        first_day, last_day = _whole_days(start, end)
+        if first_day > last_day:
+            # Less than a day, nothing for the rollup to answer.
+            return self._point_actuals(agg_unit, start, end)
+
+        # Don't reflect the whole point table for two columns.
+        t = sa.table(self.dataset_name, sa.column('hash'), sa.column('point_date'))
+        edges = sa.or_(
+            sa.and_(t.c.point_date >= start, t.c.point_date < first_day),
+            sa.and_(t.c.point_date >= last_day, t.c.point_date <= end))
+        partial = select([func.count(t.c.hash).label('count'),
+                          func.date_trunc(agg_unit, t.c.point_date).label('time_bucket')]) \
+            .where(edges) \
+            .group_by('time_bucket')
+        days = DailyCount.buckets(self.dataset_name, agg_unit, first_day, last_day)
 
-        return ts
+        return _sum_buckets(days, partial)
+
+    def _cell_actuals(self, agg_unit, start, end, geom):
+        """
+        Counts by agg_unit within geom from the dataset's CellCounts, for the
+        cells wholly inside geom on the days wholly inside [start, end].
+        The records in cells on the boundary of geom, and in the inside cells
+        on partial days, are tested against geom one by one as usual.
+        """
+        first_day, last_day = _whole_days(start, end)
+        if first_day > last_day:
+            return self._point_actuals(agg_unit, start, end, geom)
+        size_x, size_y = cell_sizes(self.grid_cells)[self.cell_counts]
+        covered = cover(postgres_engine, geom, size_x, size_y)
+        if covered is None or not covered[0]:
+            # Too big to sort out cell by cell, or no cell is wholly inside.
+            return self._point_actuals(agg_unit, start, end, geom)
+        inside, boundary = covered
+
+        start, end = _as_datetime(start), _as_datetime(end)
+        t = sa.table(self.dataset_name, sa.column('hash'), sa.column('point_date'),
+                     sa.column('geom'), sa.column(cell_column_name(self.cell_counts)))
+        cell = t.c[cell_column_name(self.cell_counts)]
+        within = func.ST_Within(t.c.geom, func.ST_GeomFromGeoJSON(geom))
+        in_range = sa.and_(t.c.point_date >= start, t.c.point_date <= end)
+        on_edges = sa.or_(
+            sa.and_(t.c.point_date >= start, t.c.point_date < first_day),
+            sa.and_(t.c.point_date >= last_day, t.c.point_date <= end))
+
+        selects = [CellCount.buckets(self.dataset_name, agg_unit, first_day, last_day, inside)]
+        for cells, dates in ((boundary, in_range), (inside, on_edges)):
+            if cells:
+                keys = cell_keys(cells)
+                selects.append(
+                    select([func.count(t.c.hash).label('count'),
+                            func.date_trunc(agg_unit, t.c.point_date).label('time_bucket')])
+                    .select_from(t.join(keys, cell == keys.c.key))
+                    .where(sa.and_(dates, within))
+                    .group_by('time_bucket'))
+        return _sum_buckets(*selects)
 
     def timeseries_one(self, agg_unit, start, end, geom=None, column_filters=None):
         ts_select = self.timeseries(agg_unit, start, end, geom, column_filters)
@@ -425,3 +534,23 @@ class MetaTable(postgres_base):
             WHERE m.approved_status = 'true'
         """
         return list(postgres_session.execute(query))
+
+
+def _as_datetime(d):
+    return d if isinstance(d, datetime) else datetime.combine(d, time())
+
+
+def _whole_days(start, end):
+    """The first day wholly inside [start, end], and the day after the last."""
+    start, end = _as_datetime(start), _as_datetime(end)
+    first_day = start.date() if start.time() == time() else start.date() + timedelta(days=1)
+    return first_day, end.date()
+
+
+def _sum_buckets(*selects):
+    """Add up the counts of selects of (count, time_bucket) by bucket."""
+    counts = sa.union_all(*selects).alias('counts')
+    actuals = select([sa.cast(func.sum(counts.c.count), sa.BigInteger).label('count'),
+                      counts.c.time_bucket]) \
+        .group_by(counts.c.time_bucket)
+    return actuals.alias('actuals')
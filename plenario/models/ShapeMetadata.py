@@ -43,6 +43,11 @@ class ShapeMetadata(postgres_base):
     is_ingested = Column(Boolean, nullable=False)
     # foreign key of celery task responsible for shapefile's ingestion
     celery_task_id = Column(String)
+    # Validators of the source as of the last successful ingest,
+    # so that updates can skip sources that haven't changed
+    source_etag = Column(String)
+    source_last_modified = Column(String)
+    source_digest = Column(String(32))
 
     @classmethod
     def get_by_dataset_name(cls, name):
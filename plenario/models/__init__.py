@@ -6,3 +6,7 @@ bcrypt = Bcrypt()
 from .MetaTable import MetaTable
 from .ShapeMetadata import ShapeMetadata
 from .User import User
+from .IngestState import IngestState
+from .IngestBatch import IngestBatch, IngestChange
+from .DailyCount import DailyCount
+from .CellCount import CellCount
@@ -13,7 +13,8 @@ from shapely import wkb
 from sqlalchemy import MetaData, and_, asc, desc, func as sqla_fn
 from sqlalchemy.orm.exc import NoResultFound
 
-from plenario.api.common import cache, crossdomain, extract_first_geometry_fragment, make_cache_key, make_fragment_str, \
+from plenario.api.caching import cached
+from plenario.api.common import crossdomain, extract_first_geometry_fragment, make_fragment_str, \
     unknown_object_json_handler
 from plenario.api.condition_builder import parse_tree
 from plenario.api.validator import valid_tree
@@ -159,7 +160,7 @@ def get_network_map(network: str) -> Response:
     return jsonify(network_object.tree())
 
 
-# @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+# @cached(timeout=CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def get_network_metadata(network: str = None) -> Response:
     '''Return metadata for some network. If no network_name is specified, the
@@ -183,7 +184,7 @@ def get_network_metadata(network: str = None) -> Response:
     return jsonify(json_response_base(validated, result, args))
 
 
-# @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+# @cached(timeout=CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def get_node_metadata(network: str, node: str = None) -> Response:
     '''Return metadata about nodes for some network. If no node_id or
@@ -259,7 +260,7 @@ def presigned_url(bucket: str, key: str, file_name: str) -> str:
     )
 
 
-# @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+# @cached(timeout=CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def get_sensor_metadata(network: str, sensor: str = None) -> Response:
     '''Return metadata for all sensors within a network. Sensors can also be
@@ -304,7 +305,7 @@ def get_sensor_metadata(network: str, sensor: str = None) -> Response:
     return jsonify(json_response_base(validated, result, args))
 
 
-# @cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+# @cached(timeout=CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def get_feature_metadata(network: str, feature: str = None) -> Response:
     '''Return metadata about features for some network. If no feature is
@@ -484,7 +485,7 @@ def get_observations_download(network: str) -> Response:
     return attachment
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cached(timeout=CACHE_TIMEOUT)
 @crossdomain(origin='*')
 def get_aggregations(network: str) -> Response:
     '''Aggregate individual node observations up to larger units of time.
@@ -72,6 +72,48 @@ MAIL_PASSWORD = get('MAIL_PASSWORD', '')
 # Toggle maintenance mode
 MAINTENANCE = False
 
+# Pipe remote point datasets straight from the download into COPY
+# instead of saving them to a temporary file first
+ETL_STREAM_INGEST = get('ETL_STREAM_INGEST', 'false').lower() == 'true'
+
+# How many connections to COPY a downloaded point dataset over at once
+ETL_COPY_WORKERS = int(get('ETL_COPY_WORKERS', 1))
+
+# Update point datasets by building a new table and swapping it in for the live one
+ETL_SWAP_TABLES = get('ETL_SWAP_TABLES', 'false').lower() == 'true'
+
+# Create ETL scratch tables (staging and n_ tables) UNLOGGED
+ETL_UNLOGGED_SCRATCH = get('ETL_UNLOGGED_SCRATCH', 'true').lower() == 'true'
+
+# Keep downloads here, keyed by URL and ETag/Last-Modified, until they're ingested,
+# so a failed ingest doesn't download again (and a cut off download resumes)
+ETL_DOWNLOAD_CACHE_DIR = get('ETL_DOWNLOAD_CACHE_DIR', None)
+
+# COPY point datasets into staging in committed chunks of this many rows,
+# so a failed ingest can resume from the last one. 0 loads in one go.
+ETL_CHECKPOINT_ROWS = int(get('ETL_CHECKPOINT_ROWS', 1000000))
+
+# Point dataset records that can't be loaded are set aside in an r_ table
+# rather than failing the ingest, unless more than this fraction of them are bad
+ETL_MAX_ERROR_RATE = float(get('ETL_MAX_ERROR_RATE', 0.01))
+
+# Give new point tables a precomputed /grid cell key at each of these resolutions (in meters)
+ETL_GRID_RESOLUTIONS = [int(r) for r in get('ETL_GRID_RESOLUTIONS', '250,500,1000').split(',') if r]
+# Keep per-day counts of point records in the cells of this resolution,
+# for timeseries within a location; one of ETL_GRID_RESOLUTIONS
+ETL_CELL_COUNT_RESOLUTION = int(get('ETL_CELL_COUNT_RESOLUTION', 500))
+# Timeseries within a location whose bounding box spans more cells than this
+# count the point table instead of sorting out the cells one by one
+CELL_COVER_MAX_SQUARES = int(get('CELL_COVER_MAX_SQUARES', 10000))
+
+# Log this fraction of the queries behind cached API responses, keeping the
+# most frequent QUERY_LOG_SIZE for each dataset to warm the cache with after ETL
+QUERY_LOG_SAMPLE_RATE = float(get('QUERY_LOG_SAMPLE_RATE', 0.1))
+QUERY_LOG_SIZE = int(get('QUERY_LOG_SIZE', 500))
+# Replay this many of a dataset's logged queries after it's updated, this many at once
+CACHE_WARM_QUERIES = int(get('CACHE_WARM_QUERIES', 20))
+CACHE_WARM_WORKERS = int(get('CACHE_WARM_WORKERS', 2))
+
 # Celery
 CELERY_BROKER_URL = get('CELERY_BROKER_URL', 'redis://{}:6379/0'.format(REDIS_HOST))
 CELERY_RESULT_BACKEND = get('CELERY_RESULT_BACKEND', 'db+{}'.format(DATABASE_CONN))
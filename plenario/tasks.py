@@ -2,6 +2,7 @@ import csv
 import logging
 import os
 import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import boto3
@@ -11,11 +12,15 @@ from raven import Client
 from sqlalchemy import Table
 
 from plenario.database import redshift_base, redshift_session, postgres_session, postgres_base, postgres_engine
+from plenario.etl.partition import drop_point_table
 from plenario.etl.point import PlenarioETL
 from plenario.etl.shape import ShapeETL
-from plenario.models import MetaTable, ShapeMetadata
-from plenario.settings import CELERY_BROKER_URL, S3_BUCKET, PLENARIO_SENTRY_URL, CELERY_RESULT_BACKEND
+from plenario.models import CellCount, DailyCount, IngestBatch, IngestState, MetaTable, ShapeMetadata
+from plenario.settings import CELERY_BROKER_URL, S3_BUCKET, PLENARIO_SENTRY_URL, CELERY_RESULT_BACKEND, \
+    CACHE_WARM_QUERIES, CACHE_WARM_WORKERS
 from plenario.utils.helpers import reflect
+from plenario.utils.query_log import REPLAY_HEADER, top_queries
+from plenario.utils.versions import bump_version
 from plenario.utils.weather import WeatherETL
 
 
@@ -57,23 +62,30 @@ def health() -> bool:
 
 
 @worker.task()
-def add_dataset(name: str) -> bool:
+def add_dataset(name: str, workers: int = None) -> bool:
     """Ingest the row information for an approved point dataset.
+    Pass workers to COPY the source over that many connections at once.
     """
     logger.info('Begin. (name: "{}")'.format(name))
     meta = get_meta(name)
-    PlenarioETL(meta).add()
+    PlenarioETL(meta, workers=workers).add()
+    bump_version('point', name)
     logger.info('End.')
     return True
 
 
 @worker.task()
-def update_dataset(name: str) -> bool:
+def update_dataset(name: str, workers: int = None, full_meta: bool = False) -> bool:
     """Update the row information for an approved point dataset.
+    Pass workers to COPY the source over that many connections at once.
+    Pass full_meta to recompute the time range and bounding box from scratch.
     """
     logger.info('Begin. (name: "{}")'.format(name))
     meta = get_meta(name)
-    PlenarioETL(meta).update()
+    # Cached responses only go stale if the source changed.
+    if PlenarioETL(meta, workers=workers).update(full_meta=full_meta):
+        bump_version('point', name)
+        warm_cache.delay('point', name)
     logger.info('End.')
     return True
 
@@ -85,7 +97,16 @@ def delete_dataset(name: str) -> bool:
     logger.info('Begin. (name: "{}")'.format(name))
     metatable = reflect("meta_master", postgres_base.metadata, postgres_engine)
     metatable.delete().where(metatable.c.dataset_name == name).execute()
-    reflect(name, postgres_base.metadata, postgres_engine).drop()
+    # Partitioned point tables take their partitions with them.
+    drop_point_table(name)
+    postgres_engine.execute('DROP TABLE IF EXISTS "r_{}"'.format(name))
+    # A failed checkpointed ingest keeps its staging table around to resume from.
+    postgres_engine.execute('DROP TABLE IF EXISTS "s_{}"'.format(name))
+    IngestState.clear(name)
+    IngestBatch.clear(name)
+    DailyCount.clear(name)
+    CellCount.clear(name)
+    bump_version('point', name)
     logger.info('End.')
     return True
 
@@ -98,6 +119,7 @@ def add_shape(name: str) -> bool:
     meta = get_meta(name)
     logger.debug('Add the shape table.')
     ShapeETL(meta).add()
+    bump_version('shape', name)
     logger.info('End.')
     return True
 
@@ -109,7 +131,9 @@ def update_shape(name: str) -> bool:
     logger.info('Begin. (name: "{}")'.format(name))
     meta = get_meta(name)
     logger.debug('Update the shape table.')
-    ShapeETL(meta).update()
+    if ShapeETL(meta).update():
+        bump_version('shape', name)
+        warm_cache.delay('shape', name)
     logger.info('End.')
     return True
 
@@ -125,6 +149,27 @@ def delete_shape(name) -> bool:
     metashape.delete().where(metashape.c.dataset_name == name).execute()
     logger.debug('Reflect and drop the corresponding shape table.')
     reflect(name, postgres_base.metadata, postgres_engine).drop()
+    bump_version('shape', name)
+    logger.info('End.')
+    return True
+
+
+@worker.task()
+def warm_cache(kind: str, name: str) -> bool:
+    """Replay the logged API queries of a dataset that just changed with the
+    highest cost times frequency, so their responses are cached again before
+    anyone asks for them.
+    """
+    logger.info('Begin. (kind: "{}", name: "{}")'.format(kind, name))
+    queries = top_queries(kind, name, CACHE_WARM_QUERIES)
+    logger.debug('Replay {} queries.'.format(len(queries)))
+    if queries:
+        app = get_app()
+        with ThreadPoolExecutor(max_workers=CACHE_WARM_WORKERS) as pool:
+            statuses = list(pool.map(lambda q: replay_query(app, q), queries))
+        failed = [q for q, status in zip(queries, statuses) if status != 200]
+        if failed:
+            logger.warning('Failed to replay: {}'.format(failed))
     logger.info('End.')
     return True
 
@@ -166,6 +211,7 @@ def update_metar() -> bool:
     w = WeatherETL()
     logger.debug('Call metar initialization method.')
     w.metar_initialize_current()
+    bump_version('weather')
     logger.info('End.')
     return True
 
@@ -179,6 +225,7 @@ def clean_metar() -> bool:
     """
     logger.info('Begin.')
     WeatherETL().clear_metars()
+    bump_version('weather')
     logger.info('End.')
     return True
 
@@ -201,6 +248,7 @@ def update_weather(month=None, year=None, wbans=None) -> bool:
     if last_month != month:
         w.initialize_month(last_year, last_month, weather_stations_list=wbans)
     w.initialize_month(year, month, weather_stations_list=wbans)
+    bump_version('weather')
     return True
 
 
@@ -319,3 +367,27 @@ def table_to_csvs(table: Table, start: datetime, end: datetime) -> list:
         file.close()
 
     return file_names
+
+
+_app = None
+
+
+def get_app():
+    """The app to replay API queries with, created when it's first needed,
+    like server.create_app only imports the API when it's needed.
+    """
+    global _app
+    if _app is None:
+        from plenario.server import create_app
+        _app = create_app()
+    return _app
+
+
+def replay_query(app, query: str) -> int:
+    """Make an API request for query in this process, caching its response.
+    """
+    try:
+        return app.test_client().get(query, headers={REPLAY_HEADER: '1'}).status_code
+    except Exception:
+        logger.exception('Failed to replay {}.'.format(query))
+        return 500
@@ -0,0 +1,122 @@
+"""
+Grid cell keys, computed once per point at ingest so /grid can group by them.
+
+A point table can carry a cell_<resolution> column for each of a few fixed
+resolutions (in meters). Each holds a BIGINT naming the square of that size
+the point snaps to, the same square ST_SnapToGrid would put it in. Squares are
+sized in degrees at the dataset's reference latitude, which is stored in
+MetaTable.grid_cells with the resolutions, so keys stay put across updates.
+
+The key packs the column and row of the square into one integer:
+column * 2^32 + row + 2^31.
+"""
+
+import re
+
+from sqlalchemy import BigInteger, cast, func, literal, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from plenario.settings import CELL_COVER_MAX_SQUARES
+from plenario.utils.helpers import get_size_in_degrees
+
+ROW_OFFSET = 2 ** 31
+COLUMN_FACTOR = 2 ** 32
+CELL_COLUMN = re.compile(r'cell_\d+$')
+
+
+def cell_column_name(resolution):
+    return 'cell_{:d}'.format(resolution)
+
+
+def cell_column_names(table):
+    """Names of the cell key columns of a point table."""
+    return [c.name for c in table.columns if CELL_COLUMN.match(c.name)]
+
+
+def record_columns(columns):
+    """The columns of a point table other than its cell keys, which aren't for users."""
+    return [c for c in columns if not CELL_COLUMN.match(c.name)]
+
+
+def cell_sizes(grid_cells):
+    """
+    :param grid_cells: {'latitude': ..., 'resolutions': [...]}, as in MetaTable.grid_cells
+    :return: {resolution: (size_x, size_y)} in degrees
+    """
+    if not grid_cells:
+        return {}
+    latitude = grid_cells['latitude']
+    return {r: get_size_in_degrees(r, latitude) for r in grid_cells['resolutions']}
+
+
+def cell_key(geom, size_x, size_y):
+    """Expression for the key of the square of geom, a point column."""
+    column = cast(func.round(func.ST_X(geom) / size_x), BigInteger)
+    row = cast(func.round(func.ST_Y(geom) / size_y), BigInteger)
+    return column * COLUMN_FACTOR + row + ROW_OFFSET
+
+
+def cell_center(key, size_x, size_y):
+    """Expression for the center of the square named by key, as ST_SnapToGrid would give it."""
+    # >> on a BIGINT keeps the sign, so this floors for negative columns too.
+    column = key.op('>>')(32)
+    row = key.op('&')(COLUMN_FACTOR - 1) - ROW_OFFSET
+    return func.ST_SetSRID(func.ST_MakePoint(column * size_x, row * size_y), 4326)
+
+
+def cell_keys(keys):
+    """
+    A FROM clause with a row for each of the given cell keys, in a column
+    named key, to join on instead of spelling the keys out in an IN list.
+    The keys go over as a single array parameter.
+    """
+    array = cast(literal(keys, ARRAY(BigInteger)), ARRAY(BigInteger))
+    return select([func.unnest(array).label('key')]).alias('cell_keys')
+
+
+# How many squares cover the bounding box of a GeoJSON geometry.
+COVER_SIZE = '''
+WITH shape AS (SELECT ST_SetSRID(ST_GeomFromGeoJSON(%(geom)s), 4326) AS g)
+SELECT (round(ST_XMax(g) / %(sx)s) - round(ST_XMin(g) / %(sx)s) + 1) *
+       (round(ST_YMax(g) / %(sy)s) - round(ST_YMin(g) / %(sy)s) + 1)
+FROM shape
+'''
+
+# Every square that touches a GeoJSON geometry, and whether it's wholly inside.
+# Grown by a hair before the test, so a point on the edge of a square that
+# rounded its way into it is still inside the geometry when the square is.
+COVER = '''
+WITH shape AS (SELECT ST_SetSRID(ST_GeomFromGeoJSON(%(geom)s), 4326) AS g)
+SELECT c * {factor} + r + {offset} AS key,
+       ST_ContainsProperly(g, ST_Expand(square, 1e-9)) AS inside
+FROM (
+    SELECT g, c, r, ST_MakeEnvelope((c - 0.5) * %(sx)s, (r - 0.5) * %(sy)s,
+                                    (c + 0.5) * %(sx)s, (r + 0.5) * %(sy)s, 4326) AS square
+    FROM shape,
+         generate_series(round(ST_XMin(g) / %(sx)s)::bigint, round(ST_XMax(g) / %(sx)s)::bigint) AS c,
+         generate_series(round(ST_YMin(g) / %(sy)s)::bigint, round(ST_YMax(g) / %(sy)s)::bigint) AS r
+) AS squares
+WHERE ST_Intersects(g, square)
+'''.format(factor=COLUMN_FACTOR, offset=ROW_OFFSET)
+
+
+def cover(bind, geom, size_x, size_y, max_squares=CELL_COVER_MAX_SQUARES):
+    """
+    Sort the squares a geometry touches into those wholly inside its interior,
+    whose points are all within it, and those on its boundary, whose points
+    have to be tested one by one.
+    :param bind: engine, connection or session to run the query over
+    :param geom: GeoJSON string of the geometry
+    :param max_squares: most squares to look at, counting every square
+                        of the geometry's bounding box
+    :return: (keys of the inside squares, keys of the boundary squares),
+             or None if the bounding box spans more than max_squares squares
+    """
+    params = {'geom': geom, 'sx': size_x, 'sy': size_y}
+    if bind.execute(COVER_SIZE, params).scalar() > max_squares:
+        return None
+
+    inside, boundary = [], []
+    for key, is_inside in bind.execute(COVER, params):
+        (inside if is_inside else boundary).append(key)
+    return inside, boundary
@@ -1,5 +1,8 @@
 import csv
+import itertools
 import math
+import os
+import random
 from collections import namedtuple
 
 import boto3
@@ -7,7 +10,7 @@ from slugify import slugify as _slugify
 from sqlalchemy import Table
 
 from plenario.settings import ADMIN_EMAILS, AWS_ACCESS_KEY, AWS_REGION_NAME, AWS_SECRET_KEY, MAIL_USERNAME
-from plenario.utils.typeinference import normalize_column_type
+from plenario.utils.typeinference import infer_column_types, normalize_column_type
 
 
 def get_size_in_degrees(meters, latitude):
@@ -29,19 +32,74 @@ ColumnInfo = namedtuple('ColumnInfo', 'name type_ has_nulls')
 
 def infer_csv_columns(inp):
     """
-    :param inp: File handle to a CSV dataset that we can throw into a UnicodeCSVReader
+    :param inp: File handle (or any iterable of lines) of a CSV dataset
     :return: List of `ColumnInfo`s
     """
     reader = csv.reader(inp)
     header = next(reader)
-    inp.seek(0)
-    iter_output = [iter_column(col_idx, inp)
-                   for col_idx in range(len(header))]
+    iter_output = infer_column_types(reader, len(header))
 
     return [ColumnInfo(name, type_, has_nulls)
             for name, (type_, has_nulls) in zip(header, iter_output)]
 
 
+def iter_columns(f):
+    """Infer the types of every column of a CSV in a single pass.
+
+    :param f: file object of CSV dataset
+    :return: list of (col_type, null_values), one for each header column
+    """
+    f.seek(0)
+    reader = csv.reader(f)
+    header = next(reader)
+    return infer_column_types(reader, len(header))
+
+
+def sample_csv_rows(f, size, block_rows=1000):
+    """Sample rows of a CSV without reading the whole file.
+
+    Half of the sample comes from the head of the file. The rest comes from
+    blocks of consecutive rows starting at random byte offsets. A block's
+    first line is discarded since it's likely a partial record, as are rows
+    whose width doesn't match the header (misaligned on a quoted newline).
+
+    :param f: text file object of CSV dataset opened from disk
+    :param size: number of rows to sample
+    :param block_rows: number of rows to read from each random offset
+    :return: (header, rows)
+    """
+    f.seek(0)
+    reader = csv.reader(f)
+    header = next(reader)
+    width = len(header)
+
+    rows = []
+    for row in reader:
+        rows.append(row)
+        if len(rows) >= size // 2:
+            break
+    else:
+        # The whole file fit in the head of the sample.
+        f.seek(0)
+        return header, rows
+
+    raw = f.buffer
+    file_size = os.fstat(raw.fileno()).st_size
+    # Allow for some blocks coming up short near the end of the file.
+    attempts = 2 * int(math.ceil((size - len(rows)) / block_rows))
+    for _ in range(attempts):
+        if len(rows) >= size:
+            break
+        raw.seek(random.randrange(file_size))
+        raw.readline()
+        lines = (line.decode('utf-8', errors='replace') for line in raw)
+        block = itertools.islice(csv.reader(lines), block_rows)
+        rows.extend(row for row in block if len(row) == width)
+
+    f.seek(0)
+    return header, rows
+
+
 def iter_column(idx, f):
     """
     :param idx: index of column
@@ -1,3 +1,4 @@
+import io
 import os
 import shutil
 import subprocess
@@ -106,8 +107,50 @@ def import_shapefile_to_table(component_path, table_name):
 
     args = ['ogr2ogr',
             '-f', 'PostgreSQL',  # Use the PostgreSQL driver. Documentation here: http://www.gdal.org/drv_pg.html
+            postgres_connection_arg] + _import_flags(component_path, table_name)
 
-            '-lco', 'PRECISION=no',  # Many .dbf files don't obey their precision headers.
+    subprocess.check_output(args)
+
+
+def dump_shapefile(component_path, table_name):
+    """
+    Like import_shapefile_to_table, but instead of writing to the database,
+    yield the SQL script that would create and fill the table.
+    Rows come as COPY data, so the caller can transform them on their way in.
+
+    :param component_path: Path to unzipped shapefile components, as in import_shapefile_to_table.
+    :param table_name: Name that we want table to have in the database
+    """
+
+    args = ['ogr2ogr',
+            '-f', 'PGDump',  # Write SQL instead. Documentation here: http://www.gdal.org/drv_pgdump.html
+            '--config', 'PG_USE_COPY', 'YES',  # Rows as COPY data instead of one INSERT apiece.
+            '-lco', 'DROP_TABLE=OFF',  # The caller takes care of any table already there.
+            '-lco', 'CREATE_SCHEMA=OFF',
+            '/vsistdout/'] + _import_flags(component_path, table_name)
+
+    # ogr2ogr can warn about more than a pipe holds while we're still reading
+    # stdout, and would block on it. So its warnings go to a file instead.
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as errors:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=errors)
+        # Popen only takes an encoding from Python 3.6 on, so decode the pipe ourselves.
+        stdout = io.TextIOWrapper(process.stdout, encoding='utf-8')
+        try:
+            for line in stdout:
+                yield line
+        finally:
+            stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+        if process.returncode != 0:
+            errors.seek(0)
+            raise OgrError('Failed to dump shapefile with ogr2ogr. {}\n{}'.format(args, errors.read()))
+
+
+def _import_flags(component_path, table_name):
+    return ['-lco', 'PRECISION=no',  # Many .dbf files don't obey their precision headers.
             # So importing as precision-marked types like NUMERIC(width, precision) often fails.
             # Instead, import as INTEGER, VARCHAR, FLOAT8.
 
@@ -116,9 +159,6 @@ def import_shapefile_to_table(component_path, table_name):
             # so we need to import the most inclusive set of types.
             '-s_srs', component_path + '.prj',  # Derive source SRID from Well Known Text in .prj
             '-t_srs', 'EPSG:4326',  # Always convert to 4326
-            postgres_connection_arg,
             component_path + '.shp',  # Point to .shp so that ogr2ogr knows it's importing a Shapefile.
             '-nln', table_name,  # (n)ew (l)ayer (n)ame. Set the name of the new table.
             '-lco', 'GEOMETRY_NAME=geom']  # Always name the geometry column 'geom'
-
-    subprocess.check_output(args)
@@ -0,0 +1,91 @@
+"""
+Sampled log of the queries behind cached API responses, kept in Redis for
+each dataset they depend on (see plenario.utils.versions), with how often
+they're asked and how long the last computation of each took. After a
+dataset changes, the cache is warmed with its queries that cost the most
+over all the times they're asked, see plenario.tasks.warm_cache.
+"""
+
+import logging
+import random
+
+from redis import Redis
+
+from plenario.settings import CACHE_CONFIG, QUERY_LOG_SAMPLE_RATE, QUERY_LOG_SIZE, REDIS_HOST
+from plenario.utils.versions import ALL
+
+logger = logging.getLogger(__name__)
+
+# Marks the requests that replay logged queries, which shouldn't be logged again.
+REPLAY_HEADER = 'X-Plenario-Replay'
+
+redis = Redis(REDIS_HOST)
+
+
+def log_key(what, kind, name):
+    """:param what: 'frequency' or 'cost'"""
+    return '{}querylog:{}:{}:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'], what, kind, name)
+
+
+def log_query(query, dependencies):
+    """
+    Count a sample of the requests for query against each dataset it depends on.
+    :param query: canonical path and query string, see plenario.api.caching.canonical_query
+    :param dependencies: [(kind, name)] of the data the response is computed from
+    """
+    if not dependencies or random.random() >= QUERY_LOG_SAMPLE_RATE:
+        return
+    pipe = redis.pipeline()
+    for kind, name in dependencies:
+        pipe.zincrby(log_key('frequency', kind, name), value=query, amount=1)
+        pipe.zcard(log_key('frequency', kind, name))
+    sizes = pipe.execute()[1::2]
+    for (kind, name), size in zip(dependencies, sizes):
+        if size > QUERY_LOG_SIZE:
+            _trim(kind, name)
+
+
+def log_cost(query, dependencies, seconds):
+    """Record that computing the response to query took seconds."""
+    if not dependencies:
+        return
+    pipe = redis.pipeline()
+    for kind, name in dependencies:
+        pipe.hset(log_key('cost', kind, name), query, seconds)
+        pipe.hlen(log_key('cost', kind, name))
+    sizes = pipe.execute()[1::2]
+    for (kind, name), size in zip(dependencies, sizes):
+        # Costs of queries that were never sampled, or fell out of the log.
+        if size > 2 * QUERY_LOG_SIZE:
+            _trim(kind, name)
+
+
+def top_queries(kind, name, n):
+    """
+    :return: up to n logged queries that depend on the dataset, or on every
+             dataset of its kind, by descending cost times frequency
+    """
+    frequencies = {}
+    costs = {}
+    for dataset in {name, ALL}:
+        for query, frequency in redis.zrange(log_key('frequency', kind, dataset), 0, -1, withscores=True):
+            frequencies[query] = frequencies.get(query, 0) + frequency
+        for query, cost in redis.hgetall(log_key('cost', kind, dataset)).items():
+            costs[query] = float(cost)
+
+    # Queries not computed since they were first sampled cost as much as the average one.
+    known = [costs[q] for q in frequencies if q in costs]
+    default = sum(known) / len(known) if known else 1.0
+    ranked = sorted(frequencies, key=lambda q: frequencies[q] * costs.get(q, default), reverse=True)
+    return [q.decode('utf-8') for q in ranked[:n]]
+
+
+def _trim(kind, name):
+    """Keep the QUERY_LOG_SIZE most frequent queries of the dataset and their costs."""
+    frequency_key = log_key('frequency', kind, name)
+    cost_key = log_key('cost', kind, name)
+    redis.zremrangebyrank(frequency_key, 0, -QUERY_LOG_SIZE - 1)
+    kept = set(redis.zrange(frequency_key, 0, -1))
+    dropped = [q for q in redis.hkeys(cost_key) if q not in kept]
+    if dropped:
+        redis.hdel(cost_key, *dropped)
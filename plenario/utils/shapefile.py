@@ -2,7 +2,7 @@ import os
 import shutil
 import tempfile
 
-from plenario.utils.ogr2ogr import OgrError, import_shapefile_to_table
+from plenario.utils.ogr2ogr import OgrError, dump_shapefile, import_shapefile_to_table
 
 
 class ShapefileError(Exception):
@@ -77,6 +77,15 @@ class Shapefile:
         except OgrError as e:
             raise ShapefileError('Failed to insert shapefile into database.\n{}'.format(repr(e)))
 
+    def dump(self, table_name):
+        """Lines of a SQL script that creates table_name and COPYs the shapes into it."""
+        component_path = os.path.join(self.unzip_dir, Shapefile.COMPONENT_PREFIX)
+        try:
+            for line in dump_shapefile(component_path=component_path, table_name=table_name):
+                yield line
+        except OgrError as e:
+            raise ShapefileError('Failed to dump shapefile.\n{}'.format(repr(e)))
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         """When a Shapefile exits its managed context or there is an internal exception,
         remove the temporary directory.
@@ -1,6 +1,7 @@
 import datetime
+import re
 
-from dateutil.parser import parse
+from dateutil.parser import parse, parserinfo
 from sqlalchemy import BigInteger, Boolean, Date, Float, Integer, String
 from sqlalchemy.dialects.postgresql import TIME, TIMESTAMP
 
@@ -14,6 +15,31 @@ DEFAULT_DATETIME = datetime.datetime(2999, 12, 31, 0, 0, 0)
 NULL_DATE = datetime.date(2999, 12, 31)
 NULL_TIME = datetime.time(0, 0, 0)
 
+# Shapes that cover nearly every date and time we ingest. Values that match
+# one of these are classified without handing them to dateutil.
+# 2015-10-12, 2015-10-12 05:00:00, 2015-10-12T05:00:00.000 (Socrata), ...
+ISO_DATETIME = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?(?:Z|[+-]\d{2}:?\d{2})?)?$'
+)
+# 10/12/2015, 10/12/2015 05:00:00 AM, ...
+US_DATETIME = re.compile(
+    r'^(\d{1,2})/(\d{1,2})/(\d{4})'
+    r'(?: (\d{1,2}):(\d{2})(?::(\d{2}))?(?: ?([AaPp][Mm]))?)?$'
+)
+# 05:00, 5:00:00 PM, ...
+TIME_OF_DAY = re.compile(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?(?: ?([AaPp][Mm]))?$')
+
+# What Postgres will take as an integer or a floating point number.
+PG_INTEGER = re.compile(r'^\s*[+-]?\d+\s*$')
+PG_NUMERIC = re.compile(r'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$')
+PG_INTEGER_MAX = 2147483647
+PG_BIGINT_MAX = 9223372036854775807
+
+DIGITS = re.compile(r'\d')
+WORDS = re.compile(r'[A-Za-z]+')
+DATEUTIL_INFO = parserinfo()
+
 
 def normalize_column_type(l):
     """Given a sequence of values in a column (l),
@@ -104,19 +130,7 @@ def normalize_column_type(l):
                 add(NoneType)
                 continue
 
-            d = parse(x, default=DEFAULT_DATETIME)
-
-            # Is it only a time?
-            if d.date() == NULL_DATE:
-                add(TIME)
-
-            # Is it only a date?
-            elif d.time() == NULL_TIME:
-                add(Date)
-
-            # It must be a date and time
-            else:
-                add(TIMESTAMP)
+            add(temporal_type(x))
 
             if 'am' in x.lower():
                 ampm = True
@@ -125,24 +139,337 @@ def normalize_column_type(l):
                 ampm = True
 
         normal_types_set.discard(NoneType)
-
-        # If a mix of dates and datetimes, up-convert dates to datetimes
-        if normal_types_set == set([TIMESTAMP, Date]):
-            normal_types_set = set([TIMESTAMP])
-        # Datetimes and times don't mix -- fallback to using strings
-        elif normal_types_set == set([TIMESTAMP, TIME]):
-            normal_types_set = set([String])
-        # Dates and times don't mix -- fallback to using strings
-        elif normal_types_set == set([Date, TIME]):
-            normal_types_set = set([String])
-        elif normal_types_set == set([TIME]) and ampm:
-            normal_types_set = set([String])
-
-        return normal_types_set.pop(), null_values
+        return resolve_temporal_types(normal_types_set, ampm), null_values
     except ValueError:
         pass
     except TypeError:  # https://bugs.launchpad.net/dateutil/+bug/1247643
         pass
+    except OverflowError:  # Huge numbers read as a day or a year
+        pass
 
     # Don't know what they are, so they must just be strings 
     return String, null_values
+
+
+def temporal_type(x):
+    """Classify a single non-null value as a time, a date or a timestamp.
+
+    Common shapes are settled by fast_temporal_type. Only the values it
+    can't vouch for are handed to dateutil, unless they plainly can't be
+    a date or time at all.
+
+    :param x: A string value from a column
+    :return: TIME, Date or TIMESTAMP
+    :raises: ValueError or TypeError if x can't be read as a date or time
+    """
+    type_ = fast_temporal_type(x)
+    if type_ is not None:
+        return type_
+
+    if not could_be_temporal(x):
+        raise ValueError('Not a date or time: {}'.format(x))
+
+    d = parse(x, default=DEFAULT_DATETIME)
+    return _classify(d)
+
+
+def _classify(d):
+    """Tell times, dates and timestamps apart by which defaults survived."""
+    if d.date() == NULL_DATE:
+        return TIME
+    elif d.time() == NULL_TIME:
+        return Date
+    else:
+        return TIMESTAMP
+
+
+def _to_24_hour(hour, ampm):
+    if ampm is None:
+        return hour
+    if not 1 <= hour <= 12:
+        raise ValueError('Hour out of range for 12-hour clock')
+    hour = hour % 12
+    return hour + 12 if ampm.lower() == 'pm' else hour
+
+
+def fast_temporal_type(x):
+    """Classify values shaped like ISO-8601, US MM/DD/YYYY or a bare time of
+    day the same way dateutil would, without calling it.
+
+    :param x: A string value from a column
+    :return: TIME, Date or TIMESTAMP, or None when x isn't one of the common
+             shapes or is an edge case that dateutil should decide.
+    """
+    try:
+        match = ISO_DATETIME.match(x)
+        if match:
+            year, month, day, hour, minute, second, fraction = match.groups()
+            d = datetime.datetime(
+                int(year), int(month), int(day),
+                int(hour or 0), int(minute or 0), int(second or 0),
+                int((fraction or '0').ljust(6, '0'))
+            )
+        else:
+            match = US_DATETIME.match(x)
+            if match:
+                month, day, year, hour, minute, second, ampm = match.groups()
+                # 13/01/2015 is read day first by dateutil, leave that to it.
+                d = datetime.datetime(
+                    int(year), int(month), int(day),
+                    _to_24_hour(int(hour), ampm) if hour else 0,
+                    int(minute or 0), int(second or 0)
+                )
+            else:
+                match = TIME_OF_DAY.match(x)
+                if not match:
+                    return None
+                hour, minute, second, ampm = match.groups()
+                datetime.time(_to_24_hour(int(hour), ampm), int(minute), int(second or 0))
+                return TIME
+    except ValueError:
+        # Out of range fields, let dateutil have the final word.
+        return None
+
+    if d.date() == NULL_DATE:
+        # Collides with the sentinel default date, so it's ambiguous.
+        return None
+    return _classify(d)
+
+
+def could_be_temporal(x):
+    """Cheap test for values that dateutil could never read as a date or time.
+
+    Without a single digit, dateutil can only make a date out of month or
+    weekday names, so free text without those is ruled out right away.
+    """
+    if DIGITS.search(x):
+        return True
+    for word in WORDS.findall(x):
+        if DATEUTIL_INFO.month(word) is not None or DATEUTIL_INFO.weekday(word) is not None:
+            return True
+    return False
+
+
+def resolve_temporal_types(types, ampm):
+    """Collapse the temporal types observed in a column into a single type.
+
+    :param types: set containing any of TIME, Date and TIMESTAMP
+    :param ampm: whether any of the values had an am/pm marker
+    :return: a SQLAlchemy TypeEngine
+    """
+    # If a mix of dates and datetimes, up-convert dates to datetimes
+    if types == {TIMESTAMP, Date}:
+        return TIMESTAMP
+    # Times don't mix with dates or datetimes -- fallback to using strings
+    elif TIME in types and len(types) > 1:
+        return String
+    elif types == {TIME} and ampm:
+        return String
+    elif not types:
+        return String
+
+    return next(iter(types))
+
+
+def _integer_type(x):
+    """Mirror the integer stage of normalize_column_type for a single value.
+
+    :return: Integer or BigInteger, or None if x rules out an integer column.
+    """
+    try:
+        int_x = int(x.replace(',', ''))
+        if x[0] == '0' and int(x) != 0:
+            return None
+    except ValueError:
+        return None
+
+    if x.isspace():
+        return None
+
+    if 9000000000000000000 > int_x > 1000000000:
+        return BigInteger
+    elif 1000000000 > int_x:
+        return Integer
+    return None
+
+
+def _is_float(x):
+    try:
+        float(x.replace(',', ''))
+    except ValueError:
+        return False
+    return True
+
+
+class ColumnTypeState(object):
+    """Type lattice for one column that is fed a single value at a time.
+
+    Reaches the same conclusion as normalize_column_type without holding the
+    column in memory. Each candidate type (bool -> int -> bigint -> float ->
+    date/time/timestamp -> string) is struck off as soon as a value rules it
+    out, and once only String is left, values are just checked for nulls.
+
+    Values that still read as numbers are not date-parsed straight away,
+    since most of them belong to numeric columns. Up to `max_deferred`
+    distinct ones are kept and replayed through the temporal check if the
+    column turns out not to be numeric after all.
+    """
+
+    def __init__(self, max_deferred=1000):
+        self.null_values = False
+        self.max_deferred = max_deferred
+
+        self.maybe_boolean = True
+        self.maybe_integer = True
+        self.maybe_float = True
+        self.maybe_temporal = True
+
+        self.integer_type = Integer
+        self.temporal_types = set()
+        self.ampm = False
+        self.deferred = set()
+
+    @property
+    def settled(self):
+        """True when every candidate except String has been ruled out."""
+        return not (self.maybe_boolean or self.maybe_integer or
+                    self.maybe_float or self.maybe_temporal)
+
+    def add(self, x):
+        if x is None or x.lower() in NULL_VALUES:
+            self.null_values = True
+            self.maybe_boolean = False
+            return
+
+        if self.settled:
+            return
+
+        if self.maybe_boolean:
+            lowered = x.lower()
+            if lowered not in TRUE_VALUES and lowered not in FALSE_VALUES:
+                self.maybe_boolean = False
+
+        if self.maybe_integer:
+            integer_type = _integer_type(x)
+            if integer_type is None:
+                self.maybe_integer = False
+            elif integer_type is BigInteger:
+                self.integer_type = BigInteger
+
+        if self.maybe_float and not _is_float(x):
+            self.maybe_float = False
+            for deferred in self.deferred:
+                self._add_temporal(deferred)
+            self.deferred = set()
+
+        if self.maybe_float:
+            if len(self.deferred) < self.max_deferred:
+                self.deferred.add(x)
+        else:
+            self._add_temporal(x)
+
+    def _add_temporal(self, x):
+        if not self.maybe_temporal:
+            return
+
+        try:
+            self.temporal_types.add(temporal_type(x))
+        except (ValueError, TypeError, OverflowError):
+            self.maybe_temporal = False
+            return
+
+        lowered = x.lower()
+        if 'am' in lowered or 'pm' in lowered:
+            self.ampm = True
+
+        if resolve_temporal_types(self.temporal_types, self.ampm) is String:
+            self.maybe_temporal = False
+
+    def result(self):
+        """
+        :return: (col_type, null_values) just like normalize_column_type
+        """
+        if self.maybe_boolean:
+            col_type = Boolean
+        elif self.maybe_integer:
+            col_type = self.integer_type
+        elif self.maybe_float:
+            col_type = Float
+        elif self.maybe_temporal:
+            col_type = resolve_temporal_types(self.temporal_types, self.ampm)
+        else:
+            col_type = String
+        return col_type, self.null_values
+
+
+def infer_column_types(reader, width):
+    """Guess the type of every column in a single pass over the rows.
+
+    :param reader: iterable of rows (lists of strings), header excluded
+    :param width: number of columns to infer
+    :return: list of (col_type, null_values), one for each column
+    """
+    states = [ColumnTypeState() for _ in range(width)]
+    for row in reader:
+        if row:
+            # Short rows leave their missing columns untouched,
+            # long rows have their extra cells ignored.
+            for state, x in zip(states, row):
+                state.add(x)
+    return [state.result() for state in states]
+
+
+# Types that can be widened into one another without going through a string.
+WIDENING_CHAINS = ((Integer, BigInteger, Float), (Date, TIMESTAMP))
+
+
+def value_type(x):
+    """Narrowest type that Postgres will accept a single raw CSV value as.
+
+    Used to check rows against a schema inferred from a sample.
+
+    :param x: A string value from a column
+    :return: a SQLAlchemy TypeEngine, or None if COPY will read x as NULL
+    """
+    if x == '':
+        return None
+
+    lowered = x.lower()
+    if lowered in TRUE_VALUES or lowered in FALSE_VALUES:
+        return Boolean
+
+    if PG_INTEGER.match(x):
+        magnitude = abs(int(x))
+        if magnitude <= PG_INTEGER_MAX:
+            return Integer
+        elif magnitude <= PG_BIGINT_MAX:
+            return BigInteger
+        return Float
+
+    if PG_NUMERIC.match(x):
+        return Float
+
+    try:
+        return temporal_type(x)
+    except (ValueError, TypeError, OverflowError):
+        return String
+
+
+def widen_type(type_, x):
+    """Smallest type that holds both the values of a type_ column and x.
+
+    :param type_: current type of the column
+    :param x: A string value from a column
+    :return: type_ itself if x fits, otherwise a wider SQLAlchemy TypeEngine
+    """
+    if type_ is String:
+        return String
+
+    other = value_type(x)
+    if other is None or other is type_:
+        return type_
+
+    for chain in WIDENING_CHAINS:
+        if type_ in chain and other in chain:
+            return chain[max(chain.index(type_), chain.index(other))]
+    return String
@@ -0,0 +1,56 @@
+"""
+Version counters of the data behind cached API responses.
+
+Each kind of data ('point' and 'shape' datasets by name, 'weather' and
+'network' as a whole) has a counter in Redis that goes up whenever the data
+changes. Bumping a dataset also bumps its kind's '*' counter, which stands
+for every dataset of that kind. Cached responses keep the versions of what
+they were computed from, and don't count as hits once any of them moves on.
+
+The counters live in Redis rather than behind Flask-Cache so that Celery
+workers, which have no app, can bump them.
+"""
+
+import logging
+
+from redis import Redis
+
+from plenario.settings import CACHE_CONFIG, REDIS_HOST
+
+logger = logging.getLogger(__name__)
+
+ALL = '*'
+KINDS = ('point', 'shape', 'weather', 'network')
+
+redis = Redis(REDIS_HOST)
+
+
+def version_key(kind, name=ALL):
+    return '{}version:{}:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'], kind, name)
+
+
+def bump_version(kind, name=ALL):
+    """
+    Mark a dataset as changed, so cached responses computed from it expire.
+    A failure is logged rather than raised; the responses still expire with their TTL.
+    """
+    assert kind in KINDS, kind
+    try:
+        pipe = redis.pipeline()
+        pipe.incr(version_key(kind, name))
+        if name != ALL:
+            pipe.incr(version_key(kind))
+        pipe.execute()
+    except Exception:
+        logger.exception('Failed to bump the version of {} {}.'.format(kind, name))
+
+
+def get_versions(dependencies):
+    """
+    :param dependencies: [(kind, name)] of the data a response was computed from
+    :return: [version] in the same order, 0 for data that's never changed
+    """
+    if not dependencies:
+        return []
+    values = redis.mget([version_key(kind, name) for kind, name in dependencies])
+    return [int(v) if v is not None else 0 for v in values]
@@ -4,7 +4,6 @@ import itertools
 import re
 from collections import namedtuple
 from hashlib import md5
-from io import StringIO
 from urllib.parse import urlparse
 
 import requests
@@ -412,13 +411,10 @@ class GenericSuggestion(object):
 
     def _infer_columns(self):
         r = requests.get(self.file_url, stream=True)
-        inp = StringIO()
 
         head = itertools.islice(r.iter_lines(), 1000)
-        for line in head:
-            inp.write(line.decode("utf-8") + '\n')
-        inp.seek(0)
-        column_info = infer_csv_columns(inp)
+        lines = (line.decode("utf-8") + '\n' for line in head)
+        column_info = infer_csv_columns(lines)
 
         return [ColumnMeta(name, type_.__visit_name__.lower(), '')
                 for name, type_, _ in column_info]
@@ -0,0 +1,33 @@
+import os
+import threading
+
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlparse
+
+pwd = os.path.dirname(os.path.realpath(__file__))
+
+
+class _FixtureHandler(SimpleHTTPRequestHandler):
+    """Serve files from the fixtures directory, wherever the tests run from."""
+
+    def translate_path(self, path):
+        return os.path.join(pwd, os.path.basename(urlparse(path).path))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(object):
+    """Serve the fixtures over HTTP on a free local port, for tests of remote sources."""
+
+    def __enter__(self):
+        self.server = HTTPServer(('localhost', 0), _FixtureHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def url(self, name):
+        return 'http://localhost:{}/{}'.format(self.server.server_port, name)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
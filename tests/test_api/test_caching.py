@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from flask import Flask, request
+
+from plenario.api.caching import ARG_DEFAULTS, canonical_key, canonical_query, dependencies, is_historical, refresh, \
+    single_flight
+
+
+class TestCanonicalKeys(unittest.TestCase):
+
+    path = '/v1/api/timeseries'
+    defaults = ARG_DEFAULTS['timeseries']
+
+    def key(self, *args):
+        return canonical_key(self.path, [(name, [value]) for name, value in args], self.defaults)
+
+    def test_argument_order(self):
+        self.assertEqual(self.key(('agg', 'month'), ('dataset_name', 'crimes')),
+                         self.key(('dataset_name', 'crimes'), ('agg', 'month')))
+
+    def test_defaults_dropped(self):
+        self.assertEqual(self.key(('agg', 'week'), ('dataset_name', 'crimes')),
+                         self.key(('dataset_name', 'crimes')))
+        self.assertNotEqual(self.key(('agg', 'month')), self.key())
+
+    def test_date_formats(self):
+        self.assertEqual(self.key(('obs_date__ge', '2016-01-01')),
+                         self.key(('obs_date__ge', '2016-01-01T00:00:00')))
+
+    def test_condition_trees(self):
+        self.assertEqual(self.key(('crimes__filter', '{"op": "eq", "col": "iucr", "val": 1150}')),
+                         self.key(('crimes__filter', '{"val":1150,"col":"iucr","op":"eq"}')))
+
+    def test_nested_condition_trees(self):
+        # Timeseries takes one tree per dataset, each under its own name.
+        tree = '{"op": "and", "val": [{"op": "eq", "col": "iucr", "val": 1150}, {"op": "ge", "col": "beat", "val": 1}]}'
+        same = '{"val":[{"val":1150,"op":"eq","col":"iucr"},{"col":"beat","val":1,"op":"ge"}],"op":"and"}'
+        self.assertEqual(self.key(('dataset_name__in', 'crimes,permits'), ('permits__filter', tree)),
+                         self.key(('dataset_name__in', 'crimes,permits'), ('permits__filter', same)))
+
+    def test_replayed_query(self):
+        # Logged queries are replayed to warm the cache, so they have to land on the same key.
+        args = [('obs_date__ge', ['2016-01-01']), ('agg', ['week']),
+                ('crimes__filter', ['{"op": "eq", "col": "iucr", "val": 1150}'])]
+        query = canonical_query(self.path, args, self.defaults)
+        path, query_string = query.split('?')
+        self.assertEqual(path, self.path)
+        self.assertEqual(canonical_key(path, parse_qs(query_string).items(), self.defaults),
+                         canonical_key(self.path, args, self.defaults))
+
+    def test_stable(self):
+        # The same in every process, unlike hash().
+        self.assertEqual(self.key(('dataset_name', 'crimes')),
+                         'view:/v1/api/timeseries:d914a5e9d234ccd922308f0475e81e97f91b6076')
+
+
+class TestDependencies(unittest.TestCase):
+
+    def test_named_datasets(self):
+        args = {'dataset_name__in': 'crimes,permits', 'crimes__filter': '{}', 'shape': 'wards'}
+        self.assertEqual(dependencies('timeseries', args),
+                         [('point', 'crimes'), ('point', 'permits'), ('shape', 'wards')])
+
+    def test_path_parameters(self):
+        self.assertEqual(dependencies('point_fields', {}, {'dataset_name': 'crimes'}), [('point', 'crimes')])
+
+    def test_any_dataset(self):
+        self.assertEqual(dependencies('meta', {}), [('point', '*')])
+        self.assertEqual(dependencies('weather', {}, {'table': 'daily'}), [('weather', '*')])
+
+    def test_unversioned(self):
+        self.assertEqual(dependencies('slow', {'dataset_name': 'crimes'}), [])
+
+    def test_historical(self):
+        now = datetime(2017, 3, 1, 12)
+        self.assertTrue(is_historical({'obs_date__le': '2017-02-28'}, now))
+        self.assertFalse(is_historical({'obs_date__le': '2017-03-01T06:00'}, now))
+        self.assertFalse(is_historical({'obs_date__ge': '2016-01-01'}, now))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_one_computation(self):
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.5)
+            return 'response'
+
+        def request():
+            results.append(single_flight('view:/test/single-flight', [], compute))
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['response'] * 8)
+
+
+class TestRefresh(unittest.TestCase):
+
+    def test_refresh_once_in_request_context(self):
+        app = Flask(__name__)
+        done = threading.Event()
+        paths = []
+
+        def compute():
+            paths.append(request.full_path)
+            time.sleep(0.2)
+            done.set()
+
+        with app.test_request_context('/v1/api/timeseries?dataset_name=crimes'):
+            refresh('view:/test/refresh', compute)
+            refresh('view:/test/refresh', compute)
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(paths, ['/v1/api/timeseries?dataset_name=crimes'])
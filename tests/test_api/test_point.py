@@ -3,7 +3,13 @@ import os
 import urllib.request, urllib.parse, urllib.error
 from io import StringIO
 import csv
+from datetime import datetime
 
+from plenario.api.common import extract_first_geometry_fragment, make_fragment_str
+from plenario.database import postgres_engine, postgres_session
+from plenario.models import MetaTable
+from plenario.utils.cells import cover
+from plenario.utils.helpers import get_size_in_degrees
 from tests.fixtures.base_test import BasePlenarioTest, fixtures_path
 
 # Filters
@@ -120,6 +126,22 @@ class PointAPITests(BasePlenarioTest):
     # /detail tree filters
     # ====================
 
+    def test_detail_since_latest_batch(self):
+        r = self.get_api_response('detail?dataset_name=flu_shot_clinics&since=2100-01-01')
+        self.assertEqual(r['objects'], [])
+        self.assertEqual(r['meta']['removed'], [])
+        self.assertIsNotNone(r['meta']['batch'])
+
+    def test_detail_since_rebuild(self):
+        # The dataset was added after batch 0, so there's no delta since then.
+        response = self.app.get('/v1/api/detail?dataset_name=flu_shot_clinics&since_batch=0')
+        self.assertEqual(response.status_code, 400)
+
+    def test_detail_since_before_change_log(self):
+        # Nothing's logged from before the first batch, so a delta would look complete but miss records.
+        response = self.app.get('/v1/api/detail?dataset_name=flu_shot_clinics&since=1900-01-01')
+        self.assertEqual(response.status_code, 400)
+
     def test_detail_with_simple_flu_filter(self):
         r = self.get_api_response('detail?obs_date__ge=2000&dataset_name=flu_shot_clinics&' + FLU_BASE + FLU_FILTER_SIMPLE)
         self.assertEqual(r['meta']['total'], 4)
@@ -335,6 +357,29 @@ class PointAPITests(BasePlenarioTest):
         # No flu shot clinics in 2012, 65 in 2013.
         self.assertEqual(name_to_series['flu_shot_clinics'], [0, 65])
 
+    def test_geo_filter_cell_counts_match_points(self):
+        rect_path = os.path.join(fixtures_path, 'loop_rectangle.json')
+        with open(rect_path) as rect_json:
+            geom = make_fragment_str(extract_first_geometry_fragment(rect_json.read()))
+        crimes = MetaTable.get_by_dataset_name('crimes')
+        self.assertTrue(crimes.cell_counts)
+
+        args = ('day', datetime(2000, 1, 1, 12), datetime(2020, 1, 1, 12), geom)
+        counted = crimes.timeseries_one(*args)
+        crimes.cell_counts = None
+        scanned = crimes.timeseries_one(*args)
+        postgres_session.rollback()
+        self.assertEqual(counted, scanned)
+
+    def test_cover_capped(self):
+        rect_path = os.path.join(fixtures_path, 'loop_rectangle.json')
+        with open(rect_path) as rect_json:
+            geom = make_fragment_str(extract_first_geometry_fragment(rect_json.read()))
+        size_x, size_y = get_size_in_degrees(500, 41.88)
+        self.assertIsNotNone(cover(postgres_engine, geom, size_x, size_y))
+        # Past the cap, timeseries count the point table instead.
+        self.assertIsNone(cover(postgres_engine, geom, size_x, size_y, max_squares=1))
+
     def test_geo_filter(self):
         escaped_query_rect = get_loop_rect()
 
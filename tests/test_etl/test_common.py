@@ -0,0 +1,219 @@
+import bz2
+import csv
+import gzip
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+
+from plenario.etl.common import DigestSet, DownloadStream, ETLFile, FileRange, RejectLog, csv_chunk_ranges, file_digest, \
+    hash_copy_text_lines, hash_csv_records, line_numbers, raw_csv_rows, record_text
+from sqlalchemy import Integer, String
+from tests.fixtures.fixture_server import FixtureServer
+
+
+class TestRowHashes(unittest.TestCase):
+
+    def test_record_text(self):
+        # Same form as Postgres' CAST(row AS text).
+        self.assertEqual(record_text(['a', None, '', 'b c', 'x"y', 'a\\b']),
+                         '(a,,"","b c","x""y","a\\\\b")')
+
+    def test_csv_duplicates_dropped(self):
+        f = io.StringIO('1,foo\n2,"bar\nbaz"\n1,foo\n')
+        with DigestSet() as digests:
+            lines = list(hash_csv_records(raw_csv_rows(f), digests))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('2,"bar\nbaz",'))
+        self.assertEqual(len(lines[0].rstrip('\n').split(',')[-1]), 32)
+
+    def test_copy_text_matches_csv(self):
+        # NULL is empty in CSV and \N in COPY's text format; both hash alike.
+        with DigestSet() as digests:
+            csv_line, = hash_csv_records(raw_csv_rows(io.StringIO('1,\n')), digests)
+        with DigestSet() as digests:
+            text_line, = hash_copy_text_lines(['1\t\\N\n', '\\.\n'], digests)
+        self.assertEqual(csv_line.split(',')[-1], text_line.split('\t')[-1])
+
+    def test_digests_spill_to_disk(self):
+        with DigestSet(max_in_memory=2) as digests:
+            added = [digests.add(d) for d in [b'a', b'b', b'c', b'd', b'c', b'a']]
+        self.assertEqual(added, [True, True, True, True, False, False])
+
+
+fixtures_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../fixtures')
+
+
+class TestSourceValidators(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(fixtures_path, 'dog_park_permits.csv')
+
+    def test_same_contents_unchanged(self):
+        with ETLFile(source_path=self.path, digest=file_digest(self.path)) as helper:
+            self.assertTrue(helper.unchanged)
+
+    def test_new_contents_changed(self):
+        with ETLFile(source_path=self.path, digest='0' * 32) as helper:
+            self.assertFalse(helper.unchanged)
+
+    def test_first_ingest_changed(self):
+        with ETLFile(source_path=self.path) as helper:
+            self.assertFalse(helper.unchanged)
+            self.assertEqual(helper.digest, file_digest(self.path))
+
+
+    def test_validators_only_sent_when_conditional(self):
+        # A 304 leaves nothing to load, so adding a dataset always fetches it in full.
+        url = 'http://nightvale.gov/dogpark.csv'
+        helper = ETLFile(source_url=url, etag='"abc"', last_modified='Wed, 21 Oct 2015 07:28:00 GMT')
+        self.assertNotIn('If-None-Match', helper.request_headers)
+        self.assertNotIn('If-Modified-Since', helper.request_headers)
+        helper.conditional = True
+        self.assertEqual(helper.request_headers['If-None-Match'], '"abc"')
+        self.assertEqual(helper.request_headers['If-Modified-Since'], 'Wed, 21 Oct 2015 07:28:00 GMT')
+
+class TestDownloadStream(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(fixtures_path, 'crime_sample.csv')
+
+    def test_reads_whole_download(self):
+        with FixtureServer() as server:
+            stream = DownloadStream(server.url('crime_sample.csv'), chunk_size=1024, max_chunks=2)
+            with io.BufferedReader(stream) as f:
+                contents = f.read()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(contents, f.read())
+        self.assertEqual(stream.digest, file_digest(self.path))
+
+    def test_close_stops_download(self):
+        # A reader that gives up early doesn't leave the download blocked on a full queue.
+        with FixtureServer() as server:
+            stream = DownloadStream(server.url('crime_sample.csv'), chunk_size=16, max_chunks=1)
+            stream.read(16)
+            stream.close()
+            stream._thread.join(5)
+        self.assertFalse(stream._thread.is_alive())
+        self.assertIsNone(stream.digest)
+
+
+class TestChunkRanges(unittest.TestCase):
+
+    def test_quoted_newlines_stay_whole(self):
+        rows = ['id,note\n'] + ['{},"line one\nline two"\n'.format(i) for i in range(50)]
+        with tempfile.NamedTemporaryFile('w+b', suffix='.csv') as f:
+            f.write(''.join(rows).encode('utf-8'))
+            f.flush()
+            ranges = csv_chunk_ranges(f, 4, block_size=16)
+
+            read = []
+            for start, end in ranges:
+                text = io.TextIOWrapper(io.BufferedReader(FileRange(f.name, start, end)), encoding='utf-8')
+                read.extend(row for row, _ in raw_csv_rows(text))
+
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(read, [[str(i), 'line one\nline two'] for i in range(50)])
+
+    def test_line_numbers(self):
+        rows = ['id,note\n'] + ['{},"line one\nline two"\n'.format(i) for i in range(50)]
+        with tempfile.NamedTemporaryFile('w+b', suffix='.csv') as f:
+            f.write(''.join(rows).encode('utf-8'))
+            f.flush()
+            ranges = csv_chunk_ranges(f, 4, block_size=16)
+            firsts = line_numbers(f, [start for start, _ in ranges], block_size=16)
+
+            for (start, _), line in zip(ranges, firsts):
+                f.seek(start)
+                row = int(f.readline().split(b',')[0])
+                self.assertEqual(line, 2 + 2 * row)
+
+
+class TestRejects(unittest.TestCase):
+
+    def test_malformed_records_rejected(self):
+        f = io.StringIO('id,note\n1,ok\n2\n3,"two\nlines"\n\n4,a,b\n5,fine\n')
+        with RejectLog() as rejects:
+            rows = [row for row, _ in raw_csv_rows(f, rejects)]
+            self.assertEqual(rows, [['id', 'note'], ['1', 'ok'], ['3', 'two\nlines'], [], ['5', 'fine']])
+            self.assertEqual(rejects.counts, (3, 2))
+
+            rejects._file.seek(0)
+            logged = [(int(line), record) for line, _, record in csv.reader(rejects._file)]
+        self.assertEqual(logged, [(3, '2\n'), (7, '4,a,b\n')])
+
+    def test_forks_count_together(self):
+        with RejectLog(width=2) as rejects:
+            for lines in (['1,a\n', '2\n'], ['3,c\n', '4,d\n']):
+                list(raw_csv_rows(lines, rejects.fork(1)))
+            self.assertEqual(rejects.counts, (3, 1))
+            self.assertEqual(rejects.error_rate, 0.25)
+
+    def test_values_checked_against_types(self):
+        f = io.StringIO('id,count,note\n1,N/A,ok\n2,"1,000",ok\n3,7,n/a\n')
+        with RejectLog(types=[Integer, Integer, String]) as rejects:
+            records = list(raw_csv_rows(f, rejects))
+            self.assertEqual(rejects.counts, (2, 1))
+
+            rejects._file.seek(0)
+            (line, reason, _), = csv.reader(rejects._file)
+        # The null token in a typed column goes to COPY as NULL; the one in a text column stays.
+        self.assertEqual(records[1:], [(['1', '', 'ok'], '1,,ok\n'), (['3', '7', 'n/a'], '3,7,n/a\n')])
+        self.assertEqual(line, '3')
+        self.assertIn('Integer', reason)
+
+
+class TestCompressedSources(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.text = 'id,note\n1,"two\nlines"\n'
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def source(self, name, opener):
+        path = os.path.join(self.dir.name, name)
+        with opener(path) as f:
+            f.write(self.text.encode('utf-8'))
+        return path
+
+    def assertReadsBack(self, path, compression):
+        with ETLFile(source_path=path) as helper:
+            self.assertEqual(helper.compression, compression)
+            with helper.open_text() as f:
+                self.assertEqual(f.read(), self.text)
+
+    def test_plain(self):
+        self.assertReadsBack(self.source('s.csv', lambda p: open(p, 'wb')), None)
+
+    def test_gzip(self):
+        self.assertReadsBack(self.source('s.csv.gz', lambda p: gzip.open(p, 'wb')), 'gzip')
+
+    def test_bz2(self):
+        self.assertReadsBack(self.source('s.csv.bz2', lambda p: bz2.open(p, 'wb')), 'bz2')
+
+    def test_zip(self):
+        path = os.path.join(self.dir.name, 's.zip')
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('s.csv', self.text)
+        self.assertReadsBack(path, 'zip')
+
+        # Staging seeks back to the start between reads,
+        # and to where a checkpoint left off when resuming.
+        with ETLFile(source_path=path) as helper:
+            with helper.open_text() as f:
+                f.read()
+                f.seek(0)
+                self.assertEqual(f.read(), self.text)
+                f.seek(0)
+                f.readline()
+                checkpoint = f.tell()
+                f.read()
+                f.seek(checkpoint)
+                self.assertEqual(f.read(), '1,"two\nlines"\n')
+
+        with ETLFile(source_path=path) as helper:
+            with helper.open_binary(unzip=False) as f:
+                self.assertEqual(zipfile.ZipFile(f).namelist(), ['s.csv'])
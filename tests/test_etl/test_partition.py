@@ -0,0 +1,22 @@
+import unittest
+from datetime import datetime
+
+from plenario.etl.partition import partition_bounds, partition_name
+
+
+class TestPartitionRanges(unittest.TestCase):
+
+    def test_month_bounds(self):
+        self.assertEqual(partition_bounds('month', datetime(2015, 12, 1)),
+                         (datetime(2015, 12, 1), datetime(2016, 1, 1)))
+        self.assertEqual(partition_bounds('month', datetime(2015, 2, 1)),
+                         (datetime(2015, 2, 1), datetime(2015, 3, 1)))
+
+    def test_year_bounds(self):
+        self.assertEqual(partition_bounds('year', datetime(2015, 1, 1)),
+                         (datetime(2015, 1, 1), datetime(2016, 1, 1)))
+
+    def test_names(self):
+        self.assertEqual(partition_name('crimes', 'month', datetime(2015, 3, 1)), 'crimes_p2015_03')
+        self.assertEqual(partition_name('crimes', 'year', datetime(2015, 1, 1)), 'crimes_p2015')
+        self.assertEqual(partition_name('crimes', 'year', None), 'crimes_pnull')
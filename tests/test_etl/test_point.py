@@ -4,12 +4,17 @@ import sqlalchemy as sa
 from sqlalchemy import Table, Column, Integer, Date, Float, String, TIMESTAMP, MetaData, Text
 from sqlalchemy.exc import NoSuchTableError
 from geoalchemy2 import Geometry
+from plenario.etl.partition import drop_point_table
 from plenario.etl.point import Staging, PlenarioETL
 import os
 import json
-from datetime import date
-from plenario.models import MetaTable
+from datetime import date, datetime
+from unittest import mock
+from plenario.etl.common import PlenarioETLError
+from plenario.models import IngestBatch, IngestState, MetaTable
+from plenario.utils.helpers import get_size_in_degrees
 from manage import init
+from tests.fixtures.fixture_server import FixtureServer
 
 pwd = os.path.dirname(os.path.realpath(__file__))
 fixtures_path = os.path.join(pwd, '../fixtures')
@@ -41,6 +46,10 @@ class StagingTableTests(TestCase):
 
         cls.dog_path = os.path.join(fixtures_path, 'dog_park_permits.csv')
         cls.radio_path = os.path.join(fixtures_path, 'community_radio_events.csv')
+        cls.gzipped_radio_path = os.path.join(fixtures_path, 'community_radio_events.csv.gz')
+        cls.zipped_radio_path = os.path.join(fixtures_path, 'community_radio_events.csv.zip')
+        cls.malformed_radio_path = os.path.join(fixtures_path, 'community_radio_events_malformed.csv')
+        cls.typos_radio_path = os.path.join(fixtures_path, 'community_radio_events_typos.csv')
         cls.opera_path = os.path.join(fixtures_path, 'public_opera_performances.csv')
 
         cls.expected_radio_col_names = ['lat', 'lon', 'event_name', 'date']
@@ -145,6 +154,106 @@ class StagingTableTests(TestCase):
                 all_rows = connection.execute(s_table.table.select()).fetchall()
         self.assertEqual(len(all_rows), 5)
 
+    def test_staging_sampled(self):
+        # Types come from a sample, the rest of the rows are checked on COPY.
+        with Staging(self.unloaded_meta, source_path=self.radio_path, sample_size=2) as s_table:
+            observed_names = self.extract_names(s_table.cols)
+            with postgres_engine.begin() as connection:
+                all_rows = connection.execute(s_table.table.select()).fetchall()
+        self.assertEqual(set(observed_names), set(self.expected_radio_col_names))
+        self.assertEqual(len(all_rows), 5)
+
+    def test_staging_streamed(self):
+        with FixtureServer() as server:
+            meta = MetaTable(url=server.url('community_radio_events.csv'),
+                             human_name='Community Radio Events', business_key='Event Name',
+                             observed_date='Date', latitude='lat', longitude='lon')
+            with Staging(meta, stream=True) as s_table:
+                self.assertTrue(s_table.file_helper.is_stream)
+                with postgres_engine.begin() as connection:
+                    all_rows = connection.execute(s_table.table.select()).fetchall()
+        self.assertEqual(len(all_rows), 5)
+
+    def test_staging_streamed_restarts_for_text(self):
+        # Host ID looks numeric at first. Once it turns out to be text,
+        # the source is downloaded and loaded again, so values stay as written.
+        with FixtureServer() as server:
+            meta = MetaTable(url=server.url('community_radio_events_hosts.csv'),
+                             human_name='Community Radio Events', business_key='Event Name',
+                             observed_date='Date', latitude='lat', longitude='lon')
+            with Staging(meta, stream=True, sample_size=2) as s_table:
+                self.assertFalse(s_table.file_helper.is_stream)
+                with postgres_engine.begin() as connection:
+                    rows = connection.execute(sa.select([s_table.table.c.host_id])).fetchall()
+        self.assertEqual({row.host_id for row in rows}, {'1.50', '2.25', 'X-3', '4', '5'})
+
+    def test_staging_parallel(self):
+        # Each worker copies its own range of the CSV.
+        with Staging(self.unloaded_meta, source_path=self.radio_path, workers=3) as s_table:
+            with postgres_engine.begin() as connection:
+                all_rows = connection.execute(s_table.table.select()).fetchall()
+        self.assertEqual(len(all_rows), 5)
+
+    def test_staging_resumes_after_failure(self):
+        # A failure after the staging load keeps the table for next time.
+        with self.assertRaises(RuntimeError):
+            with Staging(self.unloaded_meta, source_path=self.radio_path):
+                raise RuntimeError('Failed after staging')
+        self.assertIsNotNone(IngestState.get(self.unloaded_meta.dataset_name))
+
+        with Staging(self.unloaded_meta, source_path=self.radio_path) as s_table:
+            self.assertIsNotNone(s_table.resume)
+            with postgres_engine.begin() as connection:
+                all_rows = connection.execute(s_table.table.select()).fetchall()
+        self.assertEqual(len(all_rows), 5)
+        self.assertIsNone(IngestState.get(self.unloaded_meta.dataset_name))
+
+    def test_staging_gzipped(self):
+        # The source is decompressed on its way into inference and COPY.
+        with Staging(self.unloaded_meta, source_path=self.gzipped_radio_path, workers=3) as s_table:
+            observed_names = self.extract_names(s_table.cols)
+            with postgres_engine.begin() as connection:
+                all_rows = connection.execute(s_table.table.select()).fetchall()
+        self.assertEqual(set(observed_names), set(self.expected_radio_col_names))
+        self.assertEqual(len(all_rows), 5)
+
+    def test_staging_zipped(self):
+        # Inference and COPY each read the CSV in the archive from the top.
+        with Staging(self.unloaded_meta, source_path=self.zipped_radio_path) as s_table:
+            observed_names = self.extract_names(s_table.cols)
+            with postgres_engine.begin() as connection:
+                all_rows = connection.execute(s_table.table.select()).fetchall()
+        self.assertEqual(set(observed_names), set(self.expected_radio_col_names))
+        self.assertEqual(len(all_rows), 5)
+
+    def test_staging_rejects_malformed(self):
+        # The short record is set aside and the rest load.
+        with mock.patch('plenario.etl.point.ETL_MAX_ERROR_RATE', 0.5):
+            with Staging(self.unloaded_meta, source_path=self.malformed_radio_path) as s_table:
+                with postgres_engine.begin() as connection:
+                    all_rows = connection.execute(s_table.table.select()).fetchall()
+        self.assertEqual(len(all_rows), 4)
+        rejects = postgres_engine.execute('SELECT line_number FROM "{}"'.format(s_table.rejects_name)).fetchall()
+        self.assertEqual(rejects, [(3,)])
+
+    def test_staging_rejects_values_that_dont_fit(self):
+        # N/A in the integer column loads as NULL, and 1,000 can't be loaded at all.
+        with mock.patch('plenario.etl.point.ETL_MAX_ERROR_RATE', 0.5):
+            with Staging(self.unloaded_meta, source_path=self.typos_radio_path) as s_table:
+                with postgres_engine.begin() as connection:
+                    rows = connection.execute(sa.select([s_table.table.c.listeners])).fetchall()
+        listeners = [row.listeners for row in rows]
+        self.assertEqual(sorted(listeners, key=lambda v: v or 0), [None, 45, 120, 300])
+        rejects = postgres_engine.execute('SELECT line_number FROM "{}"'.format(s_table.rejects_name)).fetchall()
+        self.assertEqual(rejects, [(4,)])
+
+    def test_staging_error_rate_exceeded(self):
+        with self.assertRaises(PlenarioETLError):
+            with Staging(self.unloaded_meta, source_path=self.malformed_radio_path):
+                pass
+        rejects = postgres_engine.execute('SELECT count(*) FROM "r_{}"'.format(self.unloaded_meta.dataset_name))
+        self.assertEqual(rejects.scalar(), 1)
+
     def test_staging_existing_table(self):
         # With a fixture CSV whose columns match the existing dataset,
         # create a staging table.
@@ -163,11 +272,11 @@ class StagingTableTests(TestCase):
 
     def test_update_no_change(self):
         etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
-        etl.update()
+        self.assertTrue(etl.update())
 
-        # We're just checking that an exception doesn't get thrown.
+        # Nothing's written, so cached responses stay valid.
         etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
-        etl.update()
+        self.assertFalse(etl.update())
 
     def test_update_with_delete(self):
         etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
@@ -180,6 +289,82 @@ class StagingTableTests(TestCase):
 
         all_rows = postgres_session.execute(self.existing_table.select()).fetchall()
         self.assertEqual(len(all_rows), 4)
+        self.assertEqual((etl.inserted, etl.deleted), (0, 1))
+
+    def test_update_logs_changes(self):
+        etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
+        etl.update()
+        before = IngestBatch.latest(self.existing_meta.dataset_name)
+
+        deleted_path = os.path.join(fixtures_path, 'dog_park_permits_deleted.csv')
+        etl = PlenarioETL(self.existing_meta, source_path=deleted_path)
+        etl.update()
+
+        batch = IngestBatch.latest(self.existing_meta.dataset_name)
+        self.assertGreater(batch.id, before.id)
+        self.assertEqual((batch.full, batch.added, batch.removed), (False, 0, 1))
+        removed = IngestBatch.changed_since(self.existing_meta.dataset_name, before.id, removed=True)
+        self.assertEqual(len(postgres_engine.execute(removed).fetchall()), 1)
+        # A delta that stops at the earlier batch doesn't see the later one.
+        removed = IngestBatch.changed_since(self.existing_meta.dataset_name, before.id, removed=True,
+                                            until=before.id)
+        self.assertEqual(postgres_engine.execute(removed).fetchall(), [])
+
+    def test_update_keeps_daily_counts(self):
+        etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
+        etl.update()
+        self.assertTrue(self.existing_meta.daily_counts)
+
+        # The second update takes the deleted record off its day.
+        deleted_path = os.path.join(fixtures_path, 'dog_park_permits_deleted.csv')
+        etl = PlenarioETL(self.existing_meta, source_path=deleted_path)
+        etl.update()
+
+        counted = postgres_engine.execute(
+            "SELECT sum(count) FROM etl_daily_count WHERE dataset_name = 'dog_park_permits'").scalar()
+        self.assertEqual(counted, 4)
+
+    def test_daily_counts_match_point_table(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+        timed_path = os.path.join(fixtures_path, 'community_radio_events_timed.csv')
+        PlenarioETL(self.unloaded_meta, source_path=timed_path).add()
+
+        # Both ends fall partway through a day with a record on either side of them.
+        start, end = datetime(2015, 10, 25, 12), datetime(2015, 11, 15, 12)
+        for agg_unit in ('day', 'week', 'month'):
+            counts = []
+            for actuals in (self.unloaded_meta._daily_actuals(agg_unit, start, end),
+                            self.unloaded_meta._point_actuals(agg_unit, start, end)):
+                sel = sa.select([actuals.c.time_bucket, actuals.c.count]).order_by(actuals.c.time_bucket)
+                counts.append([(bucket, int(count)) for bucket, count in postgres_engine.execute(sel)])
+            self.assertEqual(counts[0], counts[1])
+            self.assertEqual(sum(count for _, count in counts[0]), 4)
+
+    def test_update_meta_from_delta(self):
+        etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
+        etl.update()
+        obs_from, obs_to = self.existing_meta.obs_from, self.existing_meta.obs_to
+
+        # Only the records that are new this time get folded in.
+        deleted_path = os.path.join(fixtures_path, 'dog_park_permits_deleted.csv')
+        etl = PlenarioETL(self.existing_meta, source_path=deleted_path)
+        etl.update()
+        self.assertEqual((self.existing_meta.obs_from, self.existing_meta.obs_to), (obs_from, obs_to))
+        self.assertIsNotNone(self.existing_meta.bbox)
+
+    def test_update_meta_from_delta_skips_null_island(self):
+        etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
+        etl.update()
+        bbox = postgres_session.query(sa.func.ST_AsText(self.existing_meta.bbox)).scalar()
+
+        # The new record is geocoded to (0,0), so it has no geom and doesn't stretch the bounding box.
+        island_path = os.path.join(fixtures_path, 'dog_park_permits_null_island.csv')
+        etl = PlenarioETL(self.existing_meta, source_path=island_path)
+        etl.update()
+        self.assertEqual(etl.inserted, 1)
+        self.assertEqual(postgres_session.query(sa.func.ST_AsText(self.existing_meta.bbox)).scalar(), bbox)
+        geom = postgres_engine.execute('SELECT geom FROM dog_park_permits WHERE hooded_figure_id = 6').scalar()
+        self.assertIsNone(geom)
 
     def test_update_with_change(self):
         drop_if_exists(self.unloaded_meta.dataset_name)
@@ -195,6 +380,56 @@ class StagingTableTests(TestCase):
         changed_date = postgres_engine.execute(sel).fetchone()[0]
         self.assertEqual(changed_date, date(1993, 11, 10))
 
+    def test_update_with_changed_type(self):
+        etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
+        etl.update()
+
+        # The IDs aren't integers anymore, so the table is rebuilt with the new type.
+        retyped_path = os.path.join(fixtures_path, 'dog_park_permits_retyped.csv')
+        etl = PlenarioETL(self.existing_meta, source_path=retyped_path)
+        etl.update()
+
+        table = Table('dog_park_permits', MetaData(), autoload_with=postgres_engine)
+        self.assertIsInstance(table.c.hooded_figure_id.type, sa.String)
+        ids = postgres_engine.execute('SELECT hooded_figure_id FROM dog_park_permits ORDER BY 1').fetchall()
+        self.assertEqual([i for i, in ids], ['A-1', 'A-2', 'A-3', 'A-4', 'A-5'])
+        self.assertFalse(postgres_engine.has_table('swap_dog_park_permits'))
+
+    def test_failed_ingest_keeps_old_validators(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+
+        # Otherwise the next update would skip the source as unchanged, though it never went in.
+        with mock.patch('plenario.etl.point.Creation', side_effect=PlenarioETLError('Failed to index')):
+            with self.assertRaises(PlenarioETLError):
+                PlenarioETL(self.unloaded_meta, source_path=self.radio_path).add()
+        self.assertIsNone(self.unloaded_meta.source_digest)
+
+    def test_update_with_swap(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        etl.add()
+
+        # The changed data is built off to the side and swapped in.
+        changed_path = os.path.join(fixtures_path, 'community_radio_events_changed.csv')
+        etl = PlenarioETL(self.unloaded_meta, source_path=changed_path)
+        etl.update(swap=True)
+
+        sel = "SELECT date FROM community_radio_events WHERE event_name = 'baz'"
+        changed_date = postgres_engine.execute(sel).fetchone()[0]
+        self.assertEqual(changed_date, date(1993, 11, 10))
+        self.assertFalse(postgres_engine.has_table('swap_community_radio_events'))
+
+        # The changed record is logged as a delta against the table it replaced.
+        batch = IngestBatch.latest(self.unloaded_meta.dataset_name)
+        self.assertEqual((batch.full, batch.added, batch.removed), (False, 1, 1))
+        self.assertEqual((etl.inserted, etl.deleted), (1, 1))
+        # The daily counts were rebuilt along with the swap.
+        counted = postgres_engine.execute(
+            "SELECT count FROM etl_daily_count WHERE dataset_name = 'community_radio_events' "
+            "AND day = '1993-11-10'").scalar()
+        self.assertEqual(counted, 1)
+
     def test_new_table(self):
         drop_if_exists(self.unloaded_meta.dataset_name)
 
@@ -210,6 +445,60 @@ class StagingTableTests(TestCase):
         bbox = MetaTable.get_by_dataset_name('community_radio_events').bbox
         self.assertIsNotNone(bbox)
 
+    def test_new_table_has_grid_cells(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        new_table = etl.add()
+
+        grid_cells = self.unloaded_meta.grid_cells
+        self.assertEqual(grid_cells['resolutions'], [250, 500, 1000])
+        # Grouping by the stored keys gives the same squares as snapping to the grid.
+        size_x, size_y = get_size_in_degrees(500, grid_cells['latitude'])
+        by_key = postgres_engine.execute(
+            'SELECT count(*) FROM community_radio_events GROUP BY cell_500 ORDER BY 1').fetchall()
+        by_snap = postgres_engine.execute(
+            'SELECT count(*) FROM community_radio_events '
+            'GROUP BY ST_SnapToGrid(geom, 0, 0, %s, %s) ORDER BY 1', (size_x, size_y)).fetchall()
+        self.assertEqual(by_key, by_snap)
+        self.assertNotIn('cell_500', self.unloaded_meta.column_names)
+        drop_point_table(new_table.name)
+
+    def test_new_partitioned_table(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+        self.unloaded_meta.partition_by = 'year'
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        new_table = etl.add()
+
+        # Rows land in the partitions, but read back through the parent.
+        all_rows = postgres_session.execute(new_table.select()).fetchall()
+        self.assertEqual(len(all_rows), 5)
+        parent_only = postgres_session.execute(
+            'SELECT count(*) FROM ONLY community_radio_events').scalar()
+        self.assertEqual(parent_only, 0)
+        postgres_session.close()
+        drop_point_table(new_table.name)
+
+    def test_new_table_with_layout_policy(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+        self.unloaded_meta.layout_policy = {'cluster': 'geohash', 'statistics': {'point_date': 500}}
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        new_table = etl.add()
+
+        clustered = postgres_engine.execute(
+            "SELECT indexrelid::regclass::text FROM pg_index "
+            "WHERE indrelid = 'community_radio_events'::regclass AND indisclustered").scalar()
+        self.assertEqual(clustered, 'ix_community_radio_events_geohash')
+        self.assertEqual(set(self.unloaded_meta.layout_timings), {'detail', 'timeseries', 'grid'})
+        drop_point_table(new_table.name)
+
+    def test_unknown_layout_policy(self):
+        self.unloaded_meta.layout_policy = {'cluster': 'hilbert'}
+        with self.assertRaises(PlenarioETLError):
+            PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+
     def test_new_table_has_correct_column_names_in_meta(self):
         drop_if_exists(self.unloaded_meta.dataset_name)
 
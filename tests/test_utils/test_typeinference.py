@@ -0,0 +1,81 @@
+import csv
+import os
+import unittest
+
+from sqlalchemy import BigInteger, Boolean, Date, Float, Integer, String
+from sqlalchemy.dialects.postgresql import TIME, TIMESTAMP
+
+from plenario.utils.typeinference import ColumnTypeState, could_be_temporal, fast_temporal_type, \
+    infer_column_types, normalize_column_type, widen_type
+
+fixtures_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../fixtures')
+
+
+def stream(values):
+    state = ColumnTypeState()
+    for value in values:
+        state.add(value)
+    return state.result()
+
+
+class TestColumnTypeState(unittest.TestCase):
+
+    def test_lattice(self):
+        self.assertEqual(stream(['t', 'f', 'yes']), (Boolean, False))
+        self.assertEqual(stream(['1', '', '2']), (Integer, True))
+        self.assertEqual(stream(['1', '3000000000']), (BigInteger, False))
+        self.assertEqual(stream(['1', '2.5']), (Float, False))
+        self.assertEqual(stream(['2015-01-01', '2015-01-02']), (Date, False))
+        self.assertEqual(stream(['2015-01-01', '2015-01-02 10:00']), (TIMESTAMP, False))
+        self.assertEqual(stream(['10:30', '11:45']), (TIME, False))
+        self.assertEqual(stream(['10:30', '2015-01-01']), (String, False))
+        self.assertEqual(stream(['1', 'foo']), (String, False))
+
+    def test_deferred_numbers_count_against_dates(self):
+        # '5' reads as a date, so mixing it with a time gives a string column.
+        self.assertEqual(stream(['5', '10:30']), normalize_column_type(['5', '10:30']))
+
+    def test_matches_normalize_column_type_on_fixtures(self):
+        for name in os.listdir(fixtures_path):
+            if not name.endswith('.csv'):
+                continue
+            with open(os.path.join(fixtures_path, name), encoding='utf-8') as f:
+                rows = list(csv.reader(f))
+            header, body = rows[0], rows[1:]
+            expected = [normalize_column_type([r[i] for r in body if len(r) > i])
+                        for i in range(len(header))]
+            self.assertEqual(infer_column_types(iter(body), len(header)), expected, name)
+
+
+class TestFastTemporalType(unittest.TestCase):
+
+    def test_common_shapes(self):
+        self.assertEqual(fast_temporal_type('2015-10-12'), Date)
+        self.assertEqual(fast_temporal_type('2015-10-12 00:00:00'), Date)
+        self.assertEqual(fast_temporal_type('2015-10-12T05:00:00.000'), TIMESTAMP)
+        self.assertEqual(fast_temporal_type('10/12/2015 05:00:00 PM'), TIMESTAMP)
+        self.assertEqual(fast_temporal_type('10/12/2015 12:00:00 AM'), Date)
+        self.assertEqual(fast_temporal_type('5:30 PM'), TIME)
+
+    def test_leaves_edge_cases_to_dateutil(self):
+        self.assertIsNone(fast_temporal_type('13/01/2015'))
+        self.assertIsNone(fast_temporal_type('2999-12-31'))
+        self.assertIsNone(fast_temporal_type('October 12, 2015'))
+
+    def test_could_be_temporal(self):
+        self.assertTrue(could_be_temporal('073XX S INDIANA AVE'))
+        self.assertTrue(could_be_temporal('Monday'))
+        self.assertFalse(could_be_temporal('CRIMINAL DAMAGE'))
+
+
+class TestWidenType(unittest.TestCase):
+
+    def test_widen_type(self):
+        self.assertIs(widen_type(Integer, '12'), Integer)
+        self.assertIs(widen_type(Integer, ''), Integer)
+        self.assertIs(widen_type(Integer, '3000000000'), BigInteger)
+        self.assertIs(widen_type(BigInteger, '1.5'), Float)
+        self.assertIs(widen_type(Date, '2015-01-01 10:00'), TIMESTAMP)
+        self.assertIs(widen_type(Date, '10:00'), String)
+        self.assertIs(widen_type(Float, 'foo'), String)
+        self.assertIs(widen_type(Boolean, '1'), String)